@@ -25,6 +25,9 @@ import asyncio
 import threading
 import asyncio
 import itertools
+import heapq
+import bisect
+import time
 from collections import defaultdict
 from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List
 
@@ -34,7 +37,6 @@ from .util import profiler, bfh, TxMinedInfo
 from .transaction import Transaction, TxOutput, TxInput, PartialTxInput, TxOutpoint, PartialTransaction
 from .synchronizer import Synchronizer
 from .verifier import SPV
-from .blockchain import hash_header
 from .i18n import _
 from .logging import Logger
 
@@ -92,7 +94,7 @@ class AddressSynchronizer(Logger):
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
 
-        self._get_addr_balance_cache = {}
+        self._clear_addr_caches()
 
         self.load_and_cleanup()
 
@@ -168,7 +170,8 @@ class AddressSynchronizer(Logger):
             util.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
 
     def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
+        with self.lock, self.transaction_lock:
+            self._update_balance_cache_height(self.get_local_height())
 
     def stop(self):
         if self.network:
@@ -182,6 +185,8 @@ class AddressSynchronizer(Logger):
             self.db.put('stored_height', self.get_local_height())
 
     def add_address(self, address):
+        with self.lock, self.transaction_lock:
+            self._invalidate_addr_caches(address)
         if not self.db.get_addr_history(address):
             self.db.history[address] = []
             self.set_up_to_date(False)
@@ -281,7 +286,7 @@ class AddressSynchronizer(Logger):
                         if n == prevout_n:
                             if addr and self.is_mine(addr):
                                 self.db.add_txi_addr(tx_hash, addr, ser, v)
-                                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                                self._invalidate_addr_caches(addr)
                             return
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
@@ -300,7 +305,7 @@ class AddressSynchronizer(Logger):
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    self._invalidate_addr_caches(addr)
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
@@ -336,8 +341,7 @@ class AddressSynchronizer(Logger):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+            self._invalidate_tx_caches(tx_hash)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
@@ -371,6 +375,8 @@ class AddressSynchronizer(Logger):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    with self.transaction_lock:
+                        self._invalidate_tx_caches(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.db.set_addr_history(addr, hist)
@@ -420,6 +426,7 @@ class AddressSynchronizer(Logger):
         with self.lock:
             with self.transaction_lock:
                 self.db.clear_history()
+                self._clear_addr_caches()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -446,11 +453,87 @@ class AddressSynchronizer(Logger):
         return f
 
     @with_local_height_cached
-    def get_history(self, *, domain=None) -> Sequence[HistoryItem]:
-        # get domain
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
+    def get_history(self, *, domain=None, from_timestamp=None, to_timestamp=None) -> Sequence[HistoryItem]:
+        """Returns the history of domain, oldest first.
+        If from_timestamp or to_timestamp are given, only the items with
+        from_timestamp <= timestamp < to_timestamp are returned, where
+        unconfirmed txs count as happening now.
+        """
+        if domain is not None:
+            history = self._get_history_of_domain(set(domain))
+            return self._filter_history_by_time(history, from_timestamp, to_timestamp)
+        domain = set(self.get_addresses())
+        with self.lock, self.transaction_lock:
+            self._update_history_index(domain)
+            index = self._history_index
+            balances = self._history_index_balances
+            max_timestamps = self._history_index_max_timestamps
+            min_timestamps = self._history_index_min_timestamps
+            # fixme: this may happen if history is incomplete
+            c, u, x = self.get_balance(domain)
+            if (balances[-1] if balances else 0) != c + u + x:
+                self.logger.warning("history not synchronized")
+                return []
+            # block timestamps need not be monotonic, so the running max and
+            # min only narrow down the candidates, which are filtered below.
+            # unconfirmed txs are inf there, while they count as happening now.
+            start = bisect.bisect_left(max_timestamps, from_timestamp) if from_timestamp else 0
+            if to_timestamp and to_timestamp <= time.time():
+                stop = bisect.bisect_left(min_timestamps, to_timestamp)
+            else:
+                stop = len(index)
+            h2 = []
+            for i in range(start, stop):
+                tx_hash = index[i][1]
+                h2.append(HistoryItem(txid=tx_hash,
+                                      tx_mined_status=self.get_tx_height(tx_hash),
+                                      delta=self._history_index_deltas[tx_hash][1],
+                                      fee=self.get_tx_fee(tx_hash),
+                                      balance=balances[i]))
+        return self._filter_history_by_time(h2, from_timestamp, to_timestamp)
+
+    def get_monotonic_timestamps(self, txids: Sequence[str], *, domain=None) -> List[float]:
+        """For each of txids, the max of the timestamps of the history of domain
+        up to that tx, where unconfirmed txs count as inf.
+        """
+        if domain is not None:
+            max_timestamps = {}
+            max_timestamp = 0
+            for hist_item in self._get_history_of_domain(set(domain)):
+                max_timestamp = max(max_timestamp, hist_item.tx_mined_status.timestamp or float('inf'))
+                max_timestamps[hist_item.txid] = max_timestamp
+            return [max_timestamps.get(txid, float('inf')) for txid in txids]
+        domain = set(self.get_addresses())
+        with self.lock, self.transaction_lock:
+            self._update_history_index(domain)
+            index = self._history_index
+            deltas = self._history_index_deltas
+            max_timestamps = self._history_index_max_timestamps
+            out = []
+            for txid in txids:
+                if txid not in deltas:
+                    out.append(float('inf'))  # removed in the meantime
+                    continue
+                i = bisect.bisect_left(index, (deltas[txid][0], txid))
+                out.append(max_timestamps[i])
+            return out
+
+    def _filter_history_by_time(self, history: Sequence[HistoryItem],
+                                from_timestamp, to_timestamp) -> Sequence[HistoryItem]:
+        if not from_timestamp and not to_timestamp:
+            return history
+        now = time.time()
+        out = []
+        for hist_item in history:
+            timestamp = hist_item.tx_mined_status.timestamp or now
+            if from_timestamp and timestamp < from_timestamp:
+                continue
+            if to_timestamp and timestamp >= to_timestamp:
+                continue
+            out.append(hist_item)
+        return out
+
+    def _get_history_of_domain(self, domain: Set[str]) -> Sequence[HistoryItem]:
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)  # type: Dict[str, Optional[int]]
@@ -492,8 +575,96 @@ class AddressSynchronizer(Logger):
 
         return h2
 
+    def _clear_history_index(self) -> None:
+        # (txpos, txid) of the txs in the history of the wallet, sorted
+        self._history_index = None  # type: Optional[List[Tuple[Tuple[int, int], str]]]
+        self._history_index_domain = set()  # type: Set[str]
+        # txid -> (txpos, delta)
+        self._history_index_deltas = {}  # type: Dict[str, Tuple[Tuple[int, int], int]]
+        # for each position of the index: running balance, block timestamp (inf if
+        # unverified), running max of timestamps, and min of the timestamps from there on
+        self._history_index_balances = []  # type: List[int]
+        self._history_index_timestamps = []  # type: List[float]
+        self._history_index_max_timestamps = []  # type: List[float]
+        self._history_index_min_timestamps = []  # type: List[float]
+        # txs whose position or delta might have changed
+        self._history_index_dirty = set()  # type: Set[str]
+
+    def _get_history_index_entry(self, tx_hash: str, domain: Set[str]) -> Optional[Tuple[Tuple[int, int], int]]:
+        addrs = set(itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)))
+        addrs &= domain
+        if not addrs:
+            return None
+        delta = sum(self.get_tx_delta(tx_hash, addr) for addr in addrs)
+        return self.get_txpos(tx_hash), delta
+
+    def _update_history_index(self, domain: Set[str]) -> None:
+        """Brings the history index up to date. Only the running balances
+        after the first changed position are recomputed, which is usually
+        the tail of unconfirmed txs.
+        """
+        index = self._history_index
+        deltas = self._history_index_deltas
+        if index is None or domain != self._history_index_domain:
+            deltas.clear()
+            for addr in domain:
+                for tx_hash in self._history_local.get(addr, ()):
+                    if tx_hash not in deltas:
+                        deltas[tx_hash] = self._get_history_index_entry(tx_hash, domain)
+            index = self._history_index = sorted((txpos, tx_hash) for tx_hash, (txpos, delta) in deltas.items())
+            self._history_index_domain = set(domain)
+            self._history_index_dirty.clear()
+            first_changed = 0
+        else:
+            first_changed = len(index)
+            for tx_hash in self._history_index_dirty:
+                old = deltas.pop(tx_hash, None)
+                if old is not None:
+                    i = bisect.bisect_left(index, (old[0], tx_hash))
+                    del index[i]
+                    first_changed = min(first_changed, i)
+                new = self._get_history_index_entry(tx_hash, domain)
+                if new is not None:
+                    deltas[tx_hash] = new
+                    i = bisect.bisect_left(index, (new[0], tx_hash))
+                    index.insert(i, (new[0], tx_hash))
+                    first_changed = min(first_changed, i)
+            self._history_index_dirty.clear()
+        balances = self._history_index_balances
+        timestamps = self._history_index_timestamps
+        max_timestamps = self._history_index_max_timestamps
+        min_timestamps = self._history_index_min_timestamps
+        del balances[first_changed:]
+        del timestamps[first_changed:]
+        del max_timestamps[first_changed:]
+        del min_timestamps[first_changed:]
+        balance = balances[-1] if balances else 0
+        max_timestamp = max_timestamps[-1] if max_timestamps else 0
+        for txpos, tx_hash in index[first_changed:]:
+            balance += deltas[tx_hash][1]
+            balances.append(balance)
+            verified_tx_mined_info = self.db.get_verified_tx(tx_hash)
+            timestamp = verified_tx_mined_info.timestamp if verified_tx_mined_info else None
+            timestamp = timestamp or float('inf')
+            timestamps.append(timestamp)
+            max_timestamp = max(max_timestamp, timestamp)
+            max_timestamps.append(max_timestamp)
+        min_timestamp = float('inf')
+        tail = []
+        for timestamp in reversed(timestamps[first_changed:]):
+            min_timestamp = min(min_timestamp, timestamp)
+            tail.append(min_timestamp)
+        min_timestamps.extend(reversed(tail))
+        # the mins before first_changed only change as long as they differ
+        for i in range(first_changed - 1, -1, -1):
+            min_timestamp = min(timestamps[i], min_timestamp)
+            if min_timestamps[i] == min_timestamp:
+                break
+            min_timestamps[i] = min_timestamp
+
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
+            self._history_index_dirty.add(txid)
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
@@ -502,6 +673,7 @@ class AddressSynchronizer(Logger):
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
+            self._history_index_dirty.add(txid)
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
                 cur_hist = self._history_local.get(addr, set())
                 try:
@@ -529,26 +701,31 @@ class AddressSynchronizer(Logger):
     def add_unverified_tx(self, tx_hash, tx_height):
         if self.db.is_in_verified_tx(tx_hash):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
-                with self.lock:
+                with self.lock, self.transaction_lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self._invalidate_tx_caches(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
-            with self.lock:
+            with self.lock, self.transaction_lock:
                 # tx will be verified only if height > 0
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self._invalidate_tx_caches(tx_hash)
                 self.unverified_tx[tx_hash] = tx_height
 
     def remove_unverified_tx(self, tx_hash, tx_height):
-        with self.lock:
+        with self.lock, self.transaction_lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._invalidate_tx_caches(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
-        with self.lock:
+        with self.lock, self.transaction_lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._invalidate_tx_caches(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         util.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -560,13 +737,12 @@ class AddressSynchronizer(Logger):
     def undo_verifications(self, blockchain, above_height):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
-        with self.lock:
+        with self.lock, self.transaction_lock:
             for tx_hash in self.db.list_verified_tx():
                 info = self.db.get_verified_tx(tx_hash)
                 tx_height = info.height
                 if tx_height > above_height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
+                    if info.header_hash is None or not blockchain.check_hash(tx_height, info.header_hash):
                         self.db.remove_verified_tx(tx_hash)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
@@ -578,6 +754,7 @@ class AddressSynchronizer(Logger):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self._invalidate_tx_caches(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -594,6 +771,8 @@ class AddressSynchronizer(Logger):
             tx_was_added = self.add_transaction(tx)
             if tx_was_added:
                 self.future_tx[tx.txid()] = num_blocks
+                with self.transaction_lock:
+                    self._invalidate_tx_caches(tx.txid())
             return tx_was_added
 
     def get_tx_height(self, tx_hash: str) -> TxMinedInfo:
@@ -745,8 +924,51 @@ class AddressSynchronizer(Logger):
         self.db.add_num_inputs_to_tx(txid, len(tx.inputs()))
         return fee
 
-    def get_addr_io(self, address):
+    def _clear_addr_caches(self) -> None:
+        # address -> (received, sent), as returned by get_addr_io
+        self._addr_io_cache = {}  # type: Dict[str, Tuple[Dict[str, Tuple[int, int, bool]], Dict[str, int]]]
+        # address -> prevout_str -> (tx_height, value, is_coinbase)
+        self._addr_utxo_cache = {}  # type: Dict[str, Dict[str, Tuple[int, int, bool]]]
+        self._get_addr_balance_cache = {}  # type: Dict[str, Tuple[int, int, int]]
+        # the cached balances are valid as of this local height
+        self._balance_cache_height = 0
+        # heap of (mempool height at which some coinbase output of address matures, address)
+        self._immature_coinbase_queue = []  # type: List[Tuple[int, str]]
+        self._clear_history_index()
+
+    def _invalidate_addr_caches(self, addr: str) -> None:
+        """Must be called when the history of addr or the height
+        of one of its transactions changes.
+        """
+        self._addr_io_cache.pop(addr, None)
+        self._addr_utxo_cache.pop(addr, None)
+        self._get_addr_balance_cache.pop(addr, None)
+
+    def _invalidate_tx_caches(self, tx_hash: str) -> None:
+        self._history_index_dirty.add(tx_hash)
+        for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
+            self._invalidate_addr_caches(addr)
+
+    def _update_balance_cache_height(self, local_height: int) -> None:
+        """Drops the cached balances that are different at local_height,
+        because some of their coinbase outputs matured (or did not, on reorgs).
+        """
+        if local_height < self._balance_cache_height:
+            self._get_addr_balance_cache = {}
+            self._immature_coinbase_queue = []
+        mempool_height = local_height + 1
+        queue = self._immature_coinbase_queue
+        while queue and queue[0][0] <= mempool_height:
+            _, addr = heapq.heappop(queue)
+            self._get_addr_balance_cache.pop(addr, None)
+        self._balance_cache_height = local_height
+
+    def _get_addr_io(self, address):
+        # note: the returned dicts are cached; do not modify them
         with self.lock, self.transaction_lock:
+            io = self._addr_io_cache.get(address)
+            if io is not None:
+                return io
             h = self.get_address_history(address)
             received = {}
             sent = {}
@@ -758,14 +980,29 @@ class AddressSynchronizer(Logger):
                 l = self.db.get_txi_addr(tx_hash, address)
                 for txi, v in l:
                     sent[txi] = height
-        return received, sent
+            io = self._addr_io_cache[address] = received, sent
+            return io
+
+    def get_addr_io(self, address):
+        received, sent = self._get_addr_io(address)
+        return dict(received), dict(sent)
+
+    def _get_addr_utxos(self, address: str) -> Dict[str, Tuple[int, int, bool]]:
+        # note: the returned dict is cached; do not modify it
+        with self.lock, self.transaction_lock:
+            utxos = self._addr_utxo_cache.get(address)
+            if utxos is not None:
+                return utxos
+            received, spent = self._get_addr_io(address)
+            utxos = dict(received)
+            for txi in spent:
+                utxos.pop(txi)
+            self._addr_utxo_cache[address] = utxos
+            return utxos
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for prevout_str, v in coins.items():
+        for prevout_str, v in self._get_addr_utxos(address).items():
             tx_height, value, is_cb = v
             prevout = TxOutpoint.from_str(prevout_str)
             utxo = PartialTxInput(prevout=prevout,
@@ -778,7 +1015,7 @@ class AddressSynchronizer(Logger):
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
+        received, sent = self._get_addr_io(address)
         return sum([v for height, v, is_cb in received.values()])
 
     @with_local_height_cached
@@ -786,36 +1023,43 @@ class AddressSynchronizer(Logger):
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        if not excluded_coins:  # cache is only used if there are no excluded_coins
-            cached_value = self._get_addr_balance_cache.get(address)
-            if cached_value:
-                return cached_value
         if excluded_coins is None:
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        mempool_height = self.get_local_height() + 1  # height of next block
-        for txo, (tx_height, v, is_cb) in received.items():
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        with self.lock, self.transaction_lock:
+            mempool_height = self.get_local_height() + 1  # height of next block
+            if not excluded_coins:  # cache is only used if there are no excluded_coins
+                self._update_balance_cache_height(mempool_height - 1)
+                cached_value = self._get_addr_balance_cache.get(address)
+                if cached_value:
+                    return cached_value
+            received, sent = self._get_addr_io(address)
+            c = u = x = 0
+            matures_at = None
+            for txo, (tx_height, v, is_cb) in received.items():
+                if txo in excluded_coins:
+                    continue
+                if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
+                    x += v
+                    if matures_at is None or tx_height + COINBASE_MATURITY < matures_at:
+                        matures_at = tx_height + COINBASE_MATURITY
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        if not excluded_coins:
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_addr_balance_cache[address] = result
+                    u += v
+                if txo in sent:
+                    if sent[txo] > 0:
+                        c -= v
+                    else:
+                        u -= v
+            result = c, u, x
+            # cache result.
+            if not excluded_coins:
+                # Cache gets invalidated if a transaction is added to/removed from
+                # history, or changes height; or when a coinbase output matures
+                self._get_addr_balance_cache[address] = result
+                if matures_at is not None:
+                    heapq.heappush(self._immature_coinbase_queue, (matures_at, address))
         return result
 
     @with_local_height_cached
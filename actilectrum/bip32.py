@@ -96,6 +96,23 @@ def _CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: bytes)
     return child_pubkey, child_chaincode
 
 
+def CKD_pub_range(parent_pubkey: bytes, parent_chaincode: bytes, start: int, count: int) -> List[bytes]:
+    """Returns the child public keys of indices start, ..., start+count-1,
+    as CKD_pub would derive them one at a time.
+    """
+    if start < 0: raise ValueError('the bip32 index needs to be non-negative')
+    if count <= 0: return []
+    if (start + count - 1) & BIP32_PRIME: raise Exception('not possible to derive hardened child from parent pubkey')
+    tweaks = [hmac_oneshot(parent_chaincode, parent_pubkey + child_index.to_bytes(4, 'big'), hashlib.sha512)[0:32]
+              for child_index in range(start, start + count)]
+    child_pubkeys = ecc.pubkey_tweak_add_many(parent_pubkey, tweaks)
+    for i, child_pubkey in enumerate(child_pubkeys):
+        if child_pubkey is None:
+            # let CKD_pub skip the invalid index
+            child_pubkeys[i] = CKD_pub(parent_pubkey, parent_chaincode, start + i)[0]
+    return child_pubkeys
+
+
 def xprv_header(xtype: str, *, net=None) -> bytes:
     if net is None:
         net = constants.net
@@ -269,6 +286,10 @@ class BIP32Node(NamedTuple):
                          fingerprint=fingerprint,
                          child_number=child_number)
 
+    def child_pubkeys_at_public_derivation(self, start: int, count: int) -> List[bytes]:
+        """Returns the compressed pubkeys of the children start, ..., start+count-1 of this node."""
+        return CKD_pub_range(self.eckey.get_public_key_bytes(compressed=True), self.chaincode, start, count)
+
     def calc_fingerprint_of_this_node(self) -> bytes:
         """Returns the fingerprint of this node.
         Note that self.fingerprint is of the *parent*.
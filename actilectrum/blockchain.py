@@ -21,12 +21,15 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import hashlib
+import mmap
 import threading
 import time
-from typing import Optional, Dict, Mapping, Sequence
+from collections import OrderedDict
+from typing import Optional, Dict, Mapping, Sequence, List, Tuple
 
 from . import util
-from .bitcoin import hash_encode, int_to_hex, rev_hex
+from .bitcoin import hash_encode, hash_decode, int_to_hex, rev_hex
 from .crypto import sha256d
 from . import constants
 from .util import bfh, bh2u
@@ -36,6 +39,17 @@ from .logging import get_logger, Logger
 _logger = get_logger(__name__)
 
 HEADER_SIZE = 80  # bytes
+NULL_HEADER = bytes(HEADER_SIZE)
+HASH_SIZE = 32  # bytes
+NULL_HASH = bytes(HASH_SIZE)
+HEADER_CACHE_SIZE = 4096  # number of deserialized headers kept per chain
+CHAINWORK_SIZE = 32  # bytes
+# hash of the last header of a retarget period, and chainwork up to and including it
+CHAINWORK_ENTRY_SIZE = HASH_SIZE + CHAINWORK_SIZE
+# with 'headers_durability' set to 'batched', header writes are only fsynced
+# after this many writes or seconds, and on shutdown
+HEADERS_FSYNC_COUNT = 100
+HEADERS_FSYNC_INTERVAL = 30
 MAX_TARGET = 0x00000FFFFF000000000000000000000000000000000000000000000000000000
 
 
@@ -81,6 +95,38 @@ def hash_header(header: dict) -> str:
 def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
+
+def _hash_of_raw_header(header: bytes) -> bytes:
+    if header == NULL_HEADER:
+        return NULL_HASH
+    return sha256d(bytes(header))
+
+
+def hashes_of_raw_headers(data: bytes) -> bytes:
+    """Returns the concatenated sha256d (internal byte order) of
+    the consecutive raw headers in data. Null headers get a null hash.
+    """
+    sha256 = hashlib.sha256
+    hashes = []
+    for i in range(0, len(data) - len(data) % HEADER_SIZE, HEADER_SIZE):
+        header = data[i:i+HEADER_SIZE]
+        if header == NULL_HEADER:
+            hashes.append(NULL_HASH)
+        else:
+            hashes.append(sha256(sha256(header).digest()).digest())
+    return b''.join(hashes)
+
+
+def raw_headers_connect(data: bytes, hashes: bytes, prev_hash: str) -> bool:
+    """Returns whether the consecutive raw headers in data form a chain
+    on top of the block with hash prev_hash.
+    hashes are their hashes as returned by hashes_of_raw_headers.
+    """
+    num = len(data) // HEADER_SIZE
+    prev_hashes = b''.join(data[i*HEADER_SIZE+4:i*HEADER_SIZE+36] for i in range(num))
+    return prev_hashes == (hash_decode(prev_hash) + hashes)[:num*HASH_SIZE]
+
+
 def pow_hash_header(header):
     pass
     # return hash_encode(getPoWHash(bfh(serialize_header(header))))
@@ -104,7 +150,9 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close_mmaps()
             os.unlink(best_chain.path())
+            best_chain.delete_hash_index()
             best_chain.update_size()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
@@ -113,9 +161,18 @@ def read_blockchains(config: 'SimpleConfig'):
     l = filter(lambda x: x.startswith('fork2_') and '.' not in x, os.listdir(fdir))
     l = sorted(l, key=lambda x: int(x.split('_')[1]))  # sort by forkpoint
 
-    def delete_chain(filename, reason):
+    def delete_chain(filename, reason, chain: 'Blockchain' = None):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
+        if chain is not None:
+            # files that are mapped cannot be deleted on Windows
+            chain.close_mmaps()
         os.unlink(os.path.join(fdir, filename))
+        if os.path.exists(os.path.join(fdir, filename + '.dirty')):
+            os.unlink(os.path.join(fdir, filename + '.dirty'))
+        for sidecar_dir in ('hashes', 'chainwork'):
+            sidecar_filename = os.path.join(util.get_headers_dir(config), sidecar_dir, filename)
+            if os.path.exists(sidecar_filename):
+                os.unlink(sidecar_filename)
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -141,10 +198,10 @@ def read_blockchains(config: 'SimpleConfig'):
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h):
-            delete_chain(filename, "incorrect first hash for chain")
+            delete_chain(filename, "incorrect first hash for chain", b)
             return
         if not b.parent.can_connect(h, check_height=False):
-            delete_chain(filename, "cannot connect chain to parent")
+            delete_chain(filename, "cannot connect chain to parent", b)
             return
         chain_id = b.get_id()
         assert first_hash == chain_id, (first_hash, chain_id)
@@ -154,20 +211,24 @@ def read_blockchains(config: 'SimpleConfig'):
         instantiate_chain(filename)
 
 
+def flush_blockchains() -> None:
+    """Makes all header writes durable."""
+    with blockchains_lock: chains = list(blockchains.values())
+    for b in chains:
+        b.flush()
+
+
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
-# block hash -> chain work; up to and including that block
-_CHAINWORK_CACHE = {
-    "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
-}  # type: Dict[str, int]
-
 
 def init_headers_file_for_best_chain():
     b = get_best_chain()
     filename = b.path()
     length = HEADER_SIZE * len(constants.net.CHECKPOINTS) * 2016
     if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        b.close_mmaps()
+        b.delete_hash_index()
         with open(filename, 'wb') as f:
             if length > 0:
                 f.seek(length - 1)
@@ -182,6 +243,8 @@ class Blockchain(Logger):
     Manages blockchain headers and their verification
     """
 
+    VERIFY_HEADERS = False  # no verify
+
     def __init__(self, config: SimpleConfig, forkpoint: int, parent: Optional['Blockchain'],
                  forkpoint_hash: str, prev_hash: Optional[str]):
         assert isinstance(forkpoint_hash, str) and len(forkpoint_hash) == 64, forkpoint_hash
@@ -196,6 +259,17 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._headers_mmap = None  # type: Optional[mmap.mmap]
+        self._hashes_mmap = None  # type: Optional[mmap.mmap]
+        self._header_cache = OrderedDict()  # type: OrderedDict[int, dict]
+        self._hash_index_in_sync = False
+        # number of headers that were durable before the writes not fsynced yet,
+        # or None if there are no such writes
+        self._durable_size = None  # type: Optional[int]
+        self._num_unflushed_writes = 0
+        self._last_flush_time = time.monotonic()
+        self._chainwork = None  # type: Optional[List[Tuple[bytes, int]]]
+        self._truncate_to_durable_size()
         self.update_size()
 
     def with_lock(func):
@@ -298,10 +372,260 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        # the file might have grown or shrunk; map it again on next read
+        self.close_mmaps()
+
+    @with_lock
+    def close_mmaps(self) -> None:
+        for mm in (self._headers_mmap, self._hashes_mmap):
+            if mm is None:
+                continue
+            try:
+                mm.close()
+            except BufferError:
+                # some slice of it is still alive; the mapping
+                # gets released when that is garbage collected
+                pass
+        self._headers_mmap = None
+        self._hashes_mmap = None
+
+    @with_lock
+    def _get_headers_mmap(self) -> Optional[mmap.mmap]:
+        """Returns a read-only memory map of our headers file,
+        covering exactly self.size() headers.
+        """
+        if self._headers_mmap is None and self._size > 0:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                self._headers_mmap = mmap.mmap(f.fileno(), self._size * HEADER_SIZE,
+                                               access=mmap.ACCESS_READ)
+        return self._headers_mmap
+
+    @with_lock
+    def hashes_path(self) -> str:
+        """Sidecar file of our headers file, holding the sha256d of
+        each header (32 bytes, internal byte order) at the same index.
+        Null headers have a null hash.
+        """
+        d = os.path.join(util.get_headers_dir(self.config), 'hashes')
+        return os.path.join(d, os.path.basename(self.path()))
+
+    @with_lock
+    def delete_hash_index(self) -> None:
+        self.close_mmaps()
+        self._hash_index_in_sync = False
+        name = self.hashes_path()
+        if os.path.exists(name):
+            os.unlink(name)
+
+    @with_lock
+    def _sync_hash_index(self) -> None:
+        """Makes the hash index hold exactly one hash per header in our
+        headers file, computing whatever is missing (e.g. for files
+        written by older versions, or after a crash between the two writes).
+        """
+        name = self.hashes_path()
+        util.make_dir(os.path.dirname(name))
+        num_hashes = os.path.getsize(name) // HASH_SIZE if os.path.exists(name) else 0
+        num_hashes = min(num_hashes, self._size)
+        headers_mm = self._get_headers_mmap()
+        with open(name, 'ab+') as f:
+            if num_hashes > 0:
+                # sanity check the last entry we are keeping
+                f.seek((num_hashes - 1) * HASH_SIZE)
+                last_hash = f.read(HASH_SIZE)
+                offset = (num_hashes - 1) * HEADER_SIZE
+                if last_hash != _hash_of_raw_header(headers_mm[offset:offset+HEADER_SIZE]):
+                    self.logger.info(f"hash index {name} is inconsistent with headers. rebuilding it.")
+                    num_hashes = 0
+            f.truncate(num_hashes * HASH_SIZE)
+            if num_hashes < self._size:
+                self.logger.info(f"computing hash index for {self._size - num_hashes} headers")
+                for start in range(num_hashes, self._size, 2016):
+                    end = min(start + 2016, self._size)
+                    f.write(hashes_of_raw_headers(headers_mm[start*HEADER_SIZE:end*HEADER_SIZE]))
+                f.flush()
+                os.fsync(f.fileno())
+        self._hash_index_in_sync = True
+
+    @with_lock
+    def _get_hashes_mmap(self) -> Optional[mmap.mmap]:
+        """Returns a read-only memory map of our hash index,
+        covering exactly self.size() hashes.
+        """
+        if self._hashes_mmap is None and self._size > 0:
+            if not self._hash_index_in_sync:
+                self._sync_hash_index()
+            with open(self.hashes_path(), 'rb') as f:
+                self._hashes_mmap = mmap.mmap(f.fileno(), self._size * HASH_SIZE,
+                                              access=mmap.ACCESS_READ)
+        return self._hashes_mmap
+
+    @with_lock
+    def chainwork_path(self) -> str:
+        """Sidecar file of our headers file, holding one entry per retarget
+        period ending at or after our forkpoint: the hash of the last header
+        of the period, and the chainwork up to and including that header
+        (32 bytes, big-endian).
+        """
+        d = os.path.join(util.get_headers_dir(self.config), 'chainwork')
+        return os.path.join(d, os.path.basename(self.path()))
+
+    @with_lock
+    def _load_chainwork(self) -> List[Tuple[bytes, int]]:
+        if self._chainwork is None:
+            self._chainwork = []
+            name = self.chainwork_path()
+            if os.path.exists(name):
+                with open(name, 'rb') as f:
+                    data = f.read()
+                num_entries = len(data) // CHAINWORK_ENTRY_SIZE
+                for i in range(num_entries):
+                    entry = data[i*CHAINWORK_ENTRY_SIZE:(i+1)*CHAINWORK_ENTRY_SIZE]
+                    self._chainwork.append((entry[:HASH_SIZE], int.from_bytes(entry[HASH_SIZE:], byteorder='big')))
+                if len(data) != num_entries * CHAINWORK_ENTRY_SIZE:
+                    # we crashed while appending
+                    self._truncate_chainwork(num_entries, force=True)
+        return self._chainwork
+
+    @with_lock
+    def _truncate_chainwork(self, num_entries: int, *, force: bool = False) -> None:
+        entries = self._load_chainwork()
+        if len(entries) <= num_entries and not force:
+            return
+        del entries[num_entries:]
+        name = self.chainwork_path()
+        if os.path.exists(name):
+            with open(name, 'rb+') as f:
+                f.truncate(num_entries * CHAINWORK_ENTRY_SIZE)
+
+    @with_lock
+    def _append_chainwork(self, new_entries: List[Tuple[bytes, int]]) -> None:
+        entries = self._load_chainwork()
+        name = self.chainwork_path()
+        util.make_dir(os.path.dirname(name))
+        with open(name, 'rb+' if os.path.exists(name) else 'wb') as f:
+            f.seek(len(entries) * CHAINWORK_ENTRY_SIZE)
+            f.write(b''.join(header_hash + work.to_bytes(CHAINWORK_SIZE, byteorder='big')
+                             for header_hash, work in new_entries))
+            f.truncate()
+        entries.extend(new_entries)
+
+    @with_lock
+    def _invalidate_chainwork(self, height: int) -> None:
+        """Drops the chainwork of retarget periods that include
+        the header at given height, or later ones.
+        """
+        first_period = self.forkpoint // 2016
+        self._truncate_chainwork(max(0, height // 2016 - first_period))
+
+    @with_lock
+    def _dirty_marker_path(self) -> str:
+        """While some of our writes are not fsynced yet, this file holds
+        the number of headers that were durable before those writes.
+        """
+        return self.path() + '.dirty'
+
+    def _is_fsync_batched(self) -> bool:
+        return self.config.get('headers_durability', 'full') == 'batched'
+
+    @with_lock
+    def _truncate_to_durable_size(self) -> None:
+        """Called on startup: drop whatever might not have been written
+        completely, if we were not shut down cleanly.
+        """
+        marker = self._dirty_marker_path()
+        if not os.path.exists(marker):
+            return
+        try:
+            with open(marker, 'r') as f:
+                durable_size = int(f.read())
+        except ValueError:
+            # we crashed while writing the marker, i.e. before touching the headers
+            durable_size = None
+        name = self.path()
+        if durable_size is not None and os.path.exists(name) and os.path.getsize(name) > durable_size * HEADER_SIZE:
+            self.logger.info(f"unclean shutdown. truncating {name} to {durable_size} headers")
+            with open(name, 'rb+') as f:
+                f.truncate(durable_size * HEADER_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+        os.unlink(marker)
+
+    @with_lock
+    def _mark_dirty(self, first_changed: int) -> None:
+        """Must be called before changing headers that will not be fsynced
+        right away, first_changed being the index of the first one.
+        """
+        durable_size = min(self._size, first_changed)
+        if self._durable_size is not None:
+            if durable_size >= self._durable_size:
+                return
+        with open(self._dirty_marker_path(), 'w') as f:
+            f.write(str(durable_size))
+            f.flush()
+            os.fsync(f.fileno())
+        self._durable_size = durable_size
+
+    @with_lock
+    def flush(self) -> None:
+        """Makes all our header writes durable."""
+        if self._durable_size is None:
+            return
+        for name in (self.path(), self.hashes_path()):
+            if os.path.exists(name):
+                with open(name, 'rb+') as f:
+                    os.fsync(f.fileno())
+        os.unlink(self._dirty_marker_path())
+        self._durable_size = None
+        self._num_unflushed_writes = 0
+        self._last_flush_time = time.monotonic()
+
+    @with_lock
+    def _write_hash_index(self, data: bytes, offset: int, truncate: bool, hashes: bytes = None,
+                          *, fsync: bool = True) -> None:
+        """Mirrors a write of raw headers to our headers file.
+        Must be called before self._size is updated.
+        """
+        if hashes is None:
+            hashes = hashes_of_raw_headers(data)
+        assert offset % HEADER_SIZE == 0, offset
+        assert self._hash_index_in_sync
+        self._hash_index_in_sync = False
+        hashes_offset = offset // HEADER_SIZE * HASH_SIZE
+        with open(self.hashes_path(), 'rb+') as f:
+            if truncate and offset != self._size * HEADER_SIZE:
+                f.seek(hashes_offset)
+                f.truncate()
+            f.seek(hashes_offset)
+            f.write(hashes)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        self._hash_index_in_sync = True
+
+    @with_lock
+    def _read_hash(self, height: int) -> Optional[bytes]:
+        """Returns the hash of the header at given height from the
+        hash index, or None if we don't have that header.
+        """
+        if height < 0:
+            return None
+        if height < self.forkpoint:
+            return self.parent._read_hash(height)
+        if height > self.height():
+            return None
+        offset = (height - self.forkpoint) * HASH_SIZE
+        header_hash = self._get_hashes_mmap()[offset:offset+HASH_SIZE]
+        if header_hash == NULL_HASH:
+            return None
+        return header_hash
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
-        return # no verify
+        if not cls.VERIFY_HEADERS:
+            return
         _hash = hash_header(header)
         # _powhash = pow_hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
@@ -317,22 +641,70 @@ class Blockchain(Logger):
         if block_hash_as_num > target:
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
+    @classmethod
+    def verify_raw_headers(cls, data: bytes, hashes: bytes, prev_hash: str, target: int,
+                           expected_hashes: Sequence[Optional[str]]) -> None:
+        """Same checks as verify_header, for a run of consecutive raw headers.
+        hashes are their hashes as returned by hashes_of_raw_headers.
+        The checks are done over the whole run at once, on the raw bytes.
+        """
+        if not cls.VERIFY_HEADERS:
+            return
+        num = len(data) // HEADER_SIZE
+        if num == 0:
+            return
+        assert len(hashes) == num * HASH_SIZE, (len(hashes), num)
+        assert len(expected_hashes) == num, (len(expected_hashes), num)
+        headers = [data[i*HEADER_SIZE:(i+1)*HEADER_SIZE] for i in range(num)]
+        hash_at = lambda i: hashes[i*HASH_SIZE:(i+1)*HASH_SIZE]
+
+        def first_mismatch(xs: bytes, ys: bytes, size: int) -> int:
+            return next(i for i in range(num) if xs[i*size:(i+1)*size] != ys[i*size:(i+1)*size])
+
+        expected = b''.join(hash_decode(e) if e else hash_at(i) for i, e in enumerate(expected_hashes))
+        if expected != hashes:
+            i = first_mismatch(expected, hashes, HASH_SIZE)
+            raise Exception("hash mismatches with expected: {} vs {}"
+                            .format(expected_hashes[i], hash_encode(hash_at(i))))
+        # each header commits to the hash of the previous one
+        if not raw_headers_connect(data, hashes, prev_hash):
+            prev_hashes = b''.join(h[4:36] for h in headers)
+            expected_prev_hashes = hash_decode(prev_hash) + hashes[:-HASH_SIZE]
+            i = first_mismatch(prev_hashes, expected_prev_hashes, HASH_SIZE)
+            raise Exception("prev hash mismatch: %s vs %s"
+                            % (hash_encode(expected_prev_hashes[i*HASH_SIZE:(i+1)*HASH_SIZE]),
+                               hash_encode(prev_hashes[i*HASH_SIZE:(i+1)*HASH_SIZE])))
+        if constants.net.TESTNET:
+            return
+        bits = cls.target_to_bits(target)
+        all_bits = b''.join(h[72:76] for h in headers)
+        if all_bits != bits.to_bytes(4, byteorder='little') * num:
+            i = first_mismatch(all_bits, bits.to_bytes(4, byteorder='little') * num, 4)
+            raise Exception("bits mismatch: %s vs %s"
+                            % (bits, int.from_bytes(all_bits[i*4:(i+1)*4], byteorder='little')))
+        # note: proof of work is not checked, see pow_hash_header
+
     def verify_chunk(self, index: int, data: bytes) -> None:
+        """data is one chunk, or several consecutive ones, starting at chunk index."""
         num = len(data) // HEADER_SIZE
-        self.save_chunk(index, data) # don't verify chunks
+        data = data[:num*HEADER_SIZE]
+        hashes = hashes_of_raw_headers(data)
+        self.save_chunk(index, data, hashes=hashes) # don't verify chunks
         start_height = index * 2016
         prev_hash = self.get_hash(start_height - 1)
-        target = self.get_target(index-1)
-        for i in range(num):
-            height = start_height + i
-            try:
-                expected_header_hash = self.get_hash(height)
-            except MissingHeader:
-                expected_header_hash = None
-            raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+        for i in range(0, num, 2016):
+            target = self.get_target(index + i // 2016 - 1)
+            chunk = data[i*HEADER_SIZE:(i+2016)*HEADER_SIZE]
+            chunk_hashes = hashes[i*HASH_SIZE:(i+2016)*HASH_SIZE]
+            if self.VERIFY_HEADERS:
+                expected_hashes = []
+                for height in range(start_height + i, start_height + i + len(chunk) // HEADER_SIZE):
+                    try:
+                        expected_hashes.append(self.get_hash(height))
+                    except MissingHeader:
+                        expected_hashes.append(None)
+                self.verify_raw_headers(chunk, chunk_hashes, prev_hash, target, expected_hashes)
+            prev_hash = hash_encode(chunk_hashes[-HASH_SIZE:])
 
     @with_lock
     def path(self):
@@ -348,13 +720,13 @@ class Blockchain(Logger):
         return os.path.join(d, filename)
 
     @with_lock
-    def save_chunk(self, index: int, chunk: bytes):
+    def save_chunk(self, index: int, chunk: bytes, *, hashes: bytes = None):
         assert index >= 0, index
         chunk_within_checkpoint_region = index < len(self.checkpoints)
         # chunks in checkpoint region are the responsibility of the 'main chain'
         if chunk_within_checkpoint_region and self.parent is not None:
             main_chain = get_best_chain()
-            main_chain.save_chunk(index, chunk)
+            main_chain.save_chunk(index, chunk, hashes=hashes)
             return
 
         delta_height = (index * 2016 - self.forkpoint)
@@ -363,9 +735,11 @@ class Blockchain(Logger):
         # (the part before is the responsibility of the parent)
         if delta_bytes < 0:
             chunk = chunk[-delta_bytes:]
+            if hashes is not None:
+                hashes = hashes[-delta_height*HASH_SIZE:]
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
-        self.write(chunk, delta_bytes, truncate)
+        self.write(chunk, delta_bytes, truncate, hashes=hashes)
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -405,6 +779,8 @@ class Blockchain(Logger):
         # parent's new name will be something new (not child's old name)
         self.assert_headers_file_available(self.path())
         child_old_name = self.path()
+        child_old_hashes_name = self.hashes_path()
+        child_old_chainwork_name = self.chainwork_path()
         with open(self.path(), 'rb') as f:
             my_data = f.read()
         self.assert_headers_file_available(parent.path())
@@ -415,13 +791,24 @@ class Blockchain(Logger):
             parent_data = f.read(parent_branch_size*HEADER_SIZE)
         self.write(parent_data, 0)
         parent.write(my_data, (forkpoint - parent.forkpoint)*HEADER_SIZE)
+        # markers of unflushed writes are tied to file names
+        self.flush()
+        parent.flush()
         # swap parameters
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self.close_mmaps()
+        parent.close_mmaps()
         os.replace(child_old_name, parent.path())
+        os.replace(child_old_hashes_name, parent.hashes_path())
+        # the chainwork cached by the parent now describes our headers
+        # (ours got dropped when our headers were overwritten)
+        self._chainwork, parent._chainwork = parent._chainwork, self._chainwork
+        if os.path.exists(child_old_chainwork_name):
+            os.replace(child_old_chainwork_name, parent.chainwork_path())
         self.update_size()
         parent.update_size()
         # update pointers
@@ -443,9 +830,20 @@ class Blockchain(Logger):
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
     @with_lock
-    def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
+    def write(self, data: bytes, offset: int, truncate: bool=True, *, hashes: bytes = None) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        if not self._hash_index_in_sync:
+            self._sync_hash_index()
+        # writes in the checkpoint region (truncate=False) are always fsynced:
+        # a crash must not make us drop the sparse part of the file after them
+        batched = truncate and self._is_fsync_batched()
+        if batched:
+            self._mark_dirty(offset // HEADER_SIZE)
+        # the file might get truncated below; reading a truncated
+        # region through an existing mapping would SIGBUS
+        self.close_mmaps()
+        self._header_cache.clear()
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -453,8 +851,20 @@ class Blockchain(Logger):
             f.seek(offset)
             f.write(data)
             f.flush()
-            os.fsync(f.fileno())
+            if not batched:
+                os.fsync(f.fileno())
+        self._write_hash_index(data, offset, truncate, hashes, fsync=not batched)
         self.update_size()
+        # writes in the checkpoint region do not change the chainwork
+        if truncate:
+            self._invalidate_chainwork(self.forkpoint + offset // HEADER_SIZE)
+        if not batched:
+            self.flush()
+            return
+        self._num_unflushed_writes += 1
+        if (self._num_unflushed_writes >= self.config.get('headers_fsync_count', HEADERS_FSYNC_COUNT)
+                or time.monotonic() - self._last_flush_time >= self.config.get('headers_fsync_interval', HEADERS_FSYNC_INTERVAL)):
+            self.flush()
 
     @with_lock
     def save_header(self, header: dict) -> None:
@@ -474,17 +884,23 @@ class Blockchain(Logger):
             return self.parent.read_header(height)
         if height > self.height():
             return
-        delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
+        header = self._header_cache.get(height)
+        if header is not None:
+            self._header_cache.move_to_end(height)
+            return dict(header)
+        offset = (height - self.forkpoint) * HEADER_SIZE
+        mm = self._get_headers_mmap()
+        # zero-copy: deserialize straight from the mapped file
+        with memoryview(mm)[offset:offset+HEADER_SIZE] as h:
             if len(h) < HEADER_SIZE:
                 raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
-            return None
-        return deserialize_header(h, height)
+            if h == NULL_HEADER:
+                return None
+            header = deserialize_header(h, height)
+        self._header_cache[height] = header
+        if len(self._header_cache) > HEADER_CACHE_SIZE:
+            self._header_cache.popitem(last=False)
+        return dict(header)
 
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
@@ -520,10 +936,10 @@ class Blockchain(Logger):
             h, t, _ = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
+            header_hash = self._read_hash(height)
+            if header_hash is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return hash_encode(header_hash)
 
     def get_timestamp(self, height):
         if height < len(self.checkpoints) * 2016 and (height+1) % 2016 == 0:
@@ -594,25 +1010,49 @@ class Blockchain(Logger):
             # On testnet/regtest, difficulty works somewhat different.
             # It's out of scope to properly implement that.
             return height
-        last_retarget = height // 2016 * 2016 - 1
-        cached_height = last_retarget
-        while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-            if cached_height <= -1:
-                break
-            cached_height -= 2016
-        assert cached_height >= -1, cached_height
-        running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-        while cached_height < last_retarget:
-            cached_height += 2016
-            work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-            work_in_chunk = 2016 * work_in_single_header
-            running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
-        cached_height += 2016
-        work_in_single_header = self.chainwork_of_header_at_height(cached_height)
+        running_total = self._get_chainwork_of_period(height // 2016 - 1)
+        work_in_single_header = self.chainwork_of_header_at_height(height)
         work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
         return running_total + work_in_last_partial_chunk
 
+    @with_lock
+    def _get_chainwork_of_period(self, index: int) -> int:
+        """Returns the chainwork up to and including the last header
+        of retarget period 'index', using the entries persisted in
+        our chainwork file, and extending them as needed.
+        """
+        if index < 0:
+            return 0
+        first_period = self.forkpoint // 2016
+        if index < first_period:
+            return self.parent._get_chainwork_of_period(index)
+        entries = self._load_chainwork()
+        # an entry is still good if its period still ends with the same header,
+        # as the hash of a header commits to all headers before it
+        num_entries = min(len(entries), index - first_period + 1)
+        while num_entries > 0:
+            header_hash, _ = entries[num_entries - 1]
+            try:
+                if header_hash == bfh(self.get_hash((first_period + num_entries) * 2016 - 1)):
+                    break
+            except MissingHeader:
+                pass
+            num_entries -= 1
+            self._truncate_chainwork(num_entries)
+        if num_entries > 0:
+            running_total = entries[num_entries - 1][1]
+        else:
+            running_total = self._get_chainwork_of_period(first_period - 1)
+        new_entries = []
+        for period in range(first_period + num_entries, index + 1):
+            last_height = period * 2016 + 2015
+            work_in_chunk = 2016 * self.chainwork_of_header_at_height(last_height)
+            running_total += work_in_chunk
+            new_entries.append((bfh(self.get_hash(last_height)), running_total))
+        if new_entries:
+            self._append_chainwork(new_entries)
+        return running_total
+
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
             return False
@@ -641,11 +1081,19 @@ class Blockchain(Logger):
         return True
 
     def connect_chunk(self, idx: int, hexdata: str) -> bool:
-        assert idx >= 0, idx
         try:
             data = bfh(hexdata)
+        except BaseException as e:
+            self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
+            return False
+        return self.connect_raw_chunk(idx, data)
+
+    def connect_raw_chunk(self, idx: int, data: bytes) -> bool:
+        """data is one chunk, or several consecutive ones, starting at chunk idx."""
+        assert idx >= 0, idx
+        try:
+            # note: this also saves the chunk
             self.verify_chunk(idx, data)
-            self.save_chunk(idx, data)
             return True
         except BaseException as e:
             self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
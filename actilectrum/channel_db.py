@@ -26,6 +26,9 @@
 import time
 import random
 import os
+import mmap
+import struct
+import gc
 from collections import defaultdict
 from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
 import binascii
@@ -35,14 +38,16 @@ import threading
 from enum import IntEnum
 
 
-from .sql_db import SqlDB, sql
+from .sql_db import SqlDB, sql, sql_rows
 from . import constants, util
 from .util import bh2u, profiler, get_headers_dir, bfh, is_ip_address, list_enabled_bits
 from .logging import Logger
 from .lnutil import (LNPeerAddr, format_short_channel_id, ShortChannelID,
                      validate_features, IncompatibleOrInsaneFeatures)
-from .lnverifier import LNChannelVerifier, verify_sig_for_channel_update
+from .lnverifier import LNChannelVerifier, GossipSignatureVerifier, verify_sig_for_channel_update
 from .lnmsg import decode_msg
+from .lngraph import ChannelGraph
+from .lnmissioncontrol import MissionControl, ChannelResult
 
 if TYPE_CHECKING:
     from .network import Network
@@ -242,19 +247,76 @@ msg BLOB,
 PRIMARY KEY(node_id)
 )"""
 
+# see MissionControl
+create_channel_result = """
+CREATE TABLE IF NOT EXISTS channel_result (
+key BLOB(41),
+failure_amount_msat INTEGER,
+failure_time INTEGER,
+success_amount_msat INTEGER,
+success_time INTEGER,
+PRIMARY KEY(key)
+)"""
+
+# rows of channel_info, policy and node_info changed since the last snapshot
+create_changelog = """
+CREATE TABLE IF NOT EXISTS changelog (
+seq INTEGER PRIMARY KEY AUTOINCREMENT,
+tbl STRING(16),
+key BLOB
+)"""
+
+# per chain, the block up to which all the channels of a peer were queried
+create_sync_state = """
+CREATE TABLE IF NOT EXISTS sync_state (
+chain_hash BLOB(32),
+synced_block INTEGER,
+PRIMARY KEY(chain_hash)
+)"""
+
+# the snapshot the changelog is relative to
+create_snapshot = """
+CREATE TABLE IF NOT EXISTS snapshot (
+snapshot_id BLOB(16),
+seq INTEGER
+)"""
+
+
+# Snapshot of the in-memory graph, so that startup does not need to decode
+# every gossip message in the db. After the header, it has fixed size records
+# for channels and policies, followed by variable size records for nodes.
+SNAPSHOT_MAGIC = b'LNGS'
+SNAPSHOT_VERSION = 1
+# magic, version, snapshot_id, seq, num_channels, num_policies, num_nodes
+SNAPSHOT_HEADER = struct.Struct('>4sI16sQIII')
+# short_channel_id, node1_id, node2_id, has_capacity, capacity_sat
+SNAPSHOT_CHANNEL = struct.Struct('>8s33s33s?Q')
+# key, cltv_expiry_delta, htlc_minimum_msat, has_htlc_maximum, htlc_maximum_msat,
+# fee_base_msat, fee_proportional_millionths, channel_flags, message_flags, timestamp
+SNAPSHOT_POLICY = struct.Struct('>41sHQ?QIIBBI')
+# node_id, timestamp, features length, alias length; followed by features and alias
+SNAPSHOT_NODE = struct.Struct('>33sIHB')
+
 
 class ChannelDB(SqlDB):
 
     NUM_MAX_RECENT_PEERS = 20
+    SNAPSHOT_INTERVAL = 30 * 60  # seconds
+    # a power loss may lose the last transactions, that are gossip we can get again
+    SYNCHRONOUS = 'NORMAL'
 
     def __init__(self, network: 'Network'):
         path = os.path.join(get_headers_dir(network.config), 'gossip_db')
-        super().__init__(network.asyncio_loop, path, commit_interval=100)
+        self.snapshot_path = path + '.snapshot'
+        self._num_changes_since_snapshot = 0
+        self._last_snapshot_time = time.time()
+        super().__init__(network.asyncio_loop, path)
         self.lock = threading.RLock()
         self.num_nodes = 0
         self.num_channels = 0
         self._channel_updates_for_private_channels = {}  # type: Dict[Tuple[bytes, bytes], dict]
         self.ca_verifier = LNChannelVerifier(network, self)
+        self.sig_verifier = GossipSignatureVerifier(network.config)
 
         # initialized in load_data
         # note: modify/iterate needs self.lock
@@ -268,6 +330,9 @@ class ChannelDB(SqlDB):
         self._chans_with_0_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_1_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_2_policies = set()  # type: Set[ShortChannelID]
+        self.graph = ChannelGraph()  # for path finding
+        self.mission_control = MissionControl(self)
+        self._synced_block = None  # type: Optional[int]
 
         self.data_loaded = asyncio.Event()
         self.network = network # only for callback
@@ -283,6 +348,21 @@ class ChannelDB(SqlDB):
         with self.lock:
             return set(self._channels.keys())
 
+    def get_synced_block(self) -> Optional[int]:
+        return self._synced_block
+
+    def set_synced_block(self, block: int) -> None:
+        self._synced_block = block
+        self._db_save_synced_block(constants.net.rev_genesis_bytes(), block)
+
+    def get_last_update_timestamp(self) -> Optional[int]:
+        """Timestamp of the newest channel_update, not in the future."""
+        with self.lock:
+            if not self._policies:
+                return None
+            timestamp = max(policy.timestamp for policy in self._policies.values())
+        return min(timestamp, int(time.time()))
+
     def add_recent_peer(self, peer: LNPeerAddr):
         now = int(time.time())
         node_id = peer.pubkey
@@ -360,6 +440,7 @@ class ChannelDB(SqlDB):
             self._channels[channel_info.short_channel_id] = channel_info
             self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
             self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+            self._add_channel_to_graph(channel_info)
         self._update_num_policies_for_chan(channel_info.short_channel_id)
         if 'raw' in msg:
             self._db_save_channel(channel_info.short_channel_id, msg['raw'])
@@ -424,6 +505,7 @@ class ChannelDB(SqlDB):
         policy = Policy.from_msg(payload)
         with self.lock:
             self._policies[key] = policy
+            self.graph.update_policy(policy)
         self._update_num_policies_for_chan(short_channel_id)
         if 'raw' in payload:
             self._db_save_policy(policy.key, payload['raw'])
@@ -465,36 +547,56 @@ class ChannelDB(SqlDB):
         c.execute(create_address)
         c.execute(create_policy)
         c.execute(create_channel_info)
+        c.execute(create_changelog)
+        c.execute(create_snapshot)
+        c.execute(create_channel_result)
+        c.execute(create_sync_state)
         self.conn.commit()
 
-    @sql
-    def _db_save_policy(self, key: bytes, msg: bytes):
-        # 'msg' is a 'channel_update' message
+    def _db_log_changes(self, tbl: str, keys: Sequence[bytes]) -> None:
         c = self.conn.cursor()
-        c.execute("""REPLACE INTO policy (key, msg) VALUES (?,?)""", [key, msg])
+        c.executemany("INSERT INTO changelog (tbl, key) VALUES (?,?)", [(tbl, key) for key in keys])
+        self._num_changes_since_snapshot += len(keys)
 
-    @sql
-    def _db_delete_policy(self, node_id: bytes, short_channel_id: ShortChannelID):
-        key = short_channel_id + node_id
+    @sql_rows
+    def _db_save_policy(self, rows: Sequence[Tuple[bytes, bytes]]):
+        # (key, msg), where 'msg' is a 'channel_update' message
         c = self.conn.cursor()
-        c.execute("""DELETE FROM policy WHERE key=?""", (key,))
+        c.executemany("""REPLACE INTO policy (key, msg) VALUES (?,?)""", rows)
+        self._db_log_changes('policy', [key for key, msg in rows])
 
-    @sql
-    def _db_save_channel(self, short_channel_id: ShortChannelID, msg: bytes):
-        # 'msg' is a 'channel_announcement' message
+    @sql_rows
+    def _db_delete_policy(self, rows: Sequence[Tuple[bytes, ShortChannelID]]):
+        # (node_id, short_channel_id)
+        keys = [short_channel_id + node_id for node_id, short_channel_id in rows]
         c = self.conn.cursor()
-        c.execute("REPLACE INTO channel_info (short_channel_id, msg) VALUES (?,?)", [short_channel_id, msg])
+        c.executemany("""DELETE FROM policy WHERE key=?""", [(key,) for key in keys])
+        self._db_log_changes('policy', keys)
 
-    @sql
-    def _db_delete_channel(self, short_channel_id: ShortChannelID):
+    @sql_rows
+    def _db_save_channel(self, rows: Sequence[Tuple[ShortChannelID, bytes]]):
+        # (short_channel_id, msg), where 'msg' is a 'channel_announcement' message
+        c = self.conn.cursor()
+        c.executemany("REPLACE INTO channel_info (short_channel_id, msg) VALUES (?,?)", rows)
+        self._db_log_changes('channel_info', [short_channel_id for short_channel_id, msg in rows])
+
+    @sql_rows
+    def _db_delete_channel(self, rows: Sequence[Tuple[ShortChannelID]]):
+        c = self.conn.cursor()
+        c.executemany("""DELETE FROM channel_info WHERE short_channel_id=?""", rows)
+        self._db_log_changes('channel_info', [short_channel_id for short_channel_id, in rows])
+
+    @sql_rows
+    def _db_save_node_info(self, rows: Sequence[Tuple[bytes, bytes]]):
+        # (node_id, msg), where 'msg' is a 'node_announcement' message
         c = self.conn.cursor()
-        c.execute("""DELETE FROM channel_info WHERE short_channel_id=?""", (short_channel_id,))
+        c.executemany("REPLACE INTO node_info (node_id, msg) VALUES (?,?)", rows)
+        self._db_log_changes('node_info', [node_id for node_id, msg in rows])
 
     @sql
-    def _db_save_node_info(self, node_id: bytes, msg: bytes):
-        # 'msg' is a 'node_announcement' message
+    def _db_save_synced_block(self, chain_hash: bytes, block: int):
         c = self.conn.cursor()
-        c.execute("REPLACE INTO node_info (node_id, msg) VALUES (?,?)", [node_id, msg])
+        c.execute("REPLACE INTO sync_state (chain_hash, synced_block) VALUES (?,?)", (chain_hash, block))
 
     @sql
     def _db_save_node_address(self, peer: LNPeerAddr, timestamp: int):
@@ -511,6 +613,18 @@ class ChannelDB(SqlDB):
             if r == []:
                 c.execute("INSERT INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)", (addr.pubkey, addr.host, addr.port, 0))
 
+    @sql_rows
+    def save_channel_result(self, rows: Sequence[Tuple[bytes, ChannelResult]]):
+        c = self.conn.cursor()
+        c.executemany("""REPLACE INTO channel_result (key, failure_amount_msat, failure_time,
+                         success_amount_msat, success_time) VALUES (?,?,?,?,?)""",
+                      [(key, *result) for key, result in rows])
+
+    @sql
+    def delete_channel_results(self, keys: Sequence[bytes]):
+        c = self.conn.cursor()
+        c.executemany("""DELETE FROM channel_result WHERE key=?""", [(key,) for key in keys])
+
     def verify_channel_update(self, payload):
         short_channel_id = payload['short_channel_id']
         short_channel_id = ShortChannelID(short_channel_id)
@@ -566,6 +680,7 @@ class ChannelDB(SqlDB):
                 node_id, scid = key
                 with self.lock:
                     self._policies.pop(key)
+                    self.graph.remove_policy(scid, node_id)
                 self._db_delete_policy(*key)
                 self._update_num_policies_for_chan(scid)
             self.update_counts()
@@ -594,19 +709,24 @@ class ChannelDB(SqlDB):
             if channel_info:
                 self._channels_for_node[channel_info.node1_id].remove(channel_info.short_channel_id)
                 self._channels_for_node[channel_info.node2_id].remove(channel_info.short_channel_id)
+                self.graph.remove_channel(short_channel_id)
         self._update_num_policies_for_chan(short_channel_id)
         # delete from database
         self._db_delete_channel(short_channel_id)
 
+    def _add_channel_to_graph(self, channel_info: ChannelInfo) -> None:
+        self.graph.add_channel(channel_info)
+        for node_id in (channel_info.node1_id, channel_info.node2_id):
+            policy = self._policies.get((node_id, channel_info.short_channel_id))
+            if policy:
+                self.graph.update_policy(policy)
+
     def get_node_addresses(self, node_id):
         return self._addresses.get(node_id)
 
     @sql
     @profiler
     def load_data(self):
-        # Note: this method takes several seconds... mostly due to lnmsg.decode_msg being slow.
-        #       I believe lnmsg (and lightning.json) will need a rewrite anyway, so instead of tweaking
-        #       load_data() here, that should be done. see #6006
         c = self.conn.cursor()
         c.execute("""SELECT * FROM address""")
         for x in c:
@@ -619,6 +739,50 @@ class ChannelDB(SqlDB):
             return newest_ts
         sorted_node_ids = sorted(self._addresses.keys(), key=newest_ts_for_node_id, reverse=True)
         self._recent_peers = sorted_node_ids[:self.NUM_MAX_RECENT_PEERS]
+        c.execute("""SELECT * FROM channel_result""")
+        self.mission_control.load(c.fetchall())
+        c.execute("""SELECT synced_block FROM sync_state WHERE chain_hash=?""", (constants.net.rev_genesis_bytes(),))
+        r = c.fetchone()
+        self._synced_block = r[0] if r else None
+        # the gc would otherwise repeatedly scan the objects we are creating
+        gc.disable()
+        try:
+            self._load_graph()
+            for channel_info in self._channels.values():
+                self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
+                self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+                self._update_num_policies_for_chan(channel_info.short_channel_id)
+                self._add_channel_to_graph(channel_info)
+        finally:
+            gc.enable()
+        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
+        self.update_counts()
+        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
+        self.logger.info(f'num_channels_partitioned_by_policy_count. '
+                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
+        self.data_loaded.set()
+
+    def _load_graph(self):
+        """Loads channels, policies and nodes, from the snapshot
+        and the changes since, or else from the tables."""
+        try:
+            loaded_snapshot = self._load_snapshot()
+        except Exception as e:
+            self.logger.info(f"could not load snapshot: {e!r}")
+            self._channels.clear()
+            self._policies.clear()
+            self._nodes.clear()
+            loaded_snapshot = False
+        if loaded_snapshot:
+            self._replay_changelog()
+        else:
+            self._load_tables()
+            # write a snapshot at the next opportunity
+            self._num_changes_since_snapshot = len(self._channels) + len(self._policies) + len(self._nodes)
+            self._last_snapshot_time = 0
+
+    def _load_tables(self):
+        c = self.conn.cursor()
         c.execute("""SELECT * FROM channel_info""")
         for short_channel_id, msg in c:
             try:
@@ -638,16 +802,140 @@ class ChannelDB(SqlDB):
         for key, msg in c:
             p = Policy.from_raw_msg(key, msg)
             self._policies[(p.start_node, p.short_channel_id)] = p
-        for channel_info in self._channels.values():
-            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
-            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
-            self._update_num_policies_for_chan(channel_info.short_channel_id)
-        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
-        self.update_counts()
-        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
-        self.logger.info(f'num_channels_partitioned_by_policy_count. '
-                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
-        self.data_loaded.set()
+
+    def _load_snapshot(self) -> bool:
+        """Loads channels, policies and nodes from the snapshot file,
+        if it matches the db. Returns whether it was loaded.
+        """
+        c = self.conn.cursor()
+        c.execute("""SELECT snapshot_id, seq FROM snapshot""")
+        r = c.fetchone()
+        if r is None or not os.path.exists(self.snapshot_path):
+            return False
+        snapshot_id, seq = r
+        with open(self.snapshot_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                magic, version, file_snapshot_id, file_seq, num_channels, num_policies, num_nodes \
+                    = SNAPSHOT_HEADER.unpack_from(m, 0)
+                if (magic, version, file_snapshot_id, file_seq) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, snapshot_id, seq):
+                    return False
+                pos = SNAPSHOT_HEADER.size
+                end = pos + num_channels * SNAPSHOT_CHANNEL.size
+                for scid, node1_id, node2_id, has_capacity, capacity_sat in SNAPSHOT_CHANNEL.iter_unpack(m[pos:end]):
+                    scid = ShortChannelID(scid)
+                    self._channels[scid] = ChannelInfo(scid, node1_id, node2_id,
+                                                       capacity_sat if has_capacity else None)
+                pos = end
+                end = pos + num_policies * SNAPSHOT_POLICY.size
+                for (key, cltv_expiry_delta, htlc_minimum_msat, has_htlc_maximum, htlc_maximum_msat, fee_base_msat,
+                     fee_proportional_millionths, channel_flags, message_flags, timestamp) \
+                        in SNAPSHOT_POLICY.iter_unpack(m[pos:end]):
+                    # note: positional, in the order of the Policy fields
+                    self._policies[(key[8:], ShortChannelID(key[0:8]))] = Policy(
+                        key, cltv_expiry_delta, htlc_minimum_msat,
+                        htlc_maximum_msat if has_htlc_maximum else None,
+                        fee_base_msat, fee_proportional_millionths, channel_flags, message_flags, timestamp)
+                pos = end
+                for i in range(num_nodes):
+                    node_id, timestamp, features_len, alias_len = SNAPSHOT_NODE.unpack_from(m, pos)
+                    pos += SNAPSHOT_NODE.size
+                    features = int.from_bytes(m[pos:pos+features_len], 'big')
+                    pos += features_len
+                    alias = m[pos:pos+alias_len].decode('utf8')
+                    pos += alias_len
+                    self._nodes[node_id] = NodeInfo(node_id=node_id, features=features, timestamp=timestamp, alias=alias)
+                if pos != len(m):
+                    raise Exception('unexpected snapshot size')
+        self.logger.info(f'loaded snapshot {snapshot_id.hex()}')
+        return True
+
+    def _replay_changelog(self):
+        """Applies the rows changed since the snapshot."""
+        c = self.conn.cursor()
+        c.execute("""SELECT DISTINCT tbl, key FROM changelog""")
+        changes = c.fetchall()
+        for tbl, key in changes:
+            if tbl == 'channel_info':
+                short_channel_id = ShortChannelID.normalize(key)
+                c.execute("""SELECT msg FROM channel_info WHERE short_channel_id=?""", (key,))
+                r = c.fetchone()
+                self._channels.pop(short_channel_id, None)
+                if r:
+                    try:
+                        self._channels[short_channel_id] = ChannelInfo.from_raw_msg(r[0])
+                    except IncompatibleOrInsaneFeatures:
+                        pass
+            elif tbl == 'policy':
+                c.execute("""SELECT msg FROM policy WHERE key=?""", (key,))
+                r = c.fetchone()
+                if r:
+                    p = Policy.from_raw_msg(key, r[0])
+                    self._policies[(p.start_node, p.short_channel_id)] = p
+                else:
+                    self._policies.pop((key[8:], ShortChannelID.normalize(key[0:8])), None)
+            elif tbl == 'node_info':
+                c.execute("""SELECT msg FROM node_info WHERE node_id=?""", (key,))
+                r = c.fetchone()
+                self._nodes.pop(key, None)
+                if r:
+                    try:
+                        node_info, node_addresses = NodeInfo.from_raw_msg(r[0])
+                    except IncompatibleOrInsaneFeatures:
+                        pass
+                    else:
+                        self._nodes[key] = node_info
+        self._num_changes_since_snapshot = len(changes)
+        self.logger.info(f'replayed {len(changes)} changes since snapshot')
+
+    @sql
+    @profiler
+    def save_snapshot(self):
+        """Writes the in-memory graph to the snapshot file, and
+        clears the changelog up to this point.
+        """
+        c = self.conn.cursor()
+        c.execute("""SELECT MAX(seq) FROM changelog""")
+        seq = c.fetchone()[0] or 0
+        snapshot_id = os.urandom(16)
+        with self.lock:
+            channels = list(self._channels.values())
+            policies = list(self._policies.values())
+            nodes = list(self._nodes.values())
+        chunks = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, snapshot_id, seq,
+                                       len(channels), len(policies), len(nodes))]
+        chunks += [SNAPSHOT_CHANNEL.pack(ci.short_channel_id, ci.node1_id, ci.node2_id,
+                                         ci.capacity_sat is not None, ci.capacity_sat or 0)
+                   for ci in channels]
+        chunks += [SNAPSHOT_POLICY.pack(p.key, p.cltv_expiry_delta, p.htlc_minimum_msat,
+                                        p.htlc_maximum_msat is not None, p.htlc_maximum_msat or 0,
+                                        p.fee_base_msat, p.fee_proportional_millionths,
+                                        p.channel_flags, p.message_flags, p.timestamp)
+                   for p in policies]
+        for node_info in nodes:
+            features = node_info.features.to_bytes((node_info.features.bit_length() + 7) // 8, 'big')
+            alias = node_info.alias.encode('utf8')
+            chunks.append(SNAPSHOT_NODE.pack(node_info.node_id, node_info.timestamp, len(features), len(alias)))
+            chunks.append(features)
+            chunks.append(alias)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        c.execute("""DELETE FROM snapshot""")
+        c.execute("""INSERT INTO snapshot (snapshot_id, seq) VALUES (?,?)""", (snapshot_id, seq))
+        c.execute("""DELETE FROM changelog WHERE seq <= ?""", (seq,))
+        self.conn.commit()
+        self._num_changes_since_snapshot = 0
+        self._last_snapshot_time = time.time()
+        self.logger.info(f'saved snapshot: {len(channels)} channels, {len(policies)} policies, {len(nodes)} nodes')
+
+    def is_snapshot_due(self) -> bool:
+        return (self._num_changes_since_snapshot > 0
+                and time.time() - self._last_snapshot_time > self.SNAPSHOT_INTERVAL)
 
     def _update_num_policies_for_chan(self, short_channel_id: ShortChannelID) -> None:
         channel_info = self.get_channel_info(short_channel_id)
@@ -288,7 +288,7 @@ def chacha20_poly1305_decrypt(*, key: bytes, nonce: bytes, associated_data: byte
     assert isinstance(key, (bytes, bytearray))
     assert isinstance(nonce, (bytes, bytearray))
     assert isinstance(associated_data, (bytes, bytearray))
-    assert isinstance(data, (bytes, bytearray))
+    assert isinstance(data, (bytes, bytearray, memoryview))
     if HAS_CRYPTODOME:
         cipher = CD_ChaCha20_Poly1305.new(key=key, nonce=nonce)
         cipher.update(associated_data)
@@ -296,6 +296,8 @@ def chacha20_poly1305_decrypt(*, key: bytes, nonce: bytes, associated_data: byte
         return cipher.decrypt_and_verify(ciphertext=data[:-16], received_mac_tag=data[-16:])
     if HAS_CRYPTOGRAPHY:
         a = CG_aead.ChaCha20Poly1305(key)
+        # older versions of cryptography only take bytes
+        data = bytes(data)
         try:
             return a.decrypt(nonce, data, associated_data)
         except cryptography.exceptions.InvalidTag as e:
@@ -26,7 +26,7 @@
 import base64
 import hashlib
 import functools
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Sequence, List
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer,
     CFUNCTYPE, POINTER, cast
@@ -36,7 +36,7 @@ from .util import bfh, bh2u, assert_bytes, to_bytes, InvalidPassword, profiler,
 from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
 from . import constants
 from .logging import get_logger
-from .ecc_fast import _libsecp256k1, SECP256K1_EC_UNCOMPRESSED
+from .ecc_fast import _libsecp256k1, SECP256K1_EC_UNCOMPRESSED, SECP256K1_EC_COMPRESSED
 
 _logger = get_logger(__name__)
 
@@ -365,6 +365,30 @@ def verify_signature(pubkey: bytes, sig: bytes, h: bytes) -> bool:
         return False
     return True
 
+def pubkey_tweak_add_many(pubkey: bytes, tweaks: Sequence[bytes]) -> List[Optional[bytes]]:
+    """For each tweak, returns pubkey + tweak*G as a compressed pubkey,
+    or None if the tweak is not within the curve order or the result is infinity.
+    pubkey is parsed once, for all the tweaks.
+    """
+    parsed_pubkey = ECPubkey(pubkey)._to_libsecp256k1_pubkey_ptr().raw
+    result = []
+    for tweak in tweaks:
+        if not is_secret_within_curve_range(tweak):
+            result.append(None)
+            continue
+        child_pubkey = create_string_buffer(parsed_pubkey, 64)
+        if not _libsecp256k1.secp256k1_ec_pubkey_tweak_add(_libsecp256k1.ctx, child_pubkey, tweak):
+            result.append(None)
+            continue
+        child_pubkey_serialized = create_string_buffer(33)
+        child_pubkey_size = c_size_t(33)
+        _libsecp256k1.secp256k1_ec_pubkey_serialize(
+            _libsecp256k1.ctx, child_pubkey_serialized, byref(child_pubkey_size), child_pubkey,
+            SECP256K1_EC_COMPRESSED)
+        result.append(child_pubkey_serialized.raw)
+    return result
+
+
 def verify_message_with_address(address: str, sig65: bytes, message: bytes, *, net=None):
     from .bitcoin import pubkey_to_address
     assert_bytes(sig65, message)
@@ -3,7 +3,6 @@
 # file LICENCE or http://www.opensource.org/licenses/mit-license.php
 
 import os
-import json
 import sys
 import threading
 import traceback
@@ -381,7 +380,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
-            self.data = json.loads(storage.read())
+            self.data = db.load_json(storage.read())
             self.run(action)
             for k, v in self.data.items():
                 db.put(k, v)
@@ -532,15 +532,22 @@ class Interface(Logger):
         if tip is not None:
             size = min(size, tip - index * 2016 + 1)
             size = max(size, 0)
+        res = await self.get_chunk(index, size)
+        conn = self.blockchain.connect_chunk(index, res['hex'])
+        if not conn:
+            return conn, 0
+        return conn, res['count']
+
+    async def get_chunk(self, index: int, size: int = 2016) -> dict:
+        """Requests up to `size` headers starting at chunk `index`.
+        The headers are not connected to any blockchain.
+        """
         try:
             self._requested_chunks.add(index)
             res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
         finally:
             self._requested_chunks.discard(index)
-        conn = self.blockchain.connect_chunk(index, res['hex'])
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+        return res
 
     def is_main_server(self) -> bool:
         return self.network.default_server == self.server
@@ -645,7 +652,11 @@ class Interface(Logger):
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                if next_height // 2016 > height // 2016:
+                    # several chunks to go
+                    could_connect, num_headers = await self.network.sync_chunks(self, height, next_height)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
                         raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
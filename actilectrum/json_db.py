@@ -25,6 +25,7 @@
 import threading
 import copy
 import json
+from typing import FrozenSet, List, Set, Tuple
 
 from . import util
 from .logging import Logger
@@ -38,6 +39,18 @@ def modifier(func):
             return func(self, *args, **kwargs)
     return wrapper
 
+def entry_modifier(func):
+    """For methods that only change entries of APPENDABLE_KEYS.
+    Once data was converted to StoredDicts, those keep track of
+    the entries they change themselves.
+    """
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            if not isinstance(self.data, StoredDict):
+                self._modified = True
+            return func(self, *args, **kwargs)
+    return wrapper
+
 def locked(func):
     def wrapper(self, *args, **kwargs):
         with self.lock:
@@ -111,21 +124,22 @@ class StoredDict(dict):
         # set item
         dict.__setitem__(self, key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.set_path_modified(self.path + [key])
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.set_path_modified(self.path + [key])
 
-    @locked
+    # note: reads do not take the lock. A single dict operation is atomic,
+    #       and writers only put values in place once they are converted,
+    #       so readers see either the old or the new value of a key.
     def __getitem__(self, key):
         key = self.convert_key(key)
         return dict.__getitem__(self, key)
 
-    @locked
     def __contains__(self, key):
         key = self.convert_key(key)
         return dict.__contains__(self, key)
@@ -138,10 +152,15 @@ class StoredDict(dict):
         else:
             r = dict.pop(self, key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.set_path_modified(self.path + [key])
         return r
 
     @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db.set_path_modified(self.path)
+
     def get(self, key, default=None):
         key = self.convert_key(key)
         return dict.get(self, key, default)
@@ -151,20 +170,37 @@ class StoredDict(dict):
 
 class JsonDB(Logger):
 
+    # Top-level keys holding dicts whose entries get saved one by one,
+    # by appending them to the file, instead of rewriting all of it.
+    APPENDABLE_KEYS = frozenset()  # type: FrozenSet[str]
+
     def __init__(self, data):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.data = data
-        self._modified = False
+        self._modified = False  # whether the whole file needs to be rewritten
+        self._modified_entries = set()  # type: Set[Tuple[str, str]]
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if not b:
+                self._modified_entries.clear()
+
+    def set_path_modified(self, path: List[str]) -> None:
+        """Called when the value at path in data has changed."""
+        with self.lock:
+            if len(path) >= 2 and path[0] in self.APPENDABLE_KEYS:
+                self._modified_entries.add((path[0], path[1]))
+            else:
+                self._modified = True
 
     def modified(self):
+        return self._modified or bool(self._modified_entries)
+
+    def needs_full_write(self) -> bool:
         return self._modified
 
-    @locked
     def get(self, key, default=None):
         v = self.data.get(key)
         if v is None:
@@ -191,3 +227,54 @@ class JsonDB(Logger):
     @locked
     def dump(self):
         return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
+
+    @locked
+    def dump_modified_entries(self) -> str:
+        """Returns the entries of APPENDABLE_KEYS that changed since
+        the last write, to be appended to what was written then.
+        """
+        changes = []
+        for key, subkey in sorted(self._modified_entries):
+            d = self.data.get(key)
+            if d is not None and subkey in d:
+                changes.append(['put', key, subkey, d[subkey]])
+            else:
+                changes.append(['del', key, subkey])
+        return ''.join(',\n' + json.dumps(change, cls=JsonDBJsonEncoder) for change in changes)
+
+    def load_json(self, s: str):
+        """Parses what was written by dump(), and applies
+        what dump_modified_entries() appended to it since.
+        """
+        try:
+            data, *changes = json.loads('[' + s + ']')
+        except json.JSONDecodeError:
+            # we might have crashed while appending. note that
+            # appended changes are on a single line each.
+            s = s.rstrip()
+            if s.endswith(','):
+                # right after the separator of a change
+                s = s[:-1]
+            try:
+                data, *changes = json.loads('[' + s + ']')
+            except json.JSONDecodeError:
+                i = s.rfind(',\n')
+                if i == -1:
+                    raise
+                data, *changes = json.loads('[' + s[:i] + ']')
+            self.logger.info("ignoring incomplete change at the end of file")
+            self._modified = True
+        if not isinstance(data, dict):
+            return data
+        for change in changes:
+            op, key, subkey = change[:3]
+            if op == 'put':
+                data.setdefault(key, {})[subkey] = change[3]
+            elif op == 'del':
+                data.get(key, {}).pop(subkey, None)
+            else:
+                raise Exception(f"unexpected change in file: {op}")
+        if changes:
+            # rewrite the file, so that it does not keep growing
+            self._modified = True
+        return data
@@ -180,7 +180,7 @@ class Software_KeyStore(KeyStore):
         decrypted = ec.decrypt_message(message)
         return decrypted
 
-    def sign_transaction(self, tx, password):
+    def sign_transaction(self, tx, password, *, num_threads: int = 1):
         if self.is_watching_only():
             return
         # Raise if password is not correct.
@@ -191,7 +191,7 @@ class Software_KeyStore(KeyStore):
             keypairs[k] = self.get_private_key(v, password)
         # Sign
         if keypairs:
-            tx.sign(keypairs)
+            tx.sign(keypairs, num_threads=num_threads)
 
     @abstractmethod
     def update_password(self, old_password, new_password):
@@ -356,6 +356,10 @@ class MasterPublicKeyMixin(ABC):
     def derive_pubkey(self, for_change: int, n: int) -> bytes:
         pass
 
+    def derive_pubkeys_range(self, for_change: int, start: int, count: int) -> List[bytes]:
+        """Returns the pubkeys of the addresses start, ..., start+count-1 of a chain."""
+        return [self.derive_pubkey(for_change, n) for n in range(start, start + count)]
+
     def get_pubkey_derivation(self, pubkey: bytes,
                               txinout: Union['PartialTxInput', 'PartialTxOutput'],
                               *, only_der_suffix=True) \
@@ -399,9 +403,11 @@ class Xpub(MasterPublicKeyMixin):
 
     def __init__(self, *, derivation_prefix: str = None, root_fingerprint: str = None):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
         self._xpub_bip32_node = None  # type: Optional[BIP32Node]
+        # for_change -> node of the receiving or change chain
+        self._chain_bip32_nodes = {}  # type: Dict[int, BIP32Node]
+        # (for_change, n) -> pubkey
+        self._derived_pubkeys = {}  # type: Dict[Tuple[int, int], bytes]
 
         # "key origin" info (subclass should persist these):
         self._derivation_prefix = derivation_prefix  # type: Optional[str]
@@ -479,19 +485,29 @@ class Xpub(MasterPublicKeyMixin):
             self._derivation_prefix = derivation_prefix
         self.is_requesting_to_be_rewritten_to_wallet_file = True
 
-    @lru_cache(maxsize=None)
+    def get_bip32_node_for_chain(self, for_change: int) -> BIP32Node:
+        node = self._chain_bip32_nodes.get(for_change)
+        if node is None:
+            node = self.get_bip32_node_for_xpub().subkey_at_public_derivation((for_change,))
+            self._chain_bip32_nodes[for_change] = node
+        return node
+
     def derive_pubkey(self, for_change: int, n: int) -> bytes:
         for_change = int(for_change)
         assert for_change in (0, 1)
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            rootnode = self.get_bip32_node_for_xpub()
-            xpub = rootnode.subkey_at_public_derivation((for_change,)).to_xpub()
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        pubkey = self._derived_pubkeys.get((for_change, n))
+        if pubkey is None:
+            pubkey = self.derive_pubkeys_range(for_change, n, 1)[0]
+        return pubkey
+
+    def derive_pubkeys_range(self, for_change: int, start: int, count: int) -> List[bytes]:
+        for_change = int(for_change)
+        assert for_change in (0, 1)
+        node = self.get_bip32_node_for_chain(for_change)
+        pubkeys = node.child_pubkeys_at_public_derivation(start, count)
+        for i, pubkey in enumerate(pubkeys):
+            self._derived_pubkeys[(for_change, start + i)] = pubkey
+        return pubkeys
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub: str, sequence) -> bytes:
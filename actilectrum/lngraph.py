@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2020 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from typing import List, Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .channel_db import ChannelInfo, Policy
+    from .lnutil import ShortChannelID
+
+
+# edges with a larger cltv_expiry_delta are never used (see RouteEdge.is_sane_to_use)
+MAX_CLTV_EXPIRY_DELTA = 14 * 144
+
+
+class ChannelGraph:
+    """The public channel graph, in a form that is fast to search.
+
+    Nodes and channels are interned to ints. Channel properties are kept in
+    lists indexed by channel, and policies in lists indexed by direction,
+    where direction 2*channel is from node1 and 2*channel+1 is from node2.
+
+    It is kept up to date by ChannelDB, under its lock.
+    """
+
+    def __init__(self):
+        self.node_ids = []  # type: List[bytes]
+        self.node_index = {}  # type: Dict[bytes, int]
+        # node -> channels of node
+        self.adjacency = []  # type: List[List[int]]
+
+        self.short_channel_ids = []  # type: List[Optional[ShortChannelID]]  # None for free slots
+        self.channel_index = {}  # type: Dict[ShortChannelID, int]
+        self.node1 = []  # type: List[int]
+        self.node2 = []  # type: List[int]
+        self.capacity_sat = []  # type: List[Optional[int]]
+        self._free_channels = []  # type: List[int]
+
+        # per direction
+        self.has_policy = []  # type: List[bool]
+        self.fee_base_msat = []  # type: List[int]
+        self.fee_proportional_millionths = []  # type: List[int]
+        self.cltv_expiry_delta = []  # type: List[int]
+        self.htlc_minimum_msat = []  # type: List[int]
+        self.htlc_maximum_msat = []  # type: List[Optional[int]]
+        self.is_disabled = []  # type: List[bool]
+        # whether the direction can be used, regardless of the amount:
+        # both policies published, not disabled, and sane cltv_expiry_delta
+        self.is_usable = []  # type: List[bool]
+
+    def get_node_index(self, node_id: bytes) -> int:
+        i = self.node_index.get(node_id)
+        if i is None:
+            i = self.node_index[node_id] = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self.adjacency.append([])
+        return i
+
+    def add_channel(self, channel_info: 'ChannelInfo') -> None:
+        scid = channel_info.short_channel_id
+        if scid in self.channel_index:
+            self.remove_channel(scid)
+        n1 = self.get_node_index(channel_info.node1_id)
+        n2 = self.get_node_index(channel_info.node2_id)
+        if self._free_channels:
+            c = self._free_channels.pop()
+            self.short_channel_ids[c] = scid
+            self.node1[c] = n1
+            self.node2[c] = n2
+            self.capacity_sat[c] = channel_info.capacity_sat
+        else:
+            c = len(self.short_channel_ids)
+            self.short_channel_ids.append(scid)
+            self.node1.append(n1)
+            self.node2.append(n2)
+            self.capacity_sat.append(channel_info.capacity_sat)
+            for l in (self.fee_base_msat, self.fee_proportional_millionths, self.cltv_expiry_delta,
+                      self.htlc_minimum_msat):
+                l += [0, 0]
+            self.htlc_maximum_msat += [None, None]
+            self.has_policy += [False, False]
+            self.is_disabled += [False, False]
+            self.is_usable += [False, False]
+        self.channel_index[scid] = c
+        self.adjacency[n1].append(c)
+        self.adjacency[n2].append(c)
+
+    def remove_channel(self, short_channel_id: 'ShortChannelID') -> None:
+        c = self.channel_index.pop(short_channel_id, None)
+        if c is None:
+            return
+        self.adjacency[self.node1[c]].remove(c)
+        self.adjacency[self.node2[c]].remove(c)
+        self.short_channel_ids[c] = None
+        for d in (2 * c, 2 * c + 1):
+            self.has_policy[d] = False
+            self.is_usable[d] = False
+        self._free_channels.append(c)
+
+    def get_direction(self, short_channel_id: 'ShortChannelID', start_node: bytes) -> Optional[int]:
+        c = self.channel_index.get(short_channel_id)
+        if c is None:
+            return None
+        n = self.node_index.get(start_node)
+        if n == self.node1[c]:
+            return 2 * c
+        if n == self.node2[c]:
+            return 2 * c + 1
+        return None
+
+    def update_policy(self, policy: 'Policy') -> None:
+        d = self.get_direction(policy.short_channel_id, policy.start_node)
+        if d is None:
+            return
+        self.has_policy[d] = True
+        self.fee_base_msat[d] = policy.fee_base_msat
+        self.fee_proportional_millionths[d] = policy.fee_proportional_millionths
+        self.cltv_expiry_delta[d] = policy.cltv_expiry_delta
+        self.htlc_minimum_msat[d] = policy.htlc_minimum_msat
+        self.htlc_maximum_msat[d] = policy.htlc_maximum_msat
+        self.is_disabled[d] = bool(policy.is_disabled())
+        self._update_is_usable(d)
+        self._update_is_usable(d ^ 1)
+
+    def remove_policy(self, short_channel_id: 'ShortChannelID', start_node: bytes) -> None:
+        d = self.get_direction(short_channel_id, start_node)
+        if d is None:
+            return
+        self.has_policy[d] = False
+        self._update_is_usable(d)
+        self._update_is_usable(d ^ 1)
+
+    def _update_is_usable(self, d: int) -> None:
+        self.is_usable[d] = (self.has_policy[d]
+                             and self.has_policy[d ^ 1]
+                             and not self.is_disabled[d]
+                             and self.cltv_expiry_delta[d] <= MAX_CLTV_EXPIRY_DELTA)
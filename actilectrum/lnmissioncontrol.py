@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2020 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+from typing import List, Optional, Dict, NamedTuple, TYPE_CHECKING, Iterable, Tuple
+
+from .logging import Logger
+from .lnutil import ShortChannelID
+
+if TYPE_CHECKING:
+    from .channel_db import ChannelDB
+    from .lnrouter import LNPaymentRoute
+
+
+class ChannelResult(NamedTuple):
+    """The outcome of the last payments through a channel, in one direction."""
+    failure_amount_msat: Optional[int]
+    failure_time: Optional[int]
+    success_amount_msat: Optional[int]
+    success_time: Optional[int]
+
+    def get_time(self) -> int:
+        return max(self.failure_time or 0, self.success_time or 0)
+
+
+class MissionControl(Logger):
+    """Remembers which channels forwarded our payments, and which failed to,
+    so that path finding can prefer the channels that are likely to succeed.
+
+    Results are kept per channel direction, keyed as policies are
+    (short_channel_id + start node_id). A failure excludes the channel
+    from path finding for BLACKLIST_DURATION, and then makes it more
+    expensive, by a cost that halves every HALF_LIFE. A later success
+    at a larger amount cancels it. The results are saved in the
+    gossip db, and at most MAX_RESULTS are kept.
+    """
+
+    BLACKLIST_DURATION = 10 * 60  # seconds
+    HALF_LIFE = 60 * 60  # seconds
+    MAX_RESULTS = 5000
+    # probability of success of a channel without results (as in lnd)
+    APRIORI_PROBABILITY = 0.6
+    SUCCESS_PROBABILITY = 0.95
+    MIN_PROBABILITY = 0.001
+    # what a failed attempt costs us, in the units of LNPathFinder._edge_cost
+    ATTEMPT_COST = 500
+
+    def __init__(self, channel_db: 'ChannelDB'):
+        Logger.__init__(self)
+        self.channel_db = channel_db
+        self.lock = threading.Lock()
+        self._results = {}  # type: Dict[bytes, ChannelResult]
+        # channels that failed in the last BLACKLIST_DURATION, in either direction -> time of failure
+        self.blacklist = {}  # type: Dict[ShortChannelID, int]
+
+    def load(self, rows: Iterable[Tuple[bytes, Optional[int], Optional[int], Optional[int], Optional[int]]]) -> None:
+        now = int(time.time())
+        with self.lock:
+            for key, *fields in rows:
+                result = ChannelResult(*fields)
+                self._results[bytes(key)] = result
+                if result.failure_time is not None and result.failure_time > now - self.BLACKLIST_DURATION:
+                    self.blacklist[ShortChannelID(key[:8])] = result.failure_time
+        self.logger.info(f'loaded {len(self._results)} channel results')
+
+    def clear(self) -> None:
+        with self.lock:
+            keys = list(self._results)
+            self._results.clear()
+            self.blacklist.clear()
+        self.channel_db.delete_channel_results(keys)
+
+    def get_result(self, key: bytes) -> Optional[ChannelResult]:
+        return self._results.get(key)
+
+    def get_results(self) -> Dict[bytes, ChannelResult]:
+        with self.lock:
+            return dict(self._results)
+
+    def update_blacklist(self) -> None:
+        """Removes the channels whose failure is older than BLACKLIST_DURATION."""
+        if not self.blacklist:
+            return
+        now = int(time.time())
+        with self.lock:
+            self.blacklist = {short_channel_id: failure_time
+                              for short_channel_id, failure_time in self.blacklist.items()
+                              if failure_time > now - self.BLACKLIST_DURATION}
+
+    def get_penalty(self, result: ChannelResult, amount_msat: int, now: float) -> float:
+        """Extra cost of sending amount_msat through a channel with that result,
+        compared to one without results: ATTEMPT_COST for each expected failed attempt.
+        It is not negative, as path finding needs positive costs, so successes only
+        cancel earlier failures.
+        """
+        probability = self.APRIORI_PROBABILITY
+        if result.success_amount_msat is not None and amount_msat <= result.success_amount_msat:
+            weight = 0.5 ** ((now - result.success_time) / self.HALF_LIFE)
+            probability += (self.SUCCESS_PROBABILITY - probability) * weight
+        if result.failure_amount_msat is not None and amount_msat >= result.failure_amount_msat:
+            weight = 0.5 ** ((now - result.failure_time) / self.HALF_LIFE)
+            probability *= 1 - weight
+        probability = max(probability, self.MIN_PROBABILITY)
+        return max(0., self.ATTEMPT_COST * (1 / probability - 1 / self.APRIORI_PROBABILITY))
+
+    def report_success(self, route: 'LNPaymentRoute', amount_msat: int, *, num_edges: int = None) -> None:
+        """The payment of amount_msat was forwarded through the first
+        num_edges edges of the route, or all of them.
+        """
+        if num_edges is None:
+            num_edges = len(route)
+        now = int(time.time())
+        amounts_msat = self._get_amounts_for_route(route, amount_msat)
+        with self.lock:
+            # the first edge is our own channel
+            for i in range(1, num_edges):
+                key = route[i].short_channel_id + route[i - 1].node_id
+                result = self._results.get(key, ChannelResult(None, None, None, None))
+                result = result._replace(success_amount_msat=amounts_msat[i], success_time=now)
+                if result.failure_amount_msat is not None and result.failure_amount_msat <= amounts_msat[i]:
+                    result = result._replace(failure_amount_msat=None, failure_time=None)
+                self._set_result(key, result)
+
+    def report_failure(self, route: 'LNPaymentRoute', amount_msat: int, edge_idx: int) -> None:
+        """The payment of amount_msat failed at route[edge_idx],
+        after being forwarded through the edges before it.
+        """
+        self.report_success(route, amount_msat, num_edges=edge_idx)
+        short_channel_id = route[edge_idx].short_channel_id
+        self.logger.info(f'blacklisting channel {short_channel_id}')
+        now = int(time.time())
+        amount_for_edge_msat = self._get_amounts_for_route(route, amount_msat)[edge_idx]
+        key = short_channel_id + route[edge_idx - 1].node_id
+        with self.lock:
+            result = self._results.get(key, ChannelResult(None, None, None, None))
+            result = result._replace(failure_amount_msat=amount_for_edge_msat, failure_time=now)
+            if result.success_amount_msat is not None and result.success_amount_msat >= amount_for_edge_msat:
+                result = result._replace(success_amount_msat=None, success_time=None)
+            self._set_result(key, result)
+            self.blacklist[short_channel_id] = now
+
+    def _set_result(self, key: bytes, result: ChannelResult) -> None:
+        # note: needs self.lock
+        self._results[key] = result
+        self.channel_db.save_channel_result(key, result)
+        if len(self._results) > self.MAX_RESULTS:
+            # remove the oldest tenth of the results
+            keys = sorted(self._results, key=lambda key: self._results[key].get_time())
+            removed_keys = keys[:len(keys) // 10]
+            for key in removed_keys:
+                del self._results[key]
+            self.channel_db.delete_channel_results(removed_keys)
+
+    @staticmethod
+    def _get_amounts_for_route(route: 'LNPaymentRoute', amount_msat: int) -> List[int]:
+        """Amount sent through each edge of the route, as in is_route_sane_to_use."""
+        amounts_msat = [amount_msat]
+        for route_edge in reversed(route[1:]):
+            amounts_msat.append(amounts_msat[-1] + route_edge.fee_for_edge(amounts_msat[-1]))
+        return amounts_msat[::-1]
@@ -1,6 +1,7 @@
 import os
 import csv
 import io
+import struct
 from typing import Callable, Tuple, Any, Dict, List, Sequence, Union, Optional
 from collections import OrderedDict
 
@@ -280,6 +281,143 @@ def _parse_msgtype_intvalue_for_onion_wire(value: str) -> int:
     return msg_type_int
 
 
+# field types that have a fixed size for each item of the count
+_FIXED_SIZE_FIELD_TYPES = {
+    'byte': 1,
+    'chain_hash': 32,
+    'channel_id': 32,
+    'sha256': 32,
+    'signature': 64,
+    'point': 33,
+    'short_channel_id': 8,
+}
+_STRUCT_FORMAT_FROM_UINT_FIELD_TYPE = {
+    'u8': 'B',
+    'u16': 'H',
+    'u32': 'I',
+    'u64': 'Q',
+}
+
+_STEP_STRUCT = 0  # consecutive fields of fixed size, unpacked at once,
+                  # or a single optional field of fixed size
+_STEP_BYTES = 1   # field of fixed size type, but variable count
+_STEP_FIELD = 2   # anything else, read with _read_field
+_STEP_TLVS = 3    # tlv stream
+
+
+class _MsgDecoder:
+    """Decoder for one message type, compiled from its scheme.
+
+    Runs of mandatory fields whose size does not depend on other fields
+    are unpacked with a single precomputed struct.
+    """
+
+    def __init__(self, scheme: Sequence[Sequence]):
+        assert scheme[0][0] == "msgtype", scheme[0]
+        self.msg_type_name = scheme[0][1]
+        self.msg_type_int = scheme[0][2]
+        self.steps = []  # type: List[tuple]
+        struct_format = ''
+        struct_field_names = []
+
+        def flush_struct(*, is_optional=False):
+            nonlocal struct_format, struct_field_names
+            if struct_field_names:
+                self.steps.append((_STEP_STRUCT, struct.Struct('>' + struct_format), tuple(struct_field_names),
+                                   is_optional))
+            struct_format = ''
+            struct_field_names = []
+
+        for row in scheme[1:]:
+            if row[0] != "msgdata":
+                raise Exception(f"unexpected row in scheme: {row!r}")
+            # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
+            field_name = row[2]
+            field_type = row[3]
+            field_count_str = row[4]
+            is_optional = len(row) > 5
+            if field_name == "tlvs":
+                flush_struct()
+                self.steps.append((_STEP_TLVS, field_type))
+                continue
+            try:
+                field_count = _resolve_field_count(field_count_str, vars_dict={})
+            except KeyError:
+                field_count = None  # depends on a previous field
+            if field_count is not None:
+                if field_type in _FIXED_SIZE_FIELD_TYPES:
+                    field_format = f'{field_count * _FIXED_SIZE_FIELD_TYPES[field_type]}s'
+                elif field_type in _STRUCT_FORMAT_FROM_UINT_FIELD_TYPE and field_count == 1:
+                    field_format = _STRUCT_FORMAT_FROM_UINT_FIELD_TYPE[field_type]
+                else:
+                    field_format = None
+                if field_format is not None:
+                    if is_optional:
+                        flush_struct()
+                    struct_format += field_format
+                    struct_field_names.append(field_name)
+                    if is_optional:
+                        flush_struct(is_optional=True)
+                    continue
+            flush_struct()
+            if field_type in _FIXED_SIZE_FIELD_TYPES and field_count_str != "...":
+                self.steps.append((_STEP_BYTES, field_name, _FIXED_SIZE_FIELD_TYPES[field_type],
+                                   field_count_str, is_optional))
+            else:
+                self.steps.append((_STEP_FIELD, field_name, field_type, field_count_str, is_optional))
+        flush_struct()
+
+    def decode(self, serializer: 'LNSerializer', data: bytes) -> dict:
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        parsed = {}
+        pos = 2
+        end = len(data)
+        fd = None
+        for step in self.steps:
+            kind = step[0]
+            if kind == _STEP_STRUCT:
+                _, s, field_names, is_optional = step
+                if end - pos < s.size:
+                    if is_optional:
+                        break  # optional feature field not present
+                    raise UnexpectedEndOfStream()
+                parsed.update(zip(field_names, s.unpack_from(data, pos)))
+                pos += s.size
+            elif kind == _STEP_BYTES:
+                _, field_name, type_len, field_count_str, is_optional = step
+                field_count = _resolve_field_count(field_count_str, vars_dict=parsed)
+                assert field_count >= 0, f"{field_count!r} must be non-neg int"
+                total_len = field_count * type_len
+                if end - pos < total_len:
+                    if is_optional:
+                        break  # optional feature field not present
+                    raise UnexpectedEndOfStream()
+                parsed[field_name] = data[pos:pos+total_len]
+                pos += total_len
+            else:
+                if fd is None:
+                    fd = io.BytesIO(data)
+                fd.seek(pos)
+                if kind == _STEP_TLVS:
+                    tlv_stream_name = step[1]
+                    parsed[tlv_stream_name] = serializer.read_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name)
+                else:
+                    _, field_name, field_type, field_count_str, is_optional = step
+                    field_count = _resolve_field_count(field_count_str, vars_dict=parsed)
+                    try:
+                        parsed[field_name] = _read_field(fd=fd,
+                                                         field_type=field_type,
+                                                         count=field_count)
+                    except UnexpectedEndOfStream as e:
+                        if is_optional:
+                            break  # optional feature field not present
+                        else:
+                            raise
+                pos = fd.tell()
+        return parsed
+
+
 class LNSerializer:
 
     def __init__(self, *, for_onion_wire: bool = False):
@@ -342,6 +480,8 @@ class LNSerializer:
                     self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name][tlv_record_type].append(tuple(row))
                 else:
                     pass  # TODO
+        self.msg_decoder_from_type = {msg_type_bytes: _MsgDecoder(scheme)
+                                      for msg_type_bytes, scheme in self.msg_scheme_from_type.items()}
 
     def write_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str, **kwargs) -> None:
         scheme_map = self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name]
@@ -467,42 +607,9 @@ class LNSerializer:
 
         Returns message type string and parsed message contents dict
         """
-        #print(f"decode_msg >>> {data.hex()}")
         assert len(data) >= 2
-        msg_type_bytes = data[:2]
-        msg_type_int = int.from_bytes(msg_type_bytes, byteorder="big", signed=False)
-        scheme = self.msg_scheme_from_type[msg_type_bytes]
-        assert scheme[0][2] == msg_type_int
-        msg_type_name = scheme[0][1]
-        parsed = {}
-        with io.BytesIO(data[2:]) as fd:
-            for row in scheme:
-                #print(f"row: {row!r}")
-                if row[0] == "msgtype":
-                    pass
-                elif row[0] == "msgdata":
-                    field_name = row[2]
-                    field_type = row[3]
-                    field_count_str = row[4]
-                    field_count = _resolve_field_count(field_count_str, vars_dict=parsed)
-                    if field_name == "tlvs":
-                        tlv_stream_name = field_type
-                        d = self.read_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name)
-                        parsed[tlv_stream_name] = d
-                        continue
-                    #print(f">> count={field_count}. parsed={parsed}")
-                    try:
-                        parsed[field_name] = _read_field(fd=fd,
-                                                         field_type=field_type,
-                                                         count=field_count)
-                    except UnexpectedEndOfStream as e:
-                        if len(row) > 5:
-                            break  # optional feature field not present
-                        else:
-                            raise
-                else:
-                    raise Exception(f"unexpected row in scheme: {row!r}")
-        return msg_type_name, parsed
+        decoder = self.msg_decoder_from_type[data[:2]]
+        return decoder.msg_type_name, decoder.decode(self, data)
 
 
 _inst = LNSerializer()
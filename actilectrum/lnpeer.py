@@ -63,6 +63,8 @@ LN_P2P_NETWORK_TIMEOUT = 20
 
 class Peer(Logger):
     LOGGING_SHORTCUT = 'P'
+    # stop reading messages while that much gossip waits to be processed
+    MAX_GOSSIP_QUEUE_SIZE = 5000
 
     def __init__(self, lnworker: Union['LNGossip', 'LNWallet'], pubkey:bytes, transport: LNTransportBase):
         self._sent_init = False  # type: bool
@@ -300,51 +302,17 @@ class Peer(Logger):
                 if self.gossip_queue.empty():
                     break
             self.logger.debug(f'process_gossip {len(chan_anns)} {len(node_anns)} {len(chan_upds)}')
-            # note: data processed in chunks to avoid taking sql lock for too long
-            # channel announcements
-            for chan_anns_chunk in chunks(chan_anns, 300):
-                self.verify_channel_announcements(chan_anns_chunk)
-                self.channel_db.add_channel_announcement(chan_anns_chunk)
-            # node announcements
-            for node_anns_chunk in chunks(node_anns, 100):
-                self.verify_node_announcements(node_anns_chunk)
-                self.channel_db.add_node_announcement(node_anns_chunk)
-            # channel updates
-            for chan_upds_chunk in chunks(chan_upds, 1000):
-                categorized_chan_upds = self.channel_db.add_channel_updates(
-                    chan_upds_chunk, max_age=self.network.lngossip.max_age)
-                orphaned = categorized_chan_upds.orphaned
-                if orphaned:
-                    self.logger.info(f'adding {len(orphaned)} unknown channel ids')
-                    orphaned_ids = [c['short_channel_id'] for c in orphaned]
-                    await self.network.lngossip.add_new_ids(orphaned_ids)
-                    # Save (some bounded number of) orphan channel updates for later
-                    # as it might be for our own direct channel with this peer
-                    # (and we might not yet know the short channel id for that)
-                    for chan_upd_payload in orphaned:
-                        short_channel_id = ShortChannelID(chan_upd_payload['short_channel_id'])
-                        self.orphan_channel_updates[short_channel_id] = chan_upd_payload
-                        while len(self.orphan_channel_updates) > 25:
-                            self.orphan_channel_updates.popitem(last=False)
-                if categorized_chan_upds.good:
-                    self.logger.debug(f'on_channel_update: {len(categorized_chan_upds.good)}/{len(chan_upds_chunk)}')
-
-    def verify_channel_announcements(self, chan_anns):
-        for payload in chan_anns:
-            h = sha256d(payload['raw'][2+256:])
-            pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
-            sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
-            for pubkey, sig in zip(pubkeys, sigs):
-                if not ecc.verify_signature(pubkey, sig, h):
-                    raise Exception('signature failed')
-
-    def verify_node_announcements(self, node_anns):
-        for payload in node_anns:
-            pubkey = payload['node_id']
-            signature = payload['signature']
-            h = sha256d(payload['raw'][66:])
-            if not ecc.verify_signature(pubkey, signature, h):
-                raise Exception('signature failed')
+            # note: the gossip of all peers is processed together, by LNGossip
+            await self.network.lngossip.ingest_gossip(self, chan_anns, node_anns, chan_upds)
+
+    def add_orphan_channel_update(self, payload):
+        # Save (some bounded number of) orphan channel updates for later
+        # as it might be for our own direct channel with this peer
+        # (and we might not yet know the short channel id for that)
+        short_channel_id = ShortChannelID(payload['short_channel_id'])
+        self.orphan_channel_updates[short_channel_id] = payload
+        while len(self.orphan_channel_updates) > 25:
+            self.orphan_channel_updates.popitem(last=False)
 
     async def query_gossip(self):
         try:
@@ -352,22 +320,33 @@ class Peer(Logger):
         except Exception as e:
             raise GracefulDisconnect(f"Failed to initialize: {e!r}") from e
         if self.lnworker == self.lnworker.network.lngossip:
+            # only the blocks after the last sync, and the gossip since then
+            first_block, num_blocks = self.lnworker.get_channel_range_to_query()
+            self.request_gossip(self.lnworker.get_gossip_timestamp())
             try:
-                ids, complete = await asyncio.wait_for(self.get_channel_range(), LN_P2P_NETWORK_TIMEOUT)
+                ids, complete = await asyncio.wait_for(self.get_channel_range(first_block, num_blocks), LN_P2P_NETWORK_TIMEOUT)
             except asyncio.TimeoutError as e:
                 raise GracefulDisconnect("query_channel_range timed out") from e
             self.logger.info('Received {} channel ids. (complete: {})'.format(len(ids), complete))
             await self.lnworker.add_new_ids(ids)
+            is_synced = False
             while True:
                 todo = self.lnworker.get_ids_to_query()
                 if not todo:
+                    # the ids are shared with the other peers, which may still be querying some
+                    if complete and not is_synced and not self.lnworker.queried_ids:
+                        self.lnworker.set_synced_block(first_block + num_blocks)
+                        is_synced = True
                     await asyncio.sleep(1)
                     continue
-                await self.get_short_channel_ids(todo)
-
-    async def get_channel_range(self):
-        first_block = constants.net.BLOCK_HEIGHT_FIRST_LIGHTNING_CHANNELS
-        num_blocks = self.lnworker.network.get_local_height() - first_block
+                try:
+                    await self.get_short_channel_ids(todo)
+                except BaseException:
+                    self.lnworker.set_ids_queried(todo, answered=False)
+                    raise
+                self.lnworker.set_ids_queried(todo, answered=True)
+
+    async def get_channel_range(self, first_block: int, num_blocks: int):
         self.query_channel_range(first_block, num_blocks)
         intervals = []
         ids = set()
@@ -472,6 +451,8 @@ class Peer(Logger):
         async for msg in self.transport.read_messages():
             self.process_message(msg)
             await asyncio.sleep(.01)
+            while self.gossip_queue.qsize() > self.MAX_GOSSIP_QUEUE_SIZE:
+                await asyncio.sleep(.1)
 
     def on_reply_short_channel_ids_end(self, payload):
         self.querying.set()
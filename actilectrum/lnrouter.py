@@ -23,9 +23,10 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import queue
+import heapq
+import time
 from collections import defaultdict
-from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
+from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set, Union, Iterator
 
 import attr
 
@@ -34,6 +35,7 @@ from .logging import Logger
 from .lnutil import (NUM_MAX_EDGES_IN_PAYMENT_PATH, ShortChannelID, LnFeatures,
                      NBLOCK_CLTV_EXPIRY_TOO_FAR_INTO_FUTURE)
 from .channel_db import ChannelDB, Policy, NodeInfo
+from .lnmissioncontrol import ChannelResult
 
 if TYPE_CHECKING:
     from .lnchannel import Channel
@@ -132,11 +134,7 @@ class LNPathFinder(Logger):
     def __init__(self, channel_db: ChannelDB):
         Logger.__init__(self)
         self.channel_db = channel_db
-        self.blacklist = set()
-
-    def add_to_blacklist(self, short_channel_id: ShortChannelID):
-        self.logger.info(f'blacklisting channel {short_channel_id}')
-        self.blacklist.add(short_channel_id)
+        self.mission_control = channel_db.mission_control
 
     def _edge_cost(self, short_channel_id: bytes, start_node: bytes, end_node: bytes,
                    payment_amt_msat: int, ignore_costs=False, is_mine=False, *,
@@ -169,6 +167,10 @@ class LNPathFinder(Logger):
                                                    node_info=node_info)
         if not route_edge.is_sane_to_use(payment_amt_msat):
             return float('inf'), 0  # thanks but no thanks
+        # channels that failed recently are less likely to succeed
+        channel_result = None if is_mine else self.mission_control.get_result(short_channel_id + start_node)
+        penalty = self.mission_control.get_penalty(channel_result, payment_amt_msat, time.time()) \
+            if channel_result else 0
 
         # Distance metric notes:  # TODO constants are ad-hoc
         # ( somewhat based on https://github.com/lightningnetwork/lnd/pull/1358 )
@@ -178,75 +180,175 @@ class LNPathFinder(Logger):
         # - Paying lower fees is better. :)
         base_cost = 500  # one more edge ~ paying 500 msat more fees
         if ignore_costs:
-            return base_cost, 0
+            return base_cost + penalty, 0
         fee_msat = route_edge.fee_for_edge(payment_amt_msat)
         cltv_cost = route_edge.cltv_expiry_delta * payment_amt_msat * 15 / 1_000_000_000
-        overall_cost = base_cost + fee_msat + cltv_cost
+        overall_cost = base_cost + fee_msat + cltv_cost + penalty
         return overall_cost, fee_msat
 
     def get_distances(self, nodeA: bytes, nodeB: bytes,
                       invoice_amount_msat: int, *,
-                      my_channels: Dict[ShortChannelID, 'Channel'] = None) \
-                      -> Optional[Sequence[Tuple[bytes, bytes]]]:
+                      my_channels: Dict[ShortChannelID, 'Channel'] = None,
+                      channel_penalties: Dict[ShortChannelID, float] = None) \
+                      -> Dict[bytes, Tuple[bytes, ShortChannelID]]:
+        """Returns the edges of the cheapest path from nodeA to nodeB,
+        as node_id -> (next node_id, short_channel_id).
+        channel_penalties are added to the cost of the channels, in both directions.
+        """
         # note: we don't lock self.channel_db, so while the path finding runs,
         #       the underlying graph could potentially change... (not good but maybe ~OK?)
+        if not self.channel_db.data_loaded.is_set():
+            raise Exception("channelDB data not loaded yet!")
+        if my_channels is None:
+            my_channels = {}
+        if channel_penalties is None:
+            channel_penalties = {}
+        graph = self.channel_db.graph
+        node_ids = graph.node_ids
+        adjacency = graph.adjacency
+        node1 = graph.node1
+        node2 = graph.node2
+        capacity_sat = graph.capacity_sat
+        is_usable = graph.is_usable
+        htlc_minimum_msat = graph.htlc_minimum_msat
+        htlc_maximum_msat = graph.htlc_maximum_msat
+        fee_base_msat = graph.fee_base_msat
+        fee_proportional_millionths = graph.fee_proportional_millionths
+        cltv_expiry_delta = graph.cltv_expiry_delta
+        # Nodes are referred to by their index in the graph. Nodes that are not
+        # in the graph (e.g. with only private channels) get negative indices.
+        extra_node_ids = []  # type: List[bytes]
+        def get_node_index(node_id: bytes) -> int:
+            i = graph.node_index.get(node_id)
+            if i is None:
+                if node_id not in extra_node_ids:
+                    extra_node_ids.append(node_id)
+                i = -1 - extra_node_ids.index(node_id)
+            return i
+        def get_node_id(i: int) -> bytes:
+            return node_ids[i] if i >= 0 else extra_node_ids[-1 - i]
+        # Our channels are not necessarily public, and their policies might not be either,
+        # so edges through them are evaluated with _edge_cost.
+        my_channels_for_node = defaultdict(list)
+        for chan in my_channels.values():
+            for node_id in (chan.node_id, chan.get_local_pubkey()):
+                my_channels_for_node[get_node_index(node_id)].append(chan.short_channel_id)
+        self.mission_control.update_blacklist()
+        blacklist = set(self.mission_control.blacklist)
+        skipped_channels = {graph.channel_index.get(scid) for scid in blacklist}
+        skipped_channels.update(graph.channel_index.get(scid) for scid in my_channels)
+        # the results of mission control, by direction
+        channel_results = {}  # type: Dict[int, ChannelResult]
+        for key, result in self.mission_control.get_results().items():
+            d = graph.get_direction(ShortChannelID(key[:8]), key[8:])
+            if d is not None:
+                channel_results[d] = result
+        get_penalty = self.mission_control.get_penalty
+        now = time.time()
+        penalized_channels = {graph.channel_index[scid]: penalty for scid, penalty in channel_penalties.items()
+                              if scid in graph.channel_index}
+        a = get_node_index(nodeA)
+        b = get_node_index(nodeB)
 
         # run Dijkstra
         # The search is run in the REVERSE direction, from nodeB to nodeA,
         # to properly calculate compound routing fees.
-        distance_from_start = defaultdict(lambda: float('inf'))
-        distance_from_start[nodeB] = 0
-        prev_node = {}
-        nodes_to_explore = queue.PriorityQueue()
-        nodes_to_explore.put((0, invoice_amount_msat, nodeB))  # order of fields (in tuple) matters!
-
+        inf = float('inf')
+        distance_from_start = {b: 0}
+        prev_node = {}  # type: Dict[int, Tuple[int, Union[int, ShortChannelID]]]
+        nodes_to_explore = [(0, invoice_amount_msat, b)]  # order of fields (in tuple) matters!
 
         # main loop of search
-        while nodes_to_explore.qsize() > 0:
-            dist_to_edge_endnode, amount_msat, edge_endnode = nodes_to_explore.get()
-            if edge_endnode == nodeA:
+        while nodes_to_explore:
+            dist_to_edge_endnode, amount_msat, edge_endnode = heapq.heappop(nodes_to_explore)
+            if edge_endnode == a:
                 break
             if dist_to_edge_endnode != distance_from_start[edge_endnode]:
-                # queue.PriorityQueue does not implement decrease_priority,
+                # heapq does not implement decrease_priority,
                 # so instead of decreasing priorities, we add items again into the queue.
                 # so there are duplicates in the queue, that we discard now:
                 continue
-            for edge_channel_id in self.channel_db.get_channels_for_node(edge_endnode, my_channels=my_channels):
-                assert isinstance(edge_channel_id, bytes)
-                if edge_channel_id in self.blacklist:
+            # public channels. This is _edge_cost, inlined
+            for c in (adjacency[edge_endnode] if edge_endnode >= 0 else ()):
+                if c in skipped_channels:
+                    continue
+                # the policy of the start node is used
+                if node1[c] == edge_endnode:
+                    edge_startnode = node2[c]
+                    d = 2 * c + 1
+                else:
+                    edge_startnode = node1[c]
+                    d = 2 * c
+                if not is_usable[d]:
+                    continue
+                if amount_msat < htlc_minimum_msat[d]:
+                    continue  # payment amount too little
+                if capacity_sat[c] is not None and amount_msat // 1000 > capacity_sat[c]:
+                    continue  # payment amount too large
+                if htlc_maximum_msat[d] is not None and amount_msat > htlc_maximum_msat[d]:
+                    continue  # payment amount too large
+                fee_msat = fee_base_msat[d] + amount_msat * fee_proportional_millionths[d] // 1_000_000
+                if fee_msat > 5_000 and 100 * fee_msat > amount_msat:
+                    continue  # see is_fee_sane
+                if edge_startnode == a:
+                    edge_cost = 500
+                    fee_msat = 0
+                else:
+                    edge_cost = 500 + fee_msat + cltv_expiry_delta[d] * amount_msat * 15 / 1_000_000_000
+                if d in channel_results:
+                    edge_cost += get_penalty(channel_results[d], amount_msat, now)
+                if c in penalized_channels:
+                    edge_cost += penalized_channels[c]
+                alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost
+                if alt_dist_to_neighbour < distance_from_start.get(edge_startnode, inf):
+                    distance_from_start[edge_startnode] = alt_dist_to_neighbour
+                    prev_node[edge_startnode] = edge_endnode, c
+                    heapq.heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_msat + fee_msat, edge_startnode))
+            # our own channels
+            for edge_channel_id in my_channels_for_node.get(edge_endnode, ()):
+                if edge_channel_id in blacklist:
                     continue
                 channel_info = self.channel_db.get_channel_info(edge_channel_id, my_channels=my_channels)
-                edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
-                is_mine = edge_channel_id in my_channels
-                if is_mine:
-                    if edge_startnode == nodeA:  # payment outgoing, on our channel
-                        if not my_channels[edge_channel_id].can_pay(amount_msat, check_frozen=True):
-                            continue
-                    else:  # payment incoming, on our channel. (funny business, cycle weirdness)
-                        assert edge_endnode == nodeA, (bh2u(edge_startnode), bh2u(edge_endnode))
-                        if not my_channels[edge_channel_id].can_receive(amount_msat, check_frozen=True):
-                            continue
+                edge_endnode_id = get_node_id(edge_endnode)
+                edge_startnode_id = channel_info.node2_id if channel_info.node1_id == edge_endnode_id else channel_info.node1_id
+                edge_startnode = get_node_index(edge_startnode_id)
+                if edge_startnode == a:  # payment outgoing, on our channel
+                    if not my_channels[edge_channel_id].can_pay(amount_msat, check_frozen=True):
+                        continue
+                else:  # payment incoming, on our channel. (funny business, cycle weirdness)
+                    assert edge_endnode == a, (bh2u(edge_startnode_id), bh2u(edge_endnode_id))
+                    if not my_channels[edge_channel_id].can_receive(amount_msat, check_frozen=True):
+                        continue
                 edge_cost, fee_for_edge_msat = self._edge_cost(
                     edge_channel_id,
-                    start_node=edge_startnode,
-                    end_node=edge_endnode,
+                    start_node=edge_startnode_id,
+                    end_node=edge_endnode_id,
                     payment_amt_msat=amount_msat,
-                    ignore_costs=(edge_startnode == nodeA),
-                    is_mine=is_mine,
+                    ignore_costs=(edge_startnode == a),
+                    is_mine=True,
                     my_channels=my_channels)
-                alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
-                if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
+                edge_cost += channel_penalties.get(edge_channel_id, 0)
+                alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost
+                if alt_dist_to_neighbour < distance_from_start.get(edge_startnode, inf):
                     distance_from_start[edge_startnode] = alt_dist_to_neighbour
                     prev_node[edge_startnode] = edge_endnode, edge_channel_id
                     amount_to_forward_msat = amount_msat + fee_for_edge_msat
-                    nodes_to_explore.put((alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
-
-        return prev_node
+                    heapq.heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
+
+        path = {}
+        edge_startnode = a
+        while edge_startnode in prev_node:
+            edge_endnode, c = prev_node[edge_startnode]
+            short_channel_id = graph.short_channel_ids[c] if type(c) is int else c
+            path[get_node_id(edge_startnode)] = get_node_id(edge_endnode), short_channel_id
+            edge_startnode = edge_endnode
+        return path
 
     @profiler
     def find_path_for_payment(self, nodeA: bytes, nodeB: bytes,
                               invoice_amount_msat: int, *,
-                              my_channels: Dict[ShortChannelID, 'Channel'] = None) \
+                              my_channels: Dict[ShortChannelID, 'Channel'] = None,
+                              channel_penalties: Dict[ShortChannelID, float] = None) \
             -> Optional[Sequence[Tuple[bytes, bytes]]]:
         """Return a path from nodeA to nodeB.
 
@@ -260,7 +362,8 @@ class LNPathFinder(Logger):
         if my_channels is None:
             my_channels = {}
 
-        prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
+        prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels,
+                                       channel_penalties=channel_penalties)
 
         if nodeA not in prev_node:
             return None  # no path found
@@ -275,6 +378,62 @@ class LNPathFinder(Logger):
             edge_startnode = edge_endnode
         return path
 
+    def find_paths_for_payment(self, nodeA: bytes, nodeB: bytes,
+                               invoice_amount_msat: int, *,
+                               my_channels: Dict[ShortChannelID, 'Channel'] = None) \
+            -> Iterator[Sequence[Tuple[bytes, bytes]]]:
+        """Yields near-disjoint paths from nodeA to nodeB, the cheapest first.
+
+        Each path is the cheapest one once the channels of the previous paths
+        are made more expensive, by the cost of the path they are on. A payment
+        that failed on a path can be retried on the next one, or split over several.
+        Channels blacklisted in the meantime are avoided. It stops when the cheapest
+        path is one that was already found, i.e. there is no other good enough path.
+        """
+        assert type(nodeA) is bytes
+        assert type(nodeB) is bytes
+        assert type(invoice_amount_msat) is int
+        if my_channels is None:
+            my_channels = {}
+        channel_penalties = defaultdict(float)  # type: Dict[ShortChannelID, float]
+        found_paths = set()  # type: Set[Tuple[ShortChannelID, ...]]
+        while True:
+            path = self.find_path_for_payment(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels,
+                                              channel_penalties=channel_penalties)
+            if path is None:
+                return
+            short_channel_ids = tuple(short_channel_id for _, short_channel_id in path)
+            if short_channel_ids in found_paths:
+                return
+            found_paths.add(short_channel_ids)
+            yield path
+            cost = self.get_path_cost(nodeA, path, invoice_amount_msat, my_channels=my_channels)
+            for short_channel_id in short_channel_ids:
+                channel_penalties[short_channel_id] += cost
+
+    def get_path_cost(self, nodeA: bytes, path: Sequence[Tuple[bytes, bytes]],
+                      invoice_amount_msat: int, *,
+                      my_channels: Dict[ShortChannelID, 'Channel'] = None) -> float:
+        """Returns the cost of a path from nodeA, as minimized by get_distances."""
+        if my_channels is None:
+            my_channels = {}
+        nodes = [nodeA] + [node_id for node_id, _ in path]
+        cost = 0
+        amount_msat = invoice_amount_msat
+        for i in reversed(range(len(path))):
+            short_channel_id = path[i][1]
+            edge_cost, fee_msat = self._edge_cost(
+                short_channel_id,
+                start_node=nodes[i],
+                end_node=nodes[i + 1],
+                payment_amt_msat=amount_msat,
+                ignore_costs=(i == 0),
+                is_mine=short_channel_id in my_channels,
+                my_channels=my_channels)
+            cost += edge_cost
+            amount_msat += fee_msat
+        return cost
+
     def create_route_from_path(self, path, from_node_id: bytes, *,
                                my_channels: Dict[ShortChannelID, 'Channel'] = None) -> LNPaymentRoute:
         assert isinstance(from_node_id, bytes)
@@ -8,7 +8,7 @@
 import hashlib
 import asyncio
 from asyncio import StreamReader, StreamWriter
-from typing import Optional
+from typing import Optional, List
 
 from .crypto import sha256, hmac_oneshot, chacha20_poly1305_encrypt, chacha20_poly1305_decrypt
 from .lnutil import (get_ecdh, privkey_to_pubkey, LightningPeerConnectionClosed,
@@ -92,6 +92,12 @@ class LNTransportBase:
     reader: StreamReader
     writer: StreamWriter
     privkey: bytes
+    # size of the reads from the socket
+    READ_SIZE = 2**16
+
+    def __init__(self):
+        # encrypted messages not written yet, see send_bytes
+        self._write_buffer = []  # type: List[bytes]
 
     def name(self) -> str:
         raise NotImplementedError()
@@ -102,32 +108,48 @@ class LNTransportBase:
         c = aead_encrypt(self.sk, self.sn(), b'', msg)
         assert len(lc) == 18
         assert len(c) == len(msg) + 16
-        self.writer.write(lc+c)
+        # the messages sent in the same iteration of the event loop are written together
+        if not self._write_buffer:
+            asyncio.get_event_loop().call_soon(self.flush)
+        self._write_buffer += [lc, c]
+
+    def flush(self) -> None:
+        if self._write_buffer:
+            self.writer.write(b''.join(self._write_buffer))
+            self._write_buffer.clear()
 
     async def read_messages(self):
-        read_buffer = b''
+        read_buffer = bytearray()
+        length = None  # of the next message, once its header is decrypted
         while True:
-            rn_l, rk_l = self.rn()
-            rn_m, rk_m = self.rn()
-            while True:
-                if len(read_buffer) >= 18:
-                    lc = read_buffer[:18]
-                    l = aead_decrypt(rk_l, rn_l, b'', lc)
-                    length = int.from_bytes(l, 'big')
-                    offset = 18 + length + 16
-                    if len(read_buffer) >= offset:
-                        c = read_buffer[18:offset]
-                        read_buffer = read_buffer[offset:]
-                        msg = aead_decrypt(rk_m, rn_m, b'', c)
-                        yield msg
+            # decrypt the complete messages, then remove them from the buffer at once
+            messages = []
+            offset = 0
+            with memoryview(read_buffer) as view:
+                while True:
+                    if length is None:
+                        if len(view) - offset < 18:
+                            break
+                        rn_l, rk_l = self.rn()
+                        l = aead_decrypt(rk_l, rn_l, b'', view[offset:offset+18])
+                        length = int.from_bytes(l, 'big')
+                        offset += 18
+                    if len(view) - offset < length + 16:
                         break
-                try:
-                    s = await self.reader.read(2**10)
-                except:
-                    s = None
-                if not s:
-                    raise LightningPeerConnectionClosed()
-                read_buffer += s
+                    rn_m, rk_m = self.rn()
+                    messages.append(aead_decrypt(rk_m, rn_m, b'', view[offset:offset+length+16]))
+                    offset += length + 16
+                    length = None
+            del read_buffer[:offset]
+            for msg in messages:
+                yield msg
+            try:
+                s = await self.reader.read(self.READ_SIZE)
+            except:
+                s = None
+            if not s:
+                raise LightningPeerConnectionClosed()
+            read_buffer += s
 
     def rn(self):
         o = self._rn, self.rk
@@ -153,6 +175,7 @@ class LNTransportBase:
         self.s_ck = ck
 
     def close(self):
+        self.flush()
         self.writer.close()
 
 
@@ -25,7 +25,8 @@
 
 import asyncio
 import threading
-from typing import TYPE_CHECKING, Dict, Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Set, Sequence, List, Tuple
 
 import aiorpcx
 
@@ -39,10 +40,12 @@ from .transaction import Transaction
 from .interface import GracefulDisconnect
 from .crypto import sha256d
 from .lnmsg import decode_msg, encode_msg
+from .logging import Logger
 
 if TYPE_CHECKING:
     from .network import Network
     from .lnrouter import ChannelDB
+    from .simple_config import SimpleConfig
 
 
 class LNChannelVerifier(NetworkJobOnDefaultServer):
@@ -183,3 +186,52 @@ def verify_sig_for_channel_update(chan_upd: dict, node_id: bytes) -> bool:
     if not ecc.verify_signature(node_id, sig, h):
         return False
     return True
+
+
+def _verify_signatures(items: Sequence[Tuple[bytes, bytes, bytes]]) -> bool:
+    for pubkey, sig, h in items:
+        if not ecc.verify_signature(pubkey, sig, h):
+            return False
+    return True
+
+
+class GossipSignatureVerifier(Logger):
+    """Verifies the signatures of gossip messages in a pool of threads,
+    so that the initial gossip sync does not block the event loop.
+
+    libsecp256k1 is called through ctypes, which releases the GIL,
+    so the threads also verify in parallel. The messages of each call
+    are split into one batch per thread.
+    """
+
+    def __init__(self, config: 'SimpleConfig'):
+        Logger.__init__(self)
+        self.num_threads = max(1, config.get('gossip_verify_threads', 2))
+        # note: threads are started when needed
+        self.executor = ThreadPoolExecutor(max_workers=self.num_threads,
+                                           thread_name_prefix='gossip_verify')
+
+    async def verify_channel_announcements(self, chan_anns: Sequence[dict]) -> bool:
+        items = []
+        for payload in chan_anns:
+            h = sha256d(payload['raw'][2+256:])
+            pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
+            sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
+            items += [(pubkey, sig, h) for pubkey, sig in zip(pubkeys, sigs)]
+        return await self._verify(items)
+
+    async def verify_node_announcements(self, node_anns: Sequence[dict]) -> bool:
+        items = [(payload['node_id'], payload['signature'], sha256d(payload['raw'][66:]))
+                 for payload in node_anns]
+        return await self._verify(items)
+
+    async def _verify(self, items: List[Tuple[bytes, bytes, bytes]]) -> bool:
+        """Returns whether all the (pubkey, sig, hash) items are valid."""
+        if not items:
+            return True
+        loop = asyncio.get_event_loop()
+        batch_size = -(-len(items) // self.num_threads)
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, _verify_signatures, items[i:i+batch_size])
+            for i in range(0, len(items), batch_size)])
+        return all(results)
@@ -51,6 +51,7 @@ PRIMARY KEY(outpoint)
 
 
 class SweepStore(SqlDB):
+    # note: writes are committed before their future is resolved, see SqlDB._run_batch
 
     def __init__(self, path, network):
         super().__init__(network.asyncio_loop, path)
@@ -78,7 +79,6 @@ class SweepStore(SqlDB):
         c = self.conn.cursor()
         assert Transaction(raw_tx).is_complete()
         c.execute("""INSERT INTO sweep_txs (funding_outpoint, ctn, prevout, tx) VALUES (?,?,?,?)""", (funding_outpoint, ctn, prevout, bfh(raw_tx)))
-        self.conn.commit()
 
     @sql
     def get_num_tx(self, funding_outpoint):
@@ -98,18 +98,15 @@ class SweepStore(SqlDB):
     def remove_sweep_tx(self, funding_outpoint):
         c = self.conn.cursor()
         c.execute("DELETE FROM sweep_txs WHERE funding_outpoint=?", (funding_outpoint,))
-        self.conn.commit()
 
     def _add_channel(self, outpoint, address):
         c = self.conn.cursor()
         c.execute("INSERT INTO channel_info (address, outpoint) VALUES (?,?)", (address, outpoint))
-        self.conn.commit()
 
     @sql
     def remove_channel(self, outpoint):
         c = self.conn.cursor()
         c.execute("DELETE FROM channel_info WHERE outpoint=?", (outpoint,))
-        self.conn.commit()
 
     def _has_channel(self, outpoint):
         c = self.conn.cursor()
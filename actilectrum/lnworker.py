@@ -7,13 +7,14 @@ import os
 from decimal import Decimal
 import random
 import time
-from typing import Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, NamedTuple, Union, Mapping
+from typing import (Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, NamedTuple, Union, Mapping, Iterator,
+                    Callable)
 import threading
 import socket
 import json
 from datetime import datetime, timezone
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import concurrent
 from concurrent import futures
 
@@ -33,7 +34,7 @@ from .transaction import Transaction
 from .crypto import sha256
 from .bip32 import BIP32Node
 from .util import bh2u, bfh, InvoiceError, resolve_dns_srv, is_ip_address, log_exceptions
-from .util import ignore_exceptions, make_aiohttp_session, SilentTaskGroup
+from .util import ignore_exceptions, make_aiohttp_session, SilentTaskGroup, chunks
 from .util import timestamp_to_datetime
 from .util import MyEncoder
 from .logging import Logger
@@ -387,9 +388,26 @@ class LNWorker(Logger, NetworkRetryManager[LNPeerAddr]):
         return peer
 
 
+class GossipBatch(NamedTuple):
+    peer: Peer
+    chan_anns: List[dict]
+    node_anns: List[dict]
+    chan_upds: List[dict]
+    future: asyncio.Future
+
+
 class LNGossip(LNWorker):
     max_age = 14*24*3600
     LOGGING_SHORTCUT = 'g'
+    # number of processed gossip messages that are remembered, to skip the copies from other peers
+    MAX_SEEN_GOSSIP = 50_000
+    # peers wait with their gossip while the gossip db has more pending requests
+    MAX_SQL_BACKLOG = 1000
+    # after a restart, the channel ids of the last blocks before the synced block
+    # are queried again, as their announcements may not have been sent yet
+    SYNC_BLOCK_MARGIN = 144
+    # and the gossip since a bit before the last channel_update we have
+    SYNC_TIMESTAMP_MARGIN = 3600  # seconds
 
     def __init__(self):
         seed = os.urandom(32)
@@ -399,11 +417,18 @@ class LNGossip(LNWorker):
         self.features |= LnFeatures.GOSSIP_QUERIES_OPT
         self.features |= LnFeatures.GOSSIP_QUERIES_REQ
         self.unknown_ids = set()
+        # the ids of get_ids_to_query, until their query is over
+        self.queried_ids = set()
+        # gossip of all the peers is processed together, see ingest_gossip
+        self.gossip_batches = asyncio.Queue()  # type: asyncio.Queue[GossipBatch]
+        self._seen_gossip = OrderedDict()  # type: OrderedDict[tuple, None]
+        self.gossip_counters = {'accepted': 0, 'duplicate': 0, 'dropped': 0}
 
     def start_network(self, network: 'Network'):
         assert network
         super().start_network(network)
         asyncio.run_coroutine_threadsafe(self.taskgroup.spawn(self.maintain_db()), self.network.asyncio_loop)
+        asyncio.run_coroutine_threadsafe(self.taskgroup.spawn(self.process_gossip()), self.network.asyncio_loop)
 
     async def maintain_db(self):
         await self.channel_db.load_data()
@@ -411,8 +436,134 @@ class LNGossip(LNWorker):
             if len(self.unknown_ids) == 0:
                 self.channel_db.prune_old_policies(self.max_age)
                 self.channel_db.prune_orphaned_channels()
+            if self.channel_db.is_snapshot_due():
+                await self.channel_db.save_snapshot()
+            self.logger.info(f'gossip messages: {self.gossip_counters}')
             await asyncio.sleep(120)
 
+    async def ingest_gossip(self, peer: Peer, chan_anns: List[dict], node_anns: List[dict],
+                            chan_upds: List[dict]) -> None:
+        """Adds the gossip received from peer to the db, together with that of
+        other peers. Raises if a signature is invalid.
+        """
+        # wait for the db to catch up, so that the peer stops reading gossip meanwhile
+        while self.channel_db.db_requests.qsize() > self.MAX_SQL_BACKLOG:
+            await asyncio.sleep(0.1)
+        future = asyncio.Future()
+        self.gossip_batches.put_nowait(GossipBatch(peer, chan_anns, node_anns, chan_upds, future))
+        await future
+
+    async def process_gossip(self):
+        await self.channel_db.data_loaded.wait()
+        while True:
+            batches = [await self.gossip_batches.get()]
+            while not self.gossip_batches.empty():
+                batches.append(self.gossip_batches.get_nowait())
+            try:
+                await self._process_gossip_batches(batches)
+            except BaseException as e:
+                for batch in batches:
+                    if not batch.future.done():
+                        batch.future.set_exception(e)
+                if not isinstance(e, Exception):
+                    raise
+
+    def _get_gossip_key(self, name: str, payload: dict) -> tuple:
+        if name == 'channel_announcement':
+            return name, payload['short_channel_id']
+        elif name == 'node_announcement':
+            return name, payload['node_id'], payload['timestamp']
+        else:
+            return name, payload['short_channel_id'], payload['channel_flags'][0] & 1, payload['timestamp']
+
+    def _is_known_gossip(self, name: str, payload: dict) -> bool:
+        if self._get_gossip_key(name, payload) in self._seen_gossip:
+            return True
+        if name == 'channel_announcement':
+            return self.channel_db.get_channel_info(ShortChannelID(payload['short_channel_id'])) is not None
+        if name == 'node_announcement':
+            node_info = self.channel_db.get_node_info_for_node_id(payload['node_id'])
+            return node_info is not None and node_info.timestamp >= payload['timestamp']
+        return False
+
+    def _drop_duplicate_gossip(self, batch: GossipBatch, is_duplicate: Callable[[str, dict], bool]) -> GossipBatch:
+        filtered = []
+        for name, payloads in (('channel_announcement', batch.chan_anns),
+                               ('node_announcement', batch.node_anns),
+                               ('channel_update', batch.chan_upds)):
+            new_payloads = []
+            for payload in payloads:
+                if is_duplicate(name, payload):
+                    self.gossip_counters['duplicate'] += 1
+                    continue
+                new_payloads.append(payload)
+            filtered.append(new_payloads)
+        return batch._replace(chan_anns=filtered[0], node_anns=filtered[1], chan_upds=filtered[2])
+
+    async def _process_gossip_batches(self, batches: List[GossipBatch]) -> None:
+        # Drop the messages that were already processed. Those had valid signatures.
+        batches = [self._drop_duplicate_gossip(batch, self._is_known_gossip) for batch in batches]
+        # verify signatures
+        results = await asyncio.gather(*[
+            asyncio.gather(self.channel_db.sig_verifier.verify_channel_announcements(batch.chan_anns),
+                           self.channel_db.sig_verifier.verify_node_announcements(batch.node_anns))
+            for batch in batches])
+        good_batches = []
+        for batch, result in zip(batches, results):
+            if all(result):
+                good_batches.append(batch)
+            else:
+                self.gossip_counters['dropped'] += len(batch.chan_anns) + len(batch.node_anns) + len(batch.chan_upds)
+                batch.future.set_exception(Exception('signature failed'))
+        # Drop the messages that are in an earlier batch. Only the verified batches
+        # count, so that a copy with an invalid signature does not hide valid ones,
+        # which peers would not send again.
+        keys = set()
+        def is_duplicate(name: str, payload: dict) -> bool:
+            key = self._get_gossip_key(name, payload)
+            if key in keys:
+                return True
+            keys.add(key)
+            return False
+        good_batches = [self._drop_duplicate_gossip(batch, is_duplicate) for batch in good_batches]
+        # note: data processed in chunks to avoid taking sql lock for too long
+        chan_anns = [payload for batch in good_batches for payload in batch.chan_anns]
+        for chan_anns_chunk in chunks(chan_anns, 300):
+            self.channel_db.add_channel_announcement(chan_anns_chunk)
+        node_anns = [payload for batch in good_batches for payload in batch.node_anns]
+        for node_anns_chunk in chunks(node_anns, 100):
+            self.channel_db.add_node_announcement(node_anns_chunk)
+        self.gossip_counters['accepted'] += len(chan_anns) + len(node_anns)
+        peer_for_chan_upd = {id(payload): batch.peer for batch in good_batches for payload in batch.chan_upds}
+        chan_upds = [payload for batch in good_batches for payload in batch.chan_upds]
+        # orphaned updates are not remembered, as they are sent again with their channel
+        orphaned_chan_upds = set()
+        for chan_upds_chunk in chunks(chan_upds, 1000):
+            categorized_chan_upds = self.channel_db.add_channel_updates(chan_upds_chunk, max_age=self.max_age)
+            num_accepted = len(categorized_chan_upds.good) + len(categorized_chan_upds.unchanged)
+            self.gossip_counters['accepted'] += num_accepted
+            self.gossip_counters['dropped'] += len(chan_upds_chunk) - num_accepted
+            orphaned = categorized_chan_upds.orphaned
+            if orphaned:
+                self.logger.info(f'adding {len(orphaned)} unknown channel ids')
+                orphaned_ids = [c['short_channel_id'] for c in orphaned]
+                await self.add_new_ids(orphaned_ids)
+                for chan_upd_payload in orphaned:
+                    peer_for_chan_upd[id(chan_upd_payload)].add_orphan_channel_update(chan_upd_payload)
+                    orphaned_chan_upds.add(id(chan_upd_payload))
+            if categorized_chan_upds.good:
+                self.logger.debug(f'on_channel_update: {len(categorized_chan_upds.good)}/{len(chan_upds_chunk)}')
+        for name, payloads in (('channel_announcement', chan_anns),
+                               ('node_announcement', node_anns),
+                               ('channel_update', chan_upds)):
+            for payload in payloads:
+                if id(payload) not in orphaned_chan_upds:
+                    self._seen_gossip[self._get_gossip_key(name, payload)] = None
+        while len(self._seen_gossip) > self.MAX_SEEN_GOSSIP:
+            self._seen_gossip.popitem(last=False)
+        for batch in good_batches:
+            batch.future.set_result(None)
+
     async def add_new_ids(self, ids):
         known = self.channel_db.get_channel_ids()
         new = set(ids) - set(known)
@@ -421,14 +572,46 @@ class LNGossip(LNWorker):
         util.trigger_callback('gossip_peers', self.num_peers())
         util.trigger_callback('ln_gossip_sync_progress')
 
+    def get_channel_range_to_query(self) -> Tuple[int, int]:
+        """first_block, num_blocks of the channel ids we may not have"""
+        first_block = constants.net.BLOCK_HEIGHT_FIRST_LIGHTNING_CHANNELS
+        synced_block = self.channel_db.get_synced_block()
+        if synced_block is not None:
+            first_block = max(first_block, synced_block - self.SYNC_BLOCK_MARGIN)
+        return first_block, max(0, self.network.get_local_height() - first_block)
+
+    def set_synced_block(self, block: int) -> None:
+        synced_block = self.channel_db.get_synced_block()
+        if synced_block is None or block > synced_block:
+            self.channel_db.set_synced_block(block)
+
+    def get_gossip_timestamp(self) -> int:
+        """first_timestamp for gossip_timestamp_filter. Channels that are new to
+        us are queried, so without any channel_update we only want new gossip.
+        """
+        timestamp = self.channel_db.get_last_update_timestamp()
+        if timestamp is None:
+            return int(time.time())
+        return max(0, timestamp - self.SYNC_TIMESTAMP_MARGIN)
+
     def get_ids_to_query(self):
         N = 500
         l = list(self.unknown_ids)
         self.unknown_ids = set(l[N:])
+        self.queried_ids.update(l[0:N])
         util.trigger_callback('unknown_channels', len(self.unknown_ids))
         util.trigger_callback('ln_gossip_sync_progress')
         return l[0:N]
 
+    def set_ids_queried(self, ids, *, answered: bool) -> None:
+        """The query of ids from get_ids_to_query is over.
+        If it was not answered, they are left to the next query.
+        """
+        self.queried_ids.difference_update(ids)
+        if not answered:
+            self.unknown_ids.update(ids)
+            util.trigger_callback('unknown_channels', len(self.unknown_ids))
+
     def get_sync_progress_estimate(self) -> Tuple[Optional[int], Optional[int]]:
         if self.num_peers() == 0:
             return None, None
@@ -796,13 +979,22 @@ class LNWallet(LNWorker):
         log = self.logs[key]
         success = False
         reason = ''
+        routes = None  # type: Optional[Iterator[LNPaymentRoute]]
         for i in range(attempts):
             try:
                 # note: path-finding runs in a separate thread so that we don't block the asyncio loop
                 # graph updates might occur during the computation
                 self.set_invoice_status(key, PR_ROUTING)
                 util.trigger_callback('invoice_status', key)
-                route = await run_in_thread(self._create_route_from_invoice, lnaddr)
+                route = None
+                if routes is not None:
+                    route = await run_in_thread(next, routes, None)
+                if route is None:
+                    # the routes of the last search were all tried, search again
+                    routes = self._create_routes_from_invoice(lnaddr)
+                    route = await run_in_thread(next, routes, None)
+                    if route is None:
+                        raise NoPathFound()
                 self.set_invoice_status(key, PR_INFLIGHT)
                 util.trigger_callback('invoice_status', key)
                 payment_attempt_log = await self._pay_to_route(route, lnaddr)
@@ -815,6 +1007,11 @@ class LNWallet(LNWorker):
             success = payment_attempt_log.success
             if success:
                 break
+            # unless the failure blacklisted a channel, the same channels might
+            # work now (e.g. after a channel update), so do not steer away from them
+            failure_details = payment_attempt_log.failure_details
+            if failure_details is None or not failure_details.is_blacklisted:
+                routes = None
         else:
             reason = _('Failed after {} attempts').format(attempts)
         util.trigger_callback('invoice_status', key)
@@ -839,8 +1036,11 @@ class LNWallet(LNWorker):
                         payment_secret=lnaddr.payment_secret)
         util.trigger_callback('htlc_added', htlc, lnaddr, SENT)
         payment_attempt = await self.await_payment(lnaddr.paymenthash)
+        amount_msat = int(lnaddr.amount * COIN * 1000)
+        mission_control = self.network.path_finder.mission_control
         if payment_attempt.success:
             failure_log = None
+            mission_control.report_success(route, amount_msat)
         else:
             if payment_attempt.error_bytes:
                 # TODO "decode_onion_error" might raise, catch and maybe blacklist/penalise someone?
@@ -850,12 +1050,14 @@ class LNWallet(LNWorker):
                     # blacklist channel after reporter node
                     # TODO this should depend on the error (even more granularity)
                     # also, we need finer blacklisting (directed edges; nodes)
-                    try:
-                        short_chan_id = route[sender_idx + 1].short_channel_id
-                    except IndexError:
-                        self.logger.info("payment destination reported error")
+                    if sender_idx + 1 < len(route):
+                        mission_control.report_failure(route, amount_msat, sender_idx + 1)
                     else:
-                        self.network.path_finder.add_to_blacklist(short_chan_id)
+                        self.logger.info("payment destination reported error")
+                        mission_control.report_success(route, amount_msat)
+                else:
+                    # the channels up to the reporter node forwarded the payment
+                    mission_control.report_success(route, amount_msat, num_edges=sender_idx + 1)
             else:
                 # probably got "update_fail_malformed_htlc". well... who to penalise now?
                 assert payment_attempt.error_reason is not None
@@ -940,79 +1142,94 @@ class LNWallet(LNWorker):
 
     @profiler
     def _create_route_from_invoice(self, decoded_invoice: 'LnAddr') -> LNPaymentRoute:
+        route = next(self._create_routes_from_invoice(decoded_invoice), None)
+        if route is None:
+            raise NoPathFound()
+        return route
+
+    def _create_routes_from_invoice(self, decoded_invoice: 'LnAddr') -> Iterator[LNPaymentRoute]:
+        """Yields routes for paying the invoice, best first.
+
+        Routes through the private route hints of the invoice are taken in turn,
+        then routes without them. The routes for each of these are near-disjoint
+        (see LNPathFinder.find_paths_for_payment), and they are searched one at
+        a time, so that channels blacklisted in the meantime are avoided.
+        """
         amount_msat = int(decoded_invoice.amount * COIN * 1000)
         invoice_pubkey = decoded_invoice.pubkey.serialize()
-        # use 'r' field from invoice
-        route = None  # type: Optional[LNPaymentRoute]
         # only want 'r' tags
         r_tags = list(filter(lambda x: x[0] == 'r', decoded_invoice.tags))
         # strip the tag type, it's implicitly 'r' now
         r_tags = list(map(lambda x: x[1], r_tags))
-        # if there are multiple hints, we will use the first one that works,
+        # if there are multiple hints, we will start with the first one that works,
         # from a random permutation
         random.shuffle(r_tags)
         channels = list(self.channels.values())
         scid_to_my_channels = {chan.short_channel_id: chan for chan in channels
                                if chan.short_channel_id is not None}
-        for private_route in r_tags:
-            if len(private_route) == 0:
-                continue
-            if len(private_route) > NUM_MAX_EDGES_IN_PAYMENT_PATH:
-                continue
-            border_node_pubkey = private_route[0][0]
-            path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, border_node_pubkey, amount_msat,
-                                                                  my_channels=scid_to_my_channels)
-            if not path:
-                continue
-            route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey,
-                                                                    my_channels=scid_to_my_channels)
-            # we need to shift the node pubkey by one towards the destination:
-            private_route_nodes = [edge[0] for edge in private_route][1:] + [invoice_pubkey]
-            private_route_rest = [edge[1:] for edge in private_route]
-            prev_node_id = border_node_pubkey
-            for node_pubkey, edge_rest in zip(private_route_nodes, private_route_rest):
-                short_channel_id, fee_base_msat, fee_proportional_millionths, cltv_expiry_delta = edge_rest
-                short_channel_id = ShortChannelID(short_channel_id)
-                # if we have a routing policy for this edge in the db, that takes precedence,
-                # as it is likely from a previous failure
-                channel_policy = self.channel_db.get_policy_for_node(short_channel_id=short_channel_id,
-                                                                     node_id=prev_node_id,
-                                                                     my_channels=scid_to_my_channels)
-                if channel_policy:
-                    fee_base_msat = channel_policy.fee_base_msat
-                    fee_proportional_millionths = channel_policy.fee_proportional_millionths
-                    cltv_expiry_delta = channel_policy.cltv_expiry_delta
-                node_info = self.channel_db.get_node_info_for_node_id(node_id=node_pubkey)
-                route.append(RouteEdge(node_id=node_pubkey,
-                                       short_channel_id=short_channel_id,
-                                       fee_base_msat=fee_base_msat,
-                                       fee_proportional_millionths=fee_proportional_millionths,
-                                       cltv_expiry_delta=cltv_expiry_delta,
-                                       node_features=node_info.features if node_info else 0))
-                prev_node_id = node_pubkey
-            # test sanity
-            if not is_route_sane_to_use(route, amount_msat, decoded_invoice.get_min_final_cltv_expiry()):
-                self.logger.info(f"rejecting insane route {route}")
-                route = None
-                continue
-            break
-        # if could not find route using any hint; try without hint now
-        if route is None:
-            path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, invoice_pubkey, amount_msat,
-                                                                  my_channels=scid_to_my_channels)
-            if not path:
-                raise NoPathFound()
-            route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey,
-                                                                    my_channels=scid_to_my_channels)
-            if not is_route_sane_to_use(route, amount_msat, decoded_invoice.get_min_final_cltv_expiry()):
-                self.logger.info(f"rejecting insane route {route}")
-                raise NoPathFound()
-        assert len(route) > 0
-        assert route[-1].node_id == invoice_pubkey
-        # add features from invoice
+        path_finder = self.network.path_finder
+        min_final_cltv_expiry = decoded_invoice.get_min_final_cltv_expiry()
         invoice_features = decoded_invoice.get_tag('9') or 0
-        route[-1].node_features |= invoice_features
-        return route
+
+        def routes_for_hint(private_route: Optional[Sequence]) -> Iterator[LNPaymentRoute]:
+            target = private_route[0][0] if private_route else invoice_pubkey
+            for path in path_finder.find_paths_for_payment(self.node_keypair.pubkey, target, amount_msat,
+                                                           my_channels=scid_to_my_channels):
+                route = path_finder.create_route_from_path(path, self.node_keypair.pubkey,
+                                                           my_channels=scid_to_my_channels)
+                if private_route:
+                    self._add_private_route_to_route(route, private_route, invoice_pubkey,
+                                                     my_channels=scid_to_my_channels)
+                # test sanity
+                if not is_route_sane_to_use(route, amount_msat, min_final_cltv_expiry):
+                    self.logger.info(f"rejecting insane route {route}")
+                    continue
+                assert len(route) > 0
+                assert route[-1].node_id == invoice_pubkey
+                # add features from invoice
+                route[-1].node_features |= invoice_features
+                yield route
+
+        routes = [routes_for_hint(private_route) for private_route in r_tags
+                  if 0 < len(private_route) <= NUM_MAX_EDGES_IN_PAYMENT_PATH]
+        while routes:
+            for it in list(routes):
+                route = next(it, None)
+                if route is None:
+                    routes.remove(it)
+                else:
+                    yield route
+        # if could not find route using any hint; try without hint now
+        yield from routes_for_hint(None)
+
+    def _add_private_route_to_route(self, route: List[RouteEdge], private_route: Sequence,
+                                    invoice_pubkey: bytes, *,
+                                    my_channels: Dict[ShortChannelID, Channel]) -> None:
+        border_node_pubkey = private_route[0][0]
+        # we need to shift the node pubkey by one towards the destination:
+        private_route_nodes = [edge[0] for edge in private_route][1:] + [invoice_pubkey]
+        private_route_rest = [edge[1:] for edge in private_route]
+        prev_node_id = border_node_pubkey
+        for node_pubkey, edge_rest in zip(private_route_nodes, private_route_rest):
+            short_channel_id, fee_base_msat, fee_proportional_millionths, cltv_expiry_delta = edge_rest
+            short_channel_id = ShortChannelID(short_channel_id)
+            # if we have a routing policy for this edge in the db, that takes precedence,
+            # as it is likely from a previous failure
+            channel_policy = self.channel_db.get_policy_for_node(short_channel_id=short_channel_id,
+                                                                 node_id=prev_node_id,
+                                                                 my_channels=my_channels)
+            if channel_policy:
+                fee_base_msat = channel_policy.fee_base_msat
+                fee_proportional_millionths = channel_policy.fee_proportional_millionths
+                cltv_expiry_delta = channel_policy.cltv_expiry_delta
+            node_info = self.channel_db.get_node_info_for_node_id(node_id=node_pubkey)
+            route.append(RouteEdge(node_id=node_pubkey,
+                                   short_channel_id=short_channel_id,
+                                   fee_base_msat=fee_base_msat,
+                                   fee_proportional_millionths=fee_proportional_millionths,
+                                   cltv_expiry_delta=cltv_expiry_delta,
+                                   node_features=node_info.features if node_info else 0))
+            prev_node_id = node_pubkey
 
     def add_request(self, amount_sat, message, expiry):
         coro = self._add_request_coro(amount_sat, message, expiry)
@@ -1022,6 +1022,124 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             raise Exception(f"{repr(height)} is not a block height")
         return await self.interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
 
+    async def sync_chunks(self, interface: Interface, height: int, tip: int) -> Tuple[bool, int]:
+        """Catches up the blockchain of `interface` from height up to tip.
+        Up to 'header_sync_pipeline_depth' chunks are requested at once, spread
+        over the interfaces that follow the same chain as `interface`.
+        They are connected in order as they arrive, several chunks per write.
+
+        Chunks from other servers are only saved once a chunk from `interface`
+        links up to them. If it does not, they are requested again from `interface`.
+
+        Returns (could_connect, num_headers) like Interface.request_chunk,
+        num_headers counting from the start of the first chunk.
+        Caller must hold bhi_lock.
+        """
+        chain = interface.blockchain
+        first_index = height // 2016
+        last_index = tip // 2016
+        depth = max(1, self.config.get('header_sync_pipeline_depth', 8))
+
+        def get_size(index: int) -> int:
+            return min(2016, tip - index * 2016 + 1)
+
+        def get_helpers(index: int) -> List[Interface]:
+            # the last chunk, and the last one in the checkpoint region,
+            # always come from `interface`, so that everything before links up to it
+            if index in (last_index, len(chain.checkpoints) - 1):
+                return []
+            last_height = index * 2016 + get_size(index) - 1
+            with self.interfaces_lock:
+                ifaces = list(self.interfaces.values())
+            return [iface for iface in ifaces
+                    if iface is not interface
+                    and iface.ready.done() and not iface.ready.cancelled()
+                    and iface.blockchain == chain and iface.tip >= last_height]
+
+        async def get_chunk_from_interface(index: int) -> bytes:
+            res = await interface.get_chunk(index, get_size(index))
+            return bfh(res['hex'])
+
+        async def get_chunk(index: int) -> Tuple[bytes, Interface]:
+            candidates = get_helpers(index) + [interface]
+            iface = candidates[index % len(candidates)]
+            if iface is not interface:
+                size = get_size(index)
+                try:
+                    res = await iface.get_chunk(index, size)
+                    data = bfh(res['hex'])
+                    if res['count'] == size and len(data) == size * HEADER_SIZE:
+                        return data, iface
+                    self.logger.info(f"got {res['count']} headers in chunk {index} from {iface.server}")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.info(f"failed to get chunk {index} from {iface.server}: {repr(e)}")
+            return await get_chunk_from_interface(index), interface
+
+        def get_last_hash(data: bytes, hashes: bytes, prev_hash: Optional[str]) -> Optional[str]:
+            return bitcoin.hash_encode(hashes[-blockchain.HASH_SIZE:]) if data else prev_hash
+
+        try:
+            tip_hash = chain.get_hash(first_index * 2016 - 1)
+        except blockchain.MissingHeader:
+            tip_hash = None
+        tasks = {}  # type: Dict[int, asyncio.Future]
+        next_to_fetch = next_to_connect = first_index
+        saved_up_to = first_index  # first chunk not saved yet
+        batch = []  # type: List[bytes]  # chunks to be saved, starting at saved_up_to
+        pending = []  # type: List[bytes]  # chunks from other servers after those
+        num_headers = 0
+        self.logger.info(f"syncing chunks {first_index} to {last_index} with depth {depth}")
+        try:
+            while next_to_connect <= last_index:
+                while next_to_fetch <= last_index and next_to_fetch < next_to_connect + depth:
+                    tasks[next_to_fetch] = asyncio.ensure_future(get_chunk(next_to_fetch))
+                    next_to_fetch += 1
+                index = next_to_connect
+                data, iface = await tasks.pop(index)
+                next_to_connect += 1
+                hashes = blockchain.hashes_of_raw_headers(data)
+                if iface is not interface:
+                    if tip_hash is not None and blockchain.raw_headers_connect(data, hashes, tip_hash):
+                        pending.append(data)
+                        tip_hash = get_last_hash(data, hashes, tip_hash)
+                        continue
+                    self.logger.info(f"chunk {index} from {iface.server} does not connect. requesting it again")
+                    data = await get_chunk_from_interface(index)
+                    hashes = blockchain.hashes_of_raw_headers(data)
+                if pending and not blockchain.raw_headers_connect(data, hashes, tip_hash):
+                    self.logger.info(f"chunks {index - len(pending)} to {index - 1} from other servers "
+                                     f"are not on the chain of {interface.server}. requesting them again")
+                    pending = [await get_chunk_from_interface(i) for i in range(index - len(pending), index)]
+                batch += pending + [data]
+                pending = []
+                tip_hash = get_last_hash(data, hashes, tip_hash)
+                # the server might have given us fewer headers than requested
+                num_complete = next((i + 1 for i, chunk in enumerate(batch)
+                                     if len(chunk) < get_size(saved_up_to + i) * HEADER_SIZE), len(batch))
+                is_incomplete = num_complete < len(batch) or len(data) < get_size(index) * HEADER_SIZE
+                if (is_incomplete
+                        or next_to_connect > last_index
+                        or len(batch) >= depth
+                        or next_to_connect not in tasks
+                        or not tasks[next_to_connect].done()
+                        # chunks in the checkpoint region are saved differently
+                        or next_to_connect == len(chain.checkpoints)):
+                    data = b''.join(batch[:num_complete])
+                    if not chain.connect_raw_chunk(saved_up_to, data):
+                        return num_headers > 0, num_headers
+                    num_headers += len(data) // HEADER_SIZE
+                    saved_up_to = next_to_connect
+                    batch = []
+                    util.trigger_callback('network_updated')
+                    if is_incomplete:
+                        break
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        return True, num_headers
+
     @best_effort_reliable
     @catch_server_exceptions
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
@@ -1147,6 +1265,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 # will NOT raise, and the group will keep the other tasks running
                 async with taskgroup as group:
                     await group.spawn(self._maintain_sessions())
+                    await group.spawn(self._flush_headers_periodically())
                     [await group.spawn(job) for job in self._jobs]
             except asyncio.CancelledError:
                 raise
@@ -1178,7 +1297,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interface = None
         self.interfaces = {}
         self._connecting.clear()
-        if not full_shutdown:
+        if full_shutdown:
+            blockchain.flush_blockchains()
+        else:
             util.trigger_callback('network_updated')
 
     def stop(self):
@@ -1188,6 +1309,13 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             fut.result(timeout=2)
         except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError): pass
 
+    async def _flush_headers_periodically(self):
+        # only does something if 'headers_durability' is 'batched'
+        while True:
+            await asyncio.sleep(self.config.get('headers_fsync_interval', blockchain.HEADERS_FSYNC_INTERVAL))
+            # fsync can take long on slow disks; do not block the event loop
+            await self.asyncio_loop.run_in_executor(None, blockchain.flush_blockchains)
+
     async def _ensure_there_is_a_main_interface(self):
         if self.is_connected():
             return
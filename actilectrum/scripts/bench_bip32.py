@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+#
+# Measures the derivation of the addresses of a wallet,
+# one at a time and in one batch per chain.
+#
+# usage: bench_bip32.py [num_addresses]
+
+import sys
+import time
+
+from actilectrum import keystore
+from actilectrum.bip32 import BIP32Node
+
+
+def measure(name, func):
+    t0 = time.perf_counter()
+    result = func()
+    dt = time.perf_counter() - t0
+    print(f"{name}: {1000 * dt:.1f} ms")
+    return result
+
+
+def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    xpub = BIP32Node.from_rootseed(b'\x01' * 32, xtype='p2wpkh').subkey_at_private_derivation("m/84'/0'/0'").to_xpub()
+    node = BIP32Node.from_xkey(xpub).subkey_at_public_derivation([0])
+    one_at_a_time = measure(f'{num_addresses} pubkeys, one at a time', lambda: [
+        node.subkey_at_public_derivation([i]).eckey.get_public_key_bytes(compressed=True)
+        for i in range(num_addresses)])
+    batch = measure(f'{num_addresses} pubkeys, in one batch',
+                    lambda: node.child_pubkeys_at_public_derivation(0, num_addresses))
+    assert one_at_a_time == batch
+    ks = keystore.from_master_key(xpub)
+    measure(f'{num_addresses} pubkeys, keystore', lambda: ks.derive_pubkeys_range(1, 0, num_addresses))
+
+
+if __name__ == '__main__':
+    main()
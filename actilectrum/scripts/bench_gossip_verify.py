@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+# Measures the verification of gossip signatures by GossipSignatureVerifier,
+# and how long the event loop is blocked meanwhile.
+#
+# usage: bench_gossip_verify.py [num_msgs]
+
+import asyncio
+import os
+import sys
+import time
+
+from actilectrum import ecc
+from actilectrum.crypto import sha256d
+from actilectrum.lnmsg import encode_msg, decode_msg
+from actilectrum.lnverifier import GossipSignatureVerifier
+from actilectrum.util import chunks
+
+
+def make_msgs(num_msgs: int):
+    keys = [ecc.ECPrivkey(os.urandom(32)) for _ in range(4)]
+    pubkeys = [key.get_public_key_bytes() for key in keys]
+    msgs = []
+    for i in range(num_msgs):
+        fields = dict(len=0,
+                      features=b'',
+                      chain_hash=bytes(32),
+                      short_channel_id=i.to_bytes(8, 'big'),
+                      node_id_1=pubkeys[0],
+                      node_id_2=pubkeys[1],
+                      bitcoin_key_1=pubkeys[2],
+                      bitcoin_key_2=pubkeys[3])
+        h = sha256d(encode_msg('channel_announcement', **fields)[2+256:])
+        sigs = [key.sign(h, ecc.sig_string_from_r_and_s) for key in keys]
+        raw = encode_msg('channel_announcement',
+                         node_signature_1=sigs[0],
+                         node_signature_2=sigs[1],
+                         bitcoin_signature_1=sigs[2],
+                         bitcoin_signature_2=sigs[3],
+                         **fields)
+        payload = decode_msg(raw)[1]
+        payload['raw'] = raw
+        msgs.append(payload)
+    return msgs
+
+
+async def verify(verifier: GossipSignatureVerifier, msgs):
+    # as in Peer.process_gossip
+    max_delay = 0
+    async def ticker():
+        nonlocal max_delay
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_delay = max(max_delay, time.perf_counter() - t - 0.001)
+    ticker_task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0.01)
+    t0 = time.perf_counter()
+    for chan_anns_chunk in chunks(msgs, 300):
+        if verifier is None:
+            for payload in chan_anns_chunk:
+                h = sha256d(payload['raw'][2+256:])
+                for pubkey, sig in ((payload['node_id_1'], payload['node_signature_1']),
+                                    (payload['node_id_2'], payload['node_signature_2']),
+                                    (payload['bitcoin_key_1'], payload['bitcoin_signature_1']),
+                                    (payload['bitcoin_key_2'], payload['bitcoin_signature_2'])):
+                    assert ecc.verify_signature(pubkey, sig, h)
+        else:
+            assert await verifier.verify_channel_announcements(chan_anns_chunk)
+    t = time.perf_counter() - t0
+    await asyncio.sleep(0.01)
+    ticker_task.cancel()
+    return t, max_delay
+
+
+def main():
+    num_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    msgs = make_msgs(num_msgs)
+    loop = asyncio.get_event_loop()
+    print(f"{os.cpu_count()} cpus, {num_msgs} channel announcements")
+    for num_threads in (None, 1, 2, 4):
+        verifier = GossipSignatureVerifier({'gossip_verify_threads': num_threads}) if num_threads else None
+        t, max_delay = loop.run_until_complete(verify(verifier, msgs))
+        name = f"{num_threads} threads" if num_threads else "event loop"
+        print(f"{name:>10}: {num_msgs / t:.0f} msg/s, event loop blocked for up to {1000 * max_delay:.1f} ms")
+        if verifier:
+            verifier.executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
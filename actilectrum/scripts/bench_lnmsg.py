@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Measures lnmsg.decode_msg on gossip messages.
+# The messages are read from a gossip_db, if one is given,
+# otherwise random channel announcements and updates are generated.
+#
+# usage: bench_lnmsg.py [gossip_db_path | num_msgs]
+
+import os
+import sqlite3
+import sys
+import time
+
+from actilectrum.lnmsg import encode_msg, decode_msg
+
+
+def load_msgs(path: str):
+    conn = sqlite3.connect(path)
+    msgs = []
+    for table in ('channel_info', 'node_info', 'policy'):
+        msgs += [bytes(msg) for _, msg in conn.execute(f"SELECT * FROM {table}")]
+    conn.close()
+    return msgs
+
+
+def make_msgs(num_msgs: int):
+    msgs = []
+    for i in range(num_msgs):
+        if i % 3 == 0:
+            msgs.append(encode_msg(
+                'channel_announcement',
+                node_signature_1=os.urandom(64),
+                node_signature_2=os.urandom(64),
+                bitcoin_signature_1=os.urandom(64),
+                bitcoin_signature_2=os.urandom(64),
+                len=2,
+                features=b'\x00\x00',
+                chain_hash=os.urandom(32),
+                short_channel_id=os.urandom(8),
+                node_id_1=os.urandom(33),
+                node_id_2=os.urandom(33),
+                bitcoin_key_1=os.urandom(33),
+                bitcoin_key_2=os.urandom(33)))
+        else:
+            msgs.append(encode_msg(
+                'channel_update',
+                signature=os.urandom(64),
+                chain_hash=os.urandom(32),
+                short_channel_id=os.urandom(8),
+                timestamp=i,
+                message_flags=b'\x01',
+                channel_flags=bytes([i % 2]),
+                cltv_expiry_delta=144,
+                htlc_minimum_msat=1000,
+                fee_base_msat=1000,
+                fee_proportional_millionths=1,
+                htlc_maximum_msat=10**10))
+    return msgs
+
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else '300000'
+    if os.path.exists(arg):
+        msgs = load_msgs(arg)
+    else:
+        msgs = make_msgs(int(arg))
+    t0 = time.perf_counter()
+    for msg in msgs:
+        decode_msg(msg)
+    t = time.perf_counter() - t0
+    print(f"decoded {len(msgs)} messages in {t:.3f}s ({len(msgs) / t:.0f} msg/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# Measures LNPathFinder.find_path_for_payment on a random channel graph,
+# and payments retried after failures, with find_path_for_payment and with
+# find_paths_for_payment.
+#
+# usage: bench_lnrouter.py [num_channels]
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from actilectrum.channel_db import ChannelDB
+from actilectrum.lnrouter import LNPathFinder
+from actilectrum.simple_config import SimpleConfig
+from actilectrum.util import create_and_start_event_loop
+
+
+NUM_PAYMENTS = 100
+NUM_ATTEMPTS = 10
+# channels that fail payments, in the retries
+FAILURE_RATE = 0.2
+
+
+def make_graph(cdb: ChannelDB, num_channels: int):
+    num_nodes = num_channels // 5
+    node_ids = [b'\x02' + os.urandom(32) for _ in range(num_nodes)]
+    for i in range(num_channels):
+        # a few well connected nodes, as in the real graph
+        n1 = node_ids[int(random.paretovariate(1)) % num_nodes]
+        n2 = random.choice(node_ids)
+        if n1 == n2:
+            continue
+        n1, n2 = sorted([n1, n2])
+        scid = i.to_bytes(8, 'big')
+        cdb.add_verified_channel_info({
+            'short_channel_id': scid,
+            'node_id_1': n1,
+            'node_id_2': n2,
+            'features': b'',
+        }, capacity_sat=random.randint(10**5, 10**7))
+        for direction in (0, 1):
+            cdb.add_channel_update({
+                'short_channel_id': scid,
+                'message_flags': b'\x01',
+                'channel_flags': bytes([direction]),
+                'cltv_expiry_delta': random.choice([40, 144]),
+                'htlc_minimum_msat': 1000,
+                'htlc_maximum_msat': 10**10,
+                'fee_base_msat': random.choice([0, 1000]),
+                'fee_proportional_millionths': random.randint(1, 1000),
+                'timestamp': 0,
+            }, verbose=False)
+    return node_ids
+
+
+def main():
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    user_dir = tempfile.mkdtemp()
+    class FakeNetwork:
+        config = SimpleConfig({'actilectrum_path': user_dir})
+        asyncio_loop = loop
+        interface = None
+    cdb = ChannelDB(FakeNetwork())
+    try:
+        cdb.data_loaded.set()
+        random.seed(0)
+        node_ids = make_graph(cdb, num_channels)
+        path_finder = LNPathFinder(cdb)
+        num_found = 0
+        t0 = time.perf_counter()
+        for _ in range(NUM_PAYMENTS):
+            node_a, node_b = random.sample(node_ids, 2)
+            if path_finder.find_path_for_payment(node_a, node_b, 100_000_000):
+                num_found += 1
+        t = time.perf_counter() - t0
+        print(f"{len(cdb._channels)} channels: found {num_found}/{NUM_PAYMENTS} paths, "
+              f"{1000 * t / NUM_PAYMENTS:.1f} ms per payment")
+        failing_channels = {scid for scid in cdb._channels if random.random() < FAILURE_RATE}
+        pairs = [random.sample(node_ids, 2) for _ in range(NUM_PAYMENTS)]
+        for name, find_paths in [
+                ('find_path_for_payment', lambda a, b: iter(lambda: path_finder.find_path_for_payment(a, b, 100_000_000), None)),
+                ('find_paths_for_payment', lambda a, b: path_finder.find_paths_for_payment(a, b, 100_000_000))]:
+            num_succeeded = 0
+            num_attempts = 0
+            t0 = time.perf_counter()
+            for node_a, node_b in pairs:
+                path_finder.mission_control.clear()
+                paths = find_paths(node_a, node_b)
+                for _ in range(NUM_ATTEMPTS):
+                    path = next(paths, None)
+                    if path is None:
+                        # as LNWallet._pay, search again
+                        paths = find_paths(node_a, node_b)
+                        path = next(paths, None)
+                        if path is None:
+                            break
+                    num_attempts += 1
+                    route = path_finder.create_route_from_path(path, node_a)
+                    # the first edge would be our own channel
+                    failed_edges = [i for i, edge in enumerate(route)
+                                    if i > 0 and edge.short_channel_id in failing_channels]
+                    if not failed_edges:
+                        num_succeeded += 1
+                        break
+                    path_finder.mission_control.report_failure(route, 100_000_000, failed_edges[0])
+            t = time.perf_counter() - t0
+            print(f"retries with {name}: {num_succeeded}/{NUM_PAYMENTS} payments succeeded "
+                  f"in {num_attempts} attempts, {1000 * t / NUM_PAYMENTS:.1f} ms per payment")
+    finally:
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join()
+        cdb.sql_thread.join()
+        shutil.rmtree(user_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# Measures the throughput of the BOLT-8 transport over a local socket,
+# with messages of the size of gossip, and of replies to channel range queries.
+#
+# usage: bench_lntransport.py [num_messages]
+
+import asyncio
+import os
+import sys
+import time
+from typing import List
+
+from actilectrum.ecc import ECPrivkey
+from actilectrum.lnutil import LNPeerAddr
+from actilectrum.lntransport import LNResponderTransport, LNTransport
+
+
+# channel_update, channel_announcement, node_announcement
+GOSSIP_SIZES = [136, 136, 136, 430, 150]
+# reply_channel_range with 8000 ids
+REPLY_SIZES = [64100]
+
+
+async def bench(name: str, message_sizes: List[int], num_messages: int):
+    responder_key = ECPrivkey.generate_random_key()
+    initiator_key = ECPrivkey.generate_random_key()
+    messages = [os.urandom(message_sizes[i % len(message_sizes)]) for i in range(num_messages)]
+    received = asyncio.Future()
+
+    async def on_connection(reader, writer):
+        t = LNResponderTransport(responder_key.get_secret_bytes(), reader, writer)
+        await t.handshake()
+        num_bytes = 0
+        messages_iter = t.read_messages()
+        for _ in range(num_messages):
+            num_bytes += len(await messages_iter.__anext__())
+        received.set_result(num_bytes)
+
+    server = await asyncio.start_server(on_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        peer_addr = LNPeerAddr('127.0.0.1', port, responder_key.get_public_key_bytes())
+        t = LNTransport(initiator_key.get_secret_bytes(), peer_addr, proxy=None)
+        await t.handshake()
+        t0 = time.perf_counter()
+        # as a peer sends the reply to a gossip query
+        for i in range(0, num_messages, 100):
+            for msg in messages[i:i+100]:
+                t.send_bytes(msg)
+            await t.writer.drain()
+        num_bytes = await received
+        dt = time.perf_counter() - t0
+        print(f"{name}: {num_messages} messages, {num_bytes / 2**20:.1f} MiB in {dt:.2f} s: "
+              f"{num_messages / dt:.0f} msg/s, {num_bytes / 2**20 / dt:.1f} MiB/s")
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench('gossip', GOSSIP_SIZES, num_messages))
+    loop.run_until_complete(bench('replies', REPLY_SIZES, num_messages // 20))
+
+
+if __name__ == '__main__':
+    main()
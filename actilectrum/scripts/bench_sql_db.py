@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# Measures the write throughput of ChannelDB (policies) and of
+# SweepStore (watchtower sweep txs), through their sql thread.
+#
+# usage: bench_sql_db.py [num_writes]
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from actilectrum.channel_db import ChannelDB
+from actilectrum.lnwatcher import SweepStore
+from actilectrum.simple_config import SimpleConfig
+from actilectrum.util import create_and_start_event_loop
+
+
+def wait_all(futures):
+    for fut in futures:
+        while not fut.done():
+            time.sleep(0.001)
+        fut.result()
+
+
+def bench(name, num_writes, write):
+    t0 = time.perf_counter()
+    wait_all([write(i) for i in range(num_writes)])
+    t = time.perf_counter() - t0
+    print(f"{name}: {num_writes} writes in {t:.2f} s, {num_writes / t:.0f} writes/s")
+
+
+def main():
+    num_writes = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    while not loop.is_running():
+        time.sleep(0.01)
+    user_dir = tempfile.mkdtemp()
+    class FakeNetwork:
+        config = SimpleConfig({'actilectrum_path': user_dir})
+        asyncio_loop = loop
+        interface = None
+    cdb = ChannelDB(FakeNetwork())
+    sweepstore = SweepStore(os.path.join(user_dir, 'watchtower_db'), FakeNetwork())
+    # a complete tx, its content does not matter here
+    raw_tx = ('0200000001' + '00' * 32 + '00000000' + '00' + 'ffffffff'
+              + '01' + '00' * 8 + '00' + '00000000')
+    try:
+        bench('ChannelDB', num_writes,
+              lambda i: cdb._db_save_policy(i.to_bytes(8, 'big') + b'\x02' * 33, os.urandom(136)))
+        bench('SweepStore', min(num_writes, 1000),
+              lambda i: sweepstore.add_sweep_tx(f'{i:064x}:0', i, f'{i:064x}:1', raw_tx))
+    finally:
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join()
+        cdb.sql_thread.join()
+        sweepstore.sql_thread.join()
+        shutil.rmtree(user_dir)
+
+
+if __name__ == '__main__':
+    main()
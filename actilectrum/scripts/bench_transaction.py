@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Measures signing, parsing and txid of a large transaction,
+# signing a sweep of many legacy inputs,
+# and the memory used by the transactions of a large wallet.
+#
+# usage: bench_transaction.py [num_inputs] [num_wallet_txs] [num_sweep_inputs] [num_threads]
+
+import os
+import sys
+import time
+import tracemalloc
+
+from actilectrum import bitcoin, ecc
+from actilectrum.transaction import (Transaction, PartialTransaction, PartialTxInput, PartialTxOutput,
+                                     TxOutpoint, tx_from_any)
+
+
+def make_tx(num_inputs: int, script_type: str = 'p2wpkh', num_outputs: int = None) -> PartialTransaction:
+    keypairs = {}
+    inputs = []
+    for i in range(num_inputs):
+        privkey = ecc.ECPrivkey.generate_random_key()
+        pubkey = privkey.get_public_key_bytes(compressed=True)
+        keypairs[pubkey.hex()] = (privkey.get_secret_bytes(), True)
+        txin = PartialTxInput(prevout=TxOutpoint(txid=os.urandom(32), out_idx=i % 4))
+        txin.script_type = script_type
+        txin.pubkeys = [pubkey]
+        txin.num_sig = 1
+        txin._trusted_value_sats = 100_000
+        inputs.append(txin)
+    outputs = [PartialTxOutput(scriptpubkey=bytes.fromhex(bitcoin.address_to_script(
+                   bitcoin.pubkey_to_address('p2wpkh', list(keypairs)[i]))), value=90_000)
+               for i in range(num_inputs if num_outputs is None else num_outputs)]
+    tx = PartialTransaction.from_io(inputs, outputs, locktime=0)
+    tx.keypairs = keypairs
+    return tx
+
+
+def measure(name, func, repeat=1):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    dt = (time.perf_counter() - t0) / repeat
+    print(f"{name}: {1000 * dt:.1f} ms")
+    return result
+
+
+def main():
+    num_inputs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_wallet_txs = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    num_sweep_inputs = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    num_threads = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+
+    tx = make_tx(num_inputs)
+    measure(f'sign ({num_inputs} inputs)', lambda: tx.sign(tx.keypairs))
+    assert tx.is_complete()
+    raw = tx.serialize()
+    def parse():
+        tx = Transaction(raw)
+        tx.deserialize()
+        return tx
+    measure(f'parse ({len(raw) // 2} bytes)', parse, repeat=10)
+    measure('txid', lambda: Transaction(raw).txid(), repeat=10)
+    measure('serialize', lambda: parse().serialize_to_network(), repeat=10)
+
+    # legacy sighashes cover all the inputs
+    sweep_tx = make_tx(num_sweep_inputs, 'p2pkh', num_outputs=1)
+    sweep_tx2 = make_tx(num_sweep_inputs, 'p2pkh', num_outputs=1)
+    measure(f'sign sweep ({num_sweep_inputs} p2pkh inputs)', lambda: sweep_tx.sign(sweep_tx.keypairs))
+    measure(f'sign sweep ({num_threads} threads)',
+            lambda: sweep_tx2.sign(sweep_tx2.keypairs, num_threads=num_threads))
+    assert sweep_tx.is_complete() and sweep_tx2.is_complete()
+
+    # a wallet of small transactions, as loaded by WalletDB
+    small_tx = make_tx(2)
+    small_tx.sign(small_tx.keypairs)
+    small_raw = small_tx.serialize()
+    # with distinct prevouts
+    raws = [small_raw[:14] + os.urandom(32).hex() + small_raw[78:] for _ in range(num_wallet_txs)]
+    tracemalloc.start()
+    txs = {i: tx_from_any(raw, deserialize=False) for i, raw in enumerate(raws)}
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{len(txs)} wallet txs ({len(small_raw) // 2} bytes): {size / 2**20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
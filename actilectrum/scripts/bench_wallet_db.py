@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Measures get_balance and get_history on synthetic wallets of growing size,
+# alone, and while another thread keeps updating the db, as during a sync.
+#
+# usage: bench_wallet_db.py [max_num_txs]
+
+import os
+import sys
+import threading
+import time
+
+from actilectrum.address_synchronizer import AddressSynchronizer
+from actilectrum.util import TxMinedInfo
+from actilectrum.wallet_db import WalletDB
+
+
+NUM_ADDRESSES = 1000
+NUM_ROUNDS = 5
+
+
+def make_db(num_txs: int) -> WalletDB:
+    db = WalletDB('', manual_upgrades=False)
+    history = {}
+    for i in range(num_txs):
+        txid = os.urandom(32).hex()
+        addr = f'addr{i % NUM_ADDRESSES}'
+        height = 100000 + i // 10
+        db.add_txo_addr(txid, addr, 0, 100000, False)
+        if i >= NUM_ADDRESSES:
+            # spend the previous output of that address
+            prev_txid = history[addr][-1][0]
+            db.add_txi_addr(txid, addr, prev_txid + ':0', 100000)
+        db.add_verified_tx(txid, TxMinedInfo(height=height, timestamp=1500000000 + i, txpos=i % 10,
+                                             header_hash='00' * 32))
+        history.setdefault(addr, []).append((txid, height))
+    for addr, hist in history.items():
+        db.set_addr_history(addr, hist)
+    db.put('stored_height', 100000 + num_txs // 10)
+    return db
+
+
+class Syncer(threading.Thread):
+    """Keeps changing the db, and serializing it now and then."""
+
+    def __init__(self, db: WalletDB):
+        threading.Thread.__init__(self, daemon=True)
+        self.db = db
+        self.stopped = False
+        self.num_updates = 0
+
+    def run(self):
+        while not self.stopped:
+            txid = os.urandom(32).hex()
+            self.db.add_verified_tx(txid, TxMinedInfo(height=1, timestamp=1, txpos=0, header_hash='00' * 32))
+            self.db.remove_verified_tx(txid)
+            self.num_updates += 1
+            if self.num_updates % 1000 == 0:
+                self.db.dump()
+
+
+def timed(f) -> float:
+    best = None
+    for _ in range(NUM_ROUNDS):
+        t0 = time.perf_counter()
+        f()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+def bench(adb: AddressSynchronizer):
+    def get_balance():
+        adb._clear_addr_caches()
+        adb.get_balance()
+    return timed(get_balance), timed(adb.get_history)
+
+
+def main():
+    max_num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{'txs':>8} {'balance':>10} {'history':>10} {'balance*':>10} {'history*':>10}  (* while syncing)")
+    num_txs = 1000
+    while num_txs <= max_num_txs:
+        db = make_db(num_txs)
+        adb = AddressSynchronizer(db)
+        balance, history = bench(adb)
+        syncer = Syncer(db)
+        syncer.start()
+        balance2, history2 = bench(adb)
+        syncer.stopped = True
+        syncer.join()
+        print(f"{num_txs:>8} {balance:>9.3f}s {history:>9.3f}s {balance2:>9.3f}s {history2:>9.3f}s", flush=True)
+        num_txs *= 10
+
+
+if __name__ == '__main__':
+    main()
@@ -17,13 +17,28 @@ def sql(func):
         return f
     return wrapper
 
+
+def sql_rows(func):
+    """wrapper for sql methods that write one row per call.
+    Consecutive calls are run together: func is called once,
+    with the list of the args of each call, so that it can use executemany.
+    """
+    func.takes_rows = True
+    return sql(func)
+
+
 class SqlDB(Logger):
-    
-    def __init__(self, asyncio_loop, path, commit_interval=None):
+
+    # set per database, see https://sqlite.org/pragma.html
+    JOURNAL_MODE = 'WAL'
+    SYNCHRONOUS = 'FULL'
+    # max number of requests run in one transaction
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, asyncio_loop, path):
         Logger.__init__(self)
         self.asyncio_loop = asyncio_loop
         self.path = path
-        self.commit_interval = commit_interval
         self.db_requests = queue.Queue()
         self.sql_thread = threading.Thread(target=self.run_sql)
         self.sql_thread.start()
@@ -31,31 +46,78 @@ class SqlDB(Logger):
     def run_sql(self):
         self.logger.info("SQL thread started")
         self.conn = sqlite3.connect(self.path)
+        self.conn.execute(f"PRAGMA journal_mode={self.JOURNAL_MODE}")
+        self.conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS}")
         self.logger.info("Creating database")
         self.create_database()
-        i = 0
         while self.asyncio_loop.is_running():
             try:
-                future, func, args, kwargs = self.db_requests.get(timeout=0.1)
+                requests = [self.db_requests.get(timeout=0.1)]
             except queue.Empty:
                 continue
-            try:
-                result = func(self, *args, **kwargs)
-            except BaseException as e:
-                future.set_exception(e)
-                continue
-            if not future.cancelled():
-                future.set_result(result)
-            # note: in sweepstore session.commit() is called inside
-            # the sql-decorated methods, so commiting to disk is awaited
-            if self.commit_interval:
-                i = (i + 1) % self.commit_interval
-                if i == 0:
-                    self.conn.commit()
+            while len(requests) < self.MAX_BATCH_SIZE:
+                try:
+                    requests.append(self.db_requests.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(requests)
         # write
         self.conn.commit()
         self.conn.close()
         self.logger.info("SQL thread terminated")
 
+    def _run_batch(self, requests):
+        """Runs the requests in one transaction. Their futures are
+        resolved after the commit, so that awaiting a write means it is on disk.
+        """
+        outcomes = []  # (future, result, exception)
+        self._begin()
+        i = 0
+        while i < len(requests):
+            future, func, args, kwargs = requests[i]
+            if getattr(func, 'takes_rows', False):
+                group = [requests[i]]
+                while i + len(group) < len(requests) and requests[i + len(group)][1] is func:
+                    group.append(requests[i + len(group)])
+                i += len(group)
+                e = self._run_rows(func, [r[2] for r in group])
+                outcomes += [(r[0], None, e) for r in group]
+            else:
+                i += 1
+                try:
+                    outcomes.append((future, func(self, *args, **kwargs), None))
+                except BaseException as e:
+                    outcomes.append((future, None, e))
+        try:
+            self.conn.commit()
+        except BaseException as e:
+            outcomes = [(future, None, exc or e) for future, result, exc in outcomes]
+        for future, result, e in outcomes:
+            if future.cancelled():
+                continue
+            if e is not None:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _begin(self):
+        # sqlite3 only opens a transaction by itself before INSERT, UPDATE, etc.
+        # A SAVEPOINT outside of one would start and commit a transaction of its own.
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+
+    def _run_rows(self, func, rows):
+        # a failed group is rolled back, without the other requests in the batch
+        self._begin()  # in case an earlier request committed
+        self.conn.execute("SAVEPOINT rows")
+        try:
+            func(self, rows)
+        except BaseException as e:
+            self.conn.execute("ROLLBACK TO rows")
+            self.conn.execute("RELEASE rows")
+            return e
+        self.conn.execute("RELEASE rows")
+        return None
+
     def create_database(self):
         raise NotImplementedError()
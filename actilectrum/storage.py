@@ -70,6 +70,10 @@ class WalletStorage(Logger):
         else:
             self.raw = ''
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        # size of the file, and its size when we last wrote all of it.
+        # changes get appended in between, until the file gets rewritten.
+        self.pos = self.init_pos = os.path.getsize(self.path) if self.file_exists() else 0
+        self._file_pubkey = None  # pubkey the contents of the file are encrypted to
 
     def read(self):
         return self.decrypted if self.is_encrypted() else self.raw
@@ -112,8 +116,47 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self.pos = self.init_pos = os.path.getsize(self.path)
+        self._file_pubkey = self.pubkey
         self.logger.info(f"saved {self.path}")
 
+    @profiler
+    def append(self, data):
+        """Appends data to what we last wrote. Encrypted data gets
+        encrypted on its own, and goes on a new line.
+        """
+        assert not self.needs_consolidation()
+        s = self.encrypt_before_writing(data)
+        if self.pubkey:
+            s = '\n' + s
+        with open(self.path, "a", encoding='utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        self.pos = os.path.getsize(self.path)
+
+    def has_appended_data(self) -> bool:
+        """Whether changes were appended since we last wrote all of the file."""
+        return self.pos != self.init_pos
+
+    def needs_consolidation(self) -> bool:
+        """Whether the next write has to rewrite the file, instead of
+        appending to it.
+        """
+        if not self.file_exists():
+            return True
+        if self.pubkey != self._file_pubkey:
+            # e.g. the password was changed
+            return True
+        try:
+            if os.path.getsize(self.path) != self.pos:
+                self.logger.info(f"{self.path} was changed by someone else")
+                return True
+        except OSError:
+            return True
+        # do not let the file grow to more than twice its size
+        return self.pos - self.init_pos > self.init_pos
+
     def file_exists(self) -> bool:
         return self._file_exists
 
@@ -152,7 +195,8 @@ class WalletStorage(Logger):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            # changes appended to an encrypted file are on their own lines
+            magic = base64.b64decode(self.raw.split('\n', 1)[0])[0:4]
             if magic == b'BIE1':
                 return StorageEncryptionVersion.USER_PASSWORD
             elif magic == b'BIE2':
@@ -183,11 +227,27 @@ class WalletStorage(Logger):
         ec_key = self.get_eckey_from_password(password)
         if self.raw:
             enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
+            first, *appended = self.raw.split('\n')
+            s = zlib.decompress(ec_key.decrypt_message(first, enc_magic))
             s = s.decode('utf8')
+            complete = True
+            for i, c in enumerate(appended):
+                if not c:
+                    continue
+                try:
+                    c = zlib.decompress(ec_key.decrypt_message(c, enc_magic))
+                except Exception:
+                    # we might have crashed while appending
+                    self.logger.info(f"ignoring {len(appended) - i} undecryptable change(s) at the end of file")
+                    complete = False
+                    break
+                s += c.decode('utf8')
         else:
             s = ''
+            complete = True
         self.pubkey = ec_key.get_public_key_hex()
+        # we must not append after garbage
+        self._file_pubkey = self.pubkey if complete else None
         self.decrypted = s
 
     def encrypt_before_writing(self, plaintext: str) -> str:
@@ -0,0 +1,107 @@
+import asyncio
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from actilectrum import constants, ecc
+from actilectrum.channel_db import ChannelDB
+from actilectrum.crypto import sha256d
+from actilectrum.lnmsg import encode_msg, decode_msg
+from actilectrum.simple_config import SimpleConfig
+
+from . import ElectrumTestCase
+
+
+# node ids are sorted in channel announcements
+NODE_KEYS = sorted((ecc.ECPrivkey(bytes([i]) * 32) for i in range(1, 5)),
+                   key=lambda key: key.get_public_key_bytes())
+NODE_IDS = [key.get_public_key_bytes() for key in NODE_KEYS]
+
+
+def channel_announcement(scid: int, node1: ecc.ECPrivkey, node2: ecc.ECPrivkey, *, valid=True) -> dict:
+    """The node keys are also the bitcoin keys of the channel."""
+    fields = dict(len=0,
+                  features=b'',
+                  chain_hash=constants.net.rev_genesis_bytes(),
+                  short_channel_id=scid.to_bytes(8, 'big'),
+                  node_id_1=node1.get_public_key_bytes(),
+                  node_id_2=node2.get_public_key_bytes(),
+                  bitcoin_key_1=node1.get_public_key_bytes(),
+                  bitcoin_key_2=node2.get_public_key_bytes())
+    h = sha256d(encode_msg('channel_announcement', **fields)[2+256:])
+    if not valid:
+        h = sha256d(h)
+    sigs = [key.sign(h, ecc.sig_string_from_r_and_s) for key in (node1, node2, node1, node2)]
+    raw = encode_msg('channel_announcement',
+                     node_signature_1=sigs[0],
+                     node_signature_2=sigs[1],
+                     bitcoin_signature_1=sigs[2],
+                     bitcoin_signature_2=sigs[3],
+                     **fields)
+    payload = decode_msg(raw)[1]
+    payload['raw'] = raw
+    return payload
+
+
+def channel_update(scid: int, direction: int, *, timestamp: int = None, fee_base_msat=1000) -> dict:
+    raw = encode_msg('channel_update',
+                     chain_hash=constants.net.rev_genesis_bytes(),
+                     short_channel_id=scid.to_bytes(8, 'big'),
+                     timestamp=int(time.time()) if timestamp is None else timestamp,
+                     message_flags=b'\x01',
+                     channel_flags=bytes([direction]),
+                     cltv_expiry_delta=144,
+                     htlc_minimum_msat=1000,
+                     fee_base_msat=fee_base_msat,
+                     fee_proportional_millionths=10,
+                     htlc_maximum_msat=10**9)
+    payload = decode_msg(raw)[1]
+    payload['raw'] = raw
+    return payload
+
+
+def node_announcement(node_id: bytes, alias: bytes) -> dict:
+    raw = encode_msg('node_announcement',
+                     flen=1,
+                     features=b'\x02',
+                     timestamp=int(time.time()),
+                     node_id=node_id,
+                     rgb_color=b'\x00' * 3,
+                     alias=alias.ljust(32, b'\x00'),
+                     addrlen=0,
+                     addresses=b'')
+    payload = decode_msg(raw)[1]
+    payload['raw'] = raw
+    return payload
+
+
+class FakeNetwork:
+
+    def __init__(self, user_dir: str, asyncio_loop: asyncio.AbstractEventLoop):
+        self.config = SimpleConfig({'actilectrum_path': user_dir})
+        self.asyncio_loop = asyncio_loop
+        self.interface = None
+
+
+class ChannelDBTestCase(ElectrumTestCase):
+    """Tests with self.cdb, the ChannelDB of self.network.
+    Its event loop is not running, so the sql thread exits: the db is not saved.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.loop = asyncio.get_event_loop()
+        self.network = FakeNetwork(self.user_dir, self.loop)
+        self.cdb = ChannelDB(self.network)
+        self.cdb.sql_thread.join()
+        self.cdb.data_loaded.set()
+        self.network.channel_db = self.cdb
+        patcher = mock.patch('actilectrum.util.trigger_callback')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.user_dir)
+        super().tearDown()
@@ -467,6 +467,16 @@ class Test_xprv_xpub(ElectrumTestCase):
         self.assertEqual("xpub6FnCn6nSzZAw5Tw7cgR9bi15UV96gLZhjDstkXXxvCLsUXBGXPdSnLFbdpq8p9HmGsApME5hQTZ3emM2rnY5agb9rXpVGyy3bdW6EEgAtqt", xpub)
         self.assertEqual("xprvA2nrNbFZABcdryreWet9Ea4LvTJcGsqrMzxHx98MMrotbir7yrKCEXw7nadnHM8Dq38EGfSh6dqA9QWTyefMLEcBYJUuekgW4BYPJcr9E7j", xprv)
 
+    def test_child_pubkeys_at_public_derivation(self):
+        node = BIP32Node.from_xkey(self.xprv_xpub[0]['xpub'])
+        pubkeys = node.child_pubkeys_at_public_derivation(5, 20)
+        self.assertEqual([node.subkey_at_public_derivation([i]).eckey.get_public_key_bytes(compressed=True)
+                          for i in range(5, 25)],
+                         pubkeys)
+        self.assertEqual([], node.child_pubkeys_at_public_derivation(5, 0))
+        with self.assertRaises(Exception):
+            node.child_pubkeys_at_public_derivation(bip32.BIP32_PRIME - 1, 2)
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         for xprv_details in self.xprv_xpub:
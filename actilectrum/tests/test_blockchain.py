@@ -1,6 +1,7 @@
 import shutil
 import tempfile
 import os
+from unittest import mock
 
 from actilectrum import constants, blockchain
 from actilectrum.simple_config import SimpleConfig
@@ -337,6 +338,289 @@ class TestBlockchain(ElectrumTestCase):
             self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
 
 
+class TestHeadersFile(ElectrumTestCase):
+
+    HEADERS = TestBlockchain.HEADERS
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'actilectrum_path': self.data_dir})
+        blockchain.blockchains = {}
+        blockchain.blockchains[constants.net.GENESIS] = self.chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(self.chain.path(), 'w+').close()
+
+    def test_read_header_after_appending(self):
+        chain = self.chain
+        self.assertEqual(None, chain.read_header(0))
+        for name in 'ABCDEF':
+            chain.save_header(self.HEADERS[name])
+            # reading in between forces the file to be mapped again after growing
+            self.assertEqual(self.HEADERS[name], chain.read_header(chain.height()))
+        for name in 'ABCDEF':
+            header = self.HEADERS[name]
+            self.assertEqual(header, chain.read_header(header['block_height']))
+        self.assertEqual(None, chain.read_header(6))
+        self.assertEqual(None, chain.read_header(-1))
+
+    def test_read_header_after_truncating(self):
+        chain = self.chain
+        for name in 'ABCDEFOPQ':
+            chain.save_header(self.HEADERS[name])
+        self.assertEqual(self.HEADERS['Q'], chain.read_header(8))
+        chain.write(bfh(blockchain.serialize_header(self.HEADERS['G'])), 6 * 80)
+        self.assertEqual(6, chain.height())
+        self.assertEqual(self.HEADERS['G'], chain.read_header(6))
+        self.assertEqual(None, chain.read_header(7))
+        self.assertEqual(7 * 80, os.stat(chain.path()).st_size)
+
+    def test_zeroed_header_reads_as_missing(self):
+        chain = self.chain
+        chain.save_header(self.HEADERS['A'])
+        chain.write(bytes(80), 80)
+        chain.save_header(self.HEADERS['C'])
+        self.assertEqual(self.HEADERS['A'], chain.read_header(0))
+        self.assertEqual(None, chain.read_header(1))
+        self.assertEqual(self.HEADERS['C'], chain.read_header(2))
+
+
+    def _assert_hash_index_consistent(self, chain: Blockchain):
+        # note: get_hash(0) is always the genesis hash
+        for height in range(1, chain.height() + 1):
+            header = chain.read_header(height)
+            if header is None:
+                with self.assertRaises(blockchain.MissingHeader):
+                    chain.get_hash(height)
+            else:
+                self.assertEqual(hash_header(header), chain.get_hash(height))
+        with open(chain.hashes_path(), 'rb') as f:
+            self.assertEqual(chain.size() * 32, len(f.read()))
+
+    def test_invalid_fork_is_deleted_after_unmapping(self):
+        chain_u = self.chain
+        for name in 'ABCDEFOP':
+            chain_u.save_header(self.HEADERS[name])
+        chain_g = chain_u.fork(self.HEADERS['G'])
+        fork_path = chain_g.path()
+        chain_g.close_mmaps()
+        # the file no longer starts with the header it is named after
+        with open(fork_path, 'wb') as f:
+            f.write(bfh(blockchain.serialize_header(self.HEADERS['O'])))
+        blockchain.blockchains = {}
+
+        events = []
+        get_headers_mmap = Blockchain._get_headers_mmap
+        def record_get_headers_mmap(chain):
+            events.append(('mmap', chain.path()))
+            return get_headers_mmap(chain)
+        close_mmaps = Blockchain.close_mmaps
+        def record_close_mmaps(chain):
+            events.append(('close_mmaps', chain.path()))
+            close_mmaps(chain)
+        unlink = os.unlink
+        def record_unlink(path):
+            events.append(('unlink', path))
+            unlink(path)
+        with mock.patch.object(Blockchain, '_get_headers_mmap', record_get_headers_mmap), \
+                mock.patch.object(Blockchain, 'close_mmaps', record_close_mmaps), \
+                mock.patch('os.unlink', record_unlink):
+            blockchain.read_blockchains(self.config)
+        self.assertFalse(os.path.exists(fork_path))
+        self.assertEqual([constants.net.GENESIS], list(blockchain.blockchains))
+        fork_events = [event for event, path in events if path == fork_path]
+        self.assertEqual(['mmap', 'close_mmaps', 'unlink'], fork_events[-3:])
+
+    def test_hash_index_follows_writes(self):
+        chain = self.chain
+        for name in 'ABCDEFOPQ':
+            chain.save_header(self.HEADERS[name])
+        self._assert_hash_index_consistent(chain)
+        chain.write(bfh(blockchain.serialize_header(self.HEADERS['G'])), 6 * 80)
+        self._assert_hash_index_consistent(chain)
+        self.assertEqual(hash_header(self.HEADERS['G']), chain.get_hash(6))
+        chain.write(bytes(80), 80)
+        self._assert_hash_index_consistent(chain)
+
+    def test_hash_index_gets_rebuilt(self):
+        chain = self.chain
+        for name in 'ABCDEF':
+            chain.save_header(self.HEADERS[name])
+        # as if written by an older version
+        chain.delete_hash_index()
+        self.assertFalse(os.path.exists(chain.hashes_path()))
+        self._assert_hash_index_consistent(chain)
+        # as if we crashed between writing the header and its hash
+        with open(chain.hashes_path(), 'rb+') as f:
+            f.truncate(3 * 32)
+        chain.close_mmaps()
+        chain._hash_index_in_sync = False
+        self._assert_hash_index_consistent(chain)
+        # stale contents
+        with open(chain.hashes_path(), 'rb+') as f:
+            f.seek(5 * 32)
+            f.write(bytes(range(32)))
+        chain.close_mmaps()
+        chain._hash_index_in_sync = False
+        self._assert_hash_index_consistent(chain)
+
+    def test_hash_index_after_swapping(self):
+        chain_u = self.chain
+        for name in 'ABCDEFOPQR':
+            chain_u.save_header(self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJ':
+            chain_l.save_header(self.HEADERS[name])
+        self._assert_hash_index_consistent(chain_u)
+        self._assert_hash_index_consistent(chain_l)
+        chain_l.save_header(self.HEADERS['K'])
+        # chains were swapped
+        self.assertEqual(None, chain_l.parent)
+        self.assertEqual(2, len(os.listdir(os.path.join(self.data_dir, "hashes"))))
+        self._assert_hash_index_consistent(chain_u)
+        self._assert_hash_index_consistent(chain_l)
+        self.assertEqual(hash_header(self.HEADERS['K']), chain_l.get_hash(10))
+        self.assertEqual(hash_header(self.HEADERS['R']), chain_u.get_hash(9))
+
+    def test_read_header_returns_copies(self):
+        chain = self.chain
+        chain.save_header(self.HEADERS['A'])
+        header = chain.read_header(0)
+        header['nonce'] = 42
+        self.assertEqual(self.HEADERS['A'], chain.read_header(0))
+
+
+    def _use_batched_fsync(self, count: int):
+        self.config.set_key('headers_durability', 'batched')
+        self.config.set_key('headers_fsync_count', count)
+        self.config.set_key('headers_fsync_interval', 1000)
+
+    def _reopen_chain(self) -> Blockchain:
+        # as on startup
+        return Blockchain(config=self.config, forkpoint=0, parent=None,
+                          forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+    def test_batched_fsync(self):
+        self._use_batched_fsync(count=4)
+        chain = self.chain
+        marker = chain.path() + '.dirty'
+        for name in 'ABC':
+            chain.save_header(self.HEADERS[name])
+        self.assertTrue(os.path.exists(marker))
+        with open(marker) as f:
+            self.assertEqual('0', f.read())
+        chain.save_header(self.HEADERS['D'])
+        self.assertFalse(os.path.exists(marker))
+        chain.save_header(self.HEADERS['E'])
+        with open(marker) as f:
+            self.assertEqual('4', f.read())
+        blockchain.flush_blockchains()
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(5, self._reopen_chain().size())
+
+    def test_recovery_after_crash_with_unflushed_writes(self):
+        self._use_batched_fsync(count=100)
+        chain = self.chain
+        for name in 'ABCDEFOPQ':
+            chain.save_header(self.HEADERS[name])
+        chain.flush()
+        chain.save_header(self.HEADERS['R'])
+        with open(chain.path() + '.dirty') as f:
+            self.assertEqual('9', f.read())
+        # reorg below the last durable header
+        chain.save_header(self.HEADERS['G'])
+        with open(chain.path() + '.dirty') as f:
+            self.assertEqual('6', f.read())
+        # crash: the chain is not flushed
+        chain.close_mmaps()
+        chain = self._reopen_chain()
+        self.assertFalse(os.path.exists(chain.path() + '.dirty'))
+        self.assertEqual(6, chain.size())
+        self.assertEqual(self.HEADERS['F'], chain.read_header(5))
+        self._assert_hash_index_consistent(chain)
+
+    def test_full_durability_leaves_no_marker(self):
+        chain = self.chain
+        for name in 'ABC':
+            chain.save_header(self.HEADERS[name])
+        self.assertFalse(os.path.exists(chain.path() + '.dirty'))
+        self.assertEqual(3, self._reopen_chain().size())
+
+
+    def _make_raw_headers(self, num: int, first_height: int = 0, prev_hash: bytes = bytes(32),
+                          block_time: int = 150) -> bytes:
+        headers = []
+        for height in range(first_height, first_height + num):
+            header = ((0x20000000).to_bytes(4, 'little') + prev_hash + bytes(32)
+                      + (1500000000 + height * block_time).to_bytes(4, 'little')
+                      + (0x1d00ffff).to_bytes(4, 'little') + bytes(4))
+            headers.append(header)
+            prev_hash = blockchain._hash_of_raw_header(header)
+        return b''.join(headers)
+
+    def _chainwork_from_scratch(self, chain: Blockchain) -> int:
+        chain._truncate_chainwork(0)
+        return chain.get_chainwork()
+
+    def test_chainwork_is_persisted(self):
+        chain = self.chain
+        chain.write(self._make_raw_headers(3 * 2016 + 5), 0)
+        with mock.patch.object(constants.net, 'TESTNET', False):
+            work = chain.get_chainwork()
+            with open(chain.chainwork_path(), 'rb') as f:
+                self.assertEqual(3 * blockchain.CHAINWORK_ENTRY_SIZE, len(f.read()))
+            # as on startup
+            chain.close_mmaps()
+            chain = self._reopen_chain()
+            with mock.patch.object(Blockchain, 'chainwork_of_header_at_height',
+                                   wraps=chain.chainwork_of_header_at_height) as m:
+                self.assertEqual(work, chain.get_chainwork())
+                # only for the last partial period
+                self.assertEqual(1, m.call_count)
+            self.assertEqual(work, self._chainwork_from_scratch(chain))
+
+    def test_chainwork_invalidated_on_reorg(self):
+        chain = self.chain
+        data = self._make_raw_headers(4 * 2016 + 5)
+        chain.write(data, 0)
+        with mock.patch.object(constants.net, 'TESTNET', False):
+            work = chain.get_chainwork()
+            # faster blocks from within the third period: targets change from the fourth one on
+            height = 2 * 2016 + 100
+            prev_hash = blockchain._hash_of_raw_header(data[(height-1)*80:height*80])
+            chain.write(self._make_raw_headers(2 * 2016, height, prev_hash, block_time=60), height * 80)
+            self.assertEqual(2, len(chain._load_chainwork()))
+            new_work = chain.get_chainwork()
+            self.assertNotEqual(work, new_work)
+            self.assertEqual(new_work, self._chainwork_from_scratch(chain))
+
+    def test_stale_chainwork_entries_are_not_used(self):
+        chain = self.chain
+        chain.write(self._make_raw_headers(3 * 2016 + 5), 0)
+        with mock.patch.object(constants.net, 'TESTNET', False):
+            work = chain.get_chainwork()
+            # pretend the file belongs to some other chain from the second period on
+            with open(chain.chainwork_path(), 'rb+') as f:
+                f.seek(blockchain.CHAINWORK_ENTRY_SIZE)
+                f.write(bytes(range(32)) + (1).to_bytes(32, 'big'))
+            chain._chainwork = None
+            self.assertEqual(work, chain.get_chainwork())
+            self.assertEqual(work, self._chainwork_from_scratch(chain))
+
+
 class TestVerifyHeader(ElectrumTestCase):
 
     # Data for Actinium block header #100.
@@ -369,3 +653,84 @@ class TestVerifyHeader(ElectrumTestCase):
         with self.assertRaises(Exception):
             self.header["nonce"] = 42
             Blockchain.verify_header(self.header, self.prev_hash, self.target)
+
+
+class TestVerifyRawHeaders(ElectrumTestCase):
+
+    HEADERS = TestBlockchain.HEADERS
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(Blockchain, 'VERIFY_HEADERS', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _verify_one_by_one(self, data: bytes, prev_hash: str, expected_hashes):
+        for i in range(len(data) // 80):
+            header = deserialize_header(data[i*80:(i+1)*80], i)
+            Blockchain.verify_header(header, prev_hash, 0, expected_hashes[i])
+            prev_hash = hash_header(header)
+
+    def _assert_same_result(self, data: bytes, prev_hash: str, expected_hashes=None):
+        if expected_hashes is None:
+            expected_hashes = [None] * (len(data) // 80)
+        hashes = blockchain.hashes_of_raw_headers(data)
+        try:
+            self._verify_one_by_one(data, prev_hash, expected_hashes)
+        except Exception:
+            with self.assertRaises(Exception):
+                Blockchain.verify_raw_headers(data, hashes, prev_hash, 0, expected_hashes)
+            return False
+        Blockchain.verify_raw_headers(data, hashes, prev_hash, 0, expected_hashes)
+        return True
+
+    def _raw(self, names: str) -> bytes:
+        return b''.join(bfh(blockchain.serialize_header(self.HEADERS[name])) for name in names)
+
+    def test_hashes_of_raw_headers(self):
+        data = self._raw('ABC') + bytes(80)
+        hashes = blockchain.hashes_of_raw_headers(data)
+        self.assertEqual(hash_header(self.HEADERS['B']), bh2u(hashes[32:64][::-1]))
+        self.assertEqual(bytes(32), hashes[96:])
+
+    def test_valid_run(self):
+        prev_hash = hash_header(self.HEADERS['A'])
+        self.assertTrue(self._assert_same_result(self._raw('BCDEFOPQRSTU'), prev_hash))
+        self.assertTrue(self._assert_same_result(self._raw('GHIJKL'), hash_header(self.HEADERS['F'])))
+
+    def test_prev_hash_mismatch(self):
+        prev_hash = hash_header(self.HEADERS['A'])
+        self.assertFalse(self._assert_same_result(self._raw('BCDFE'), prev_hash))
+        self.assertFalse(self._assert_same_result(self._raw('BCD'), hash_header(self.HEADERS['B'])))
+
+    def test_expected_hash_mismatch(self):
+        prev_hash = hash_header(self.HEADERS['A'])
+        data = self._raw('BCD')
+        expected = [None, hash_header(self.HEADERS['C']), None]
+        self.assertTrue(self._assert_same_result(data, prev_hash, expected))
+        expected = [None, hash_header(self.HEADERS['D']), None]
+        self.assertFalse(self._assert_same_result(data, prev_hash, expected))
+
+    def test_target_mismatch(self):
+        constants.set_mainnet()
+        try:
+            data = bfh(TestVerifyHeader.valid_header)
+            hashes = blockchain.hashes_of_raw_headers(data)
+            Blockchain.verify_raw_headers(data, hashes, TestVerifyHeader.prev_hash,
+                                          TestVerifyHeader.target, [None])
+            with self.assertRaises(Exception):
+                other_target = Blockchain.bits_to_target(0x1d00eeee)
+                Blockchain.verify_raw_headers(data, hashes, TestVerifyHeader.prev_hash,
+                                              other_target, [None])
+        finally:
+            constants.set_regtest()
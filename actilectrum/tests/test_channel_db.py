@@ -0,0 +1,156 @@
+import asyncio
+import os
+import tempfile
+import shutil
+import threading
+import time
+from unittest import mock
+
+from actilectrum import constants
+from actilectrum.channel_db import ChannelDB
+from actilectrum.lnrouter import RouteEdge
+from actilectrum.lnutil import ShortChannelID
+from actilectrum.simple_config import SimpleConfig
+
+from . import ElectrumTestCase
+from .gossip_util import NODE_KEYS, NODE_IDS, channel_announcement, channel_update, node_announcement
+
+
+class TestChannelDBSnapshot(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'actilectrum_path': self.user_dir})
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.cdbs = []
+        patcher = mock.patch('actilectrum.util.trigger_callback')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for cdb in self.cdbs:
+            self._close(cdb)
+        shutil.rmtree(self.user_dir)
+        super().tearDown()
+
+    def _open(self) -> ChannelDB:
+        class FakeNetwork:
+            config = self.config
+            asyncio_loop = self.asyncio_loop
+            interface = None
+        self._stopping_fut = self.asyncio_loop.create_future()
+        self._loop_thread = threading.Thread(target=self.asyncio_loop.run_until_complete,
+                                             args=(self._stopping_fut,))
+        self._loop_thread.start()
+        while not self.asyncio_loop.is_running():
+            time.sleep(0.01)
+        cdb = ChannelDB(FakeNetwork())
+        self.cdbs.append(cdb)
+        self._wait(cdb.load_data())
+        return cdb
+
+    def _close(self, cdb: ChannelDB):
+        if not cdb.sql_thread.is_alive():
+            return
+        self.asyncio_loop.call_soon_threadsafe(self._stopping_fut.set_result, 1)
+        self._loop_thread.join()
+        cdb.sql_thread.join()
+
+    def _wait(self, fut):
+        while not fut.done():
+            time.sleep(0.01)
+        return fut.result()
+
+    def _populate(self, cdb: ChannelDB):
+        cdb.add_channel_announcement(channel_announcement(1, NODE_KEYS[0], NODE_KEYS[1]))
+        cdb.add_channel_announcement(channel_announcement(2, NODE_KEYS[1], NODE_KEYS[2]))
+        cdb.add_channel_updates([channel_update(1, 0, fee_base_msat=1000),
+                                 channel_update(1, 1, fee_base_msat=2000),
+                                 channel_update(2, 0, fee_base_msat=3000)])
+        cdb.add_node_announcement(node_announcement(NODE_IDS[1], b'bob'))
+
+    def _add_more(self, cdb: ChannelDB):
+        cdb.add_channel_announcement(channel_announcement(3, NODE_KEYS[2], NODE_KEYS[3]))
+        cdb.add_channel_updates([channel_update(3, 1, fee_base_msat=4000)])
+        cdb.add_node_announcement(node_announcement(NODE_IDS[2], b'carol'))
+        cdb.remove_channel(ShortChannelID.from_components(0, 0, 2))
+        cdb._policies.pop((NODE_IDS[1], ShortChannelID.from_components(0, 0, 2)))
+        self._wait(cdb._db_delete_policy(NODE_IDS[1], ShortChannelID.from_components(0, 0, 2)))
+
+    def _assert_same_graph(self, cdb1: ChannelDB, cdb2: ChannelDB):
+        self.assertEqual(cdb1._channels, cdb2._channels)
+        self.assertEqual(cdb1._policies, cdb2._policies)
+        self.assertEqual(cdb1._nodes, cdb2._nodes)
+        self.assertEqual({k: v for k, v in cdb1._channels_for_node.items() if v},
+                         {k: v for k, v in cdb2._channels_for_node.items() if v})
+        self.assertEqual(cdb1.get_num_channels_partitioned_by_policy_count(),
+                         cdb2.get_num_channels_partitioned_by_policy_count())
+        self.assertEqual(self._usable_edges(cdb1), self._usable_edges(cdb2))
+
+    def _usable_edges(self, cdb: ChannelDB):
+        graph = cdb.graph
+        edges = set()
+        for c, scid in enumerate(graph.short_channel_ids):
+            for d, start_node in ((2 * c, graph.node1[c]), (2 * c + 1, graph.node2[c])):
+                if scid is not None and graph.is_usable[d]:
+                    edges.add((scid, graph.node_ids[start_node], graph.fee_base_msat[d]))
+        return edges
+
+    def test_load_snapshot_and_replay_changes(self):
+        cdb1 = self._open()
+        self._populate(cdb1)
+        self._wait(cdb1.save_snapshot())
+        self.assertTrue(os.path.exists(cdb1.snapshot_path))
+        self._add_more(cdb1)
+        self._close(cdb1)
+        cdb2 = self._open()
+        self._assert_same_graph(cdb1, cdb2)
+        self.assertEqual({(ShortChannelID.from_components(0, 0, 1), NODE_IDS[0], 1000),
+                          (ShortChannelID.from_components(0, 0, 1), NODE_IDS[1], 2000)},
+                         self._usable_edges(cdb2))
+        # channel 3 and its policy, node 2, channel 2 and its policy
+        self.assertEqual(5, cdb2._num_changes_since_snapshot)
+
+    def test_snapshot_not_matching_db_is_ignored(self):
+        cdb1 = self._open()
+        self._populate(cdb1)
+        self._wait(cdb1.save_snapshot())
+        self._add_more(cdb1)
+        self._wait(cdb1.save_snapshot())
+        self._close(cdb1)
+        cdb2 = self._open()
+        self._assert_same_graph(cdb1, cdb2)
+        self.assertEqual(0, cdb2._num_changes_since_snapshot)
+        self._close(cdb2)
+        # the db is reset, but the snapshot file is still there
+        os.unlink(os.path.join(self.user_dir, 'gossip_db'))
+        cdb3 = self._open()
+        self.assertEqual({}, cdb3._channels)
+        self.assertEqual({}, cdb3._policies)
+
+    def test_channel_results_are_saved(self):
+        cdb1 = self._open()
+        route = [RouteEdge(node_id=node_id,
+                           short_channel_id=ShortChannelID.from_components(0, 0, i),
+                           fee_base_msat=1000,
+                           fee_proportional_millionths=0,
+                           cltv_expiry_delta=144,
+                           node_features=0)
+                 for i, node_id in enumerate(NODE_IDS[:3])]
+        cdb1.mission_control.report_failure(route, 10**8, 2)
+        # the sql requests are processed in order
+        self._wait(cdb1.delete_channel_results([]))
+        self._close(cdb1)
+        cdb2 = self._open()
+        self.assertEqual(cdb1.mission_control.get_results(), cdb2.mission_control.get_results())
+        self.assertEqual({route[2].short_channel_id}, set(cdb2.mission_control.blacklist))
+
+    def test_synced_block_is_saved(self):
+        cdb1 = self._open()
+        self.assertIsNone(cdb1.get_synced_block())
+        cdb1.set_synced_block(610_000)
+        self._wait(cdb1._db_save_synced_block(constants.net.rev_genesis_bytes(), 610_000))
+        self._close(cdb1)
+        cdb2 = self._open()
+        self.assertEqual(610_000, cdb2.get_synced_block())
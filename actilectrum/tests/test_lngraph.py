@@ -0,0 +1,148 @@
+from actilectrum.channel_db import ChannelInfo, Policy
+from actilectrum.lngraph import ChannelGraph
+from actilectrum.lnrouter import LNPathFinder
+from actilectrum.lnutil import ShortChannelID
+
+from . import ElectrumTestCase
+from .gossip_util import NODE_KEYS, NODE_IDS, ChannelDBTestCase, channel_announcement, channel_update
+
+
+def channel_info(scid: int, node1: bytes, node2: bytes) -> ChannelInfo:
+    return ChannelInfo(short_channel_id=ShortChannelID.from_components(0, 0, scid),
+                       node1_id=node1,
+                       node2_id=node2,
+                       capacity_sat=10**6)
+
+
+def policy(scid: int, start_node: bytes, *, cltv_expiry_delta=144, channel_flags=0) -> Policy:
+    return Policy(key=ShortChannelID.from_components(0, 0, scid) + start_node,
+                  cltv_expiry_delta=cltv_expiry_delta,
+                  htlc_minimum_msat=1000,
+                  htlc_maximum_msat=None,
+                  fee_base_msat=1000,
+                  fee_proportional_millionths=10,
+                  channel_flags=channel_flags,
+                  message_flags=0,
+                  timestamp=0)
+
+
+class TestChannelGraph(ElectrumTestCase):
+
+    def test_add_and_remove_channels(self):
+        graph = ChannelGraph()
+        graph.add_channel(channel_info(1, NODE_IDS[0], NODE_IDS[1]))
+        graph.add_channel(channel_info(2, NODE_IDS[1], NODE_IDS[2]))
+        n0, n1, n2 = [graph.node_index[node_id] for node_id in NODE_IDS[:3]]
+        c1 = graph.channel_index[ShortChannelID.from_components(0, 0, 1)]
+        c2 = graph.channel_index[ShortChannelID.from_components(0, 0, 2)]
+        self.assertEqual([c1], graph.adjacency[n0])
+        self.assertEqual([c1, c2], graph.adjacency[n1])
+        self.assertEqual([c2], graph.adjacency[n2])
+        graph.remove_channel(ShortChannelID.from_components(0, 0, 1))
+        self.assertEqual([], graph.adjacency[n0])
+        self.assertEqual([c2], graph.adjacency[n1])
+        self.assertIsNone(graph.short_channel_ids[c1])
+        # the slot of the removed channel is reused
+        graph.add_channel(channel_info(3, NODE_IDS[2], NODE_IDS[3]))
+        self.assertEqual(c1, graph.channel_index[ShortChannelID.from_components(0, 0, 3)])
+        self.assertEqual(2, len(graph.short_channel_ids))
+        # removing an unknown channel is a no-op
+        graph.remove_channel(ShortChannelID.from_components(0, 0, 4))
+
+    def test_usable_directions(self):
+        graph = ChannelGraph()
+        graph.add_channel(channel_info(1, NODE_IDS[0], NODE_IDS[1]))
+        c = graph.channel_index[ShortChannelID.from_components(0, 0, 1)]
+        # policies of unknown channels and nodes are ignored
+        graph.update_policy(policy(2, NODE_IDS[0]))
+        graph.update_policy(policy(1, NODE_IDS[2]))
+        self.assertEqual([False, False], graph.has_policy)
+        # a direction needs both policies
+        graph.update_policy(policy(1, NODE_IDS[0]))
+        self.assertEqual([False, False], graph.is_usable[2 * c:2 * c + 2])
+        graph.update_policy(policy(1, NODE_IDS[1]))
+        self.assertEqual([True, True], graph.is_usable[2 * c:2 * c + 2])
+        self.assertEqual(1000, graph.fee_base_msat[2 * c + 1])
+        # disabled, or with too large cltv_expiry_delta
+        graph.update_policy(policy(1, NODE_IDS[0], channel_flags=2))
+        self.assertEqual([False, True], graph.is_usable[2 * c:2 * c + 2])
+        graph.update_policy(policy(1, NODE_IDS[0]))
+        graph.update_policy(policy(1, NODE_IDS[1], cltv_expiry_delta=10000))
+        self.assertEqual([True, False], graph.is_usable[2 * c:2 * c + 2])
+        graph.remove_policy(ShortChannelID.from_components(0, 0, 1), NODE_IDS[1])
+        self.assertEqual([False, False], graph.is_usable[2 * c:2 * c + 2])
+
+
+class TestLNPathFinder(ChannelDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path_finder = LNPathFinder(self.cdb)
+        # A is connected to D through B and C, that are also connected
+        self.A, self.B, self.C, self.D = NODE_IDS
+        self._add_channel(1, self.A, self.B, fee_base_msat=1000)
+        self._add_channel(2, self.B, self.D, fee_base_msat=1000)
+        self._add_channel(3, self.A, self.C, fee_base_msat=1000)
+        self._add_channel(4, self.C, self.D, fee_base_msat=2000)
+        self._add_channel(5, self.B, self.C, fee_base_msat=0)
+
+    def _add_channel(self, scid: int, node1: bytes, node2: bytes, *, fee_base_msat: int):
+        node_keys = [NODE_KEYS[NODE_IDS.index(node_id)] for node_id in (node1, node2)]
+        self.cdb.add_verified_channel_info(channel_announcement(scid, *node_keys))
+        for direction in (0, 1):
+            self.cdb.add_channel_update(channel_update(scid, direction, fee_base_msat=fee_base_msat),
+                                        verbose=False)
+
+    def _path(self, *scids):
+        path = []
+        node_id = self.A
+        for scid in scids:
+            short_channel_id = ShortChannelID.from_components(0, 0, scid)
+            channel_info = self.cdb.get_channel_info(short_channel_id)
+            node_id = channel_info.node2_id if channel_info.node1_id == node_id else channel_info.node1_id
+            path.append((node_id, short_channel_id))
+        return path
+
+    def test_find_path_for_payment(self):
+        self.assertEqual(self._path(1, 2), self.path_finder.find_path_for_payment(self.A, self.D, 10**8))
+        self.assertEqual(self._path(1), self.path_finder.find_path_for_payment(self.A, self.B, 10**8))
+        self.assertIsNone(self.path_finder.find_path_for_payment(self.A, b'\x02' + bytes(32), 10**8))
+
+    def test_find_paths_for_payment(self):
+        # the paths through channel 5 share channels with both, and cost more
+        paths = list(self.path_finder.find_paths_for_payment(self.A, self.D, 10**8))
+        self.assertEqual([self._path(1, 2), self._path(3, 4)], paths)
+        costs = [self.path_finder.get_path_cost(self.A, path, 10**8) for path in paths]
+        self.assertEqual(sorted(costs), costs)
+        # a more expensive disjoint path comes before a cheaper one with a shared channel
+        self._add_channel(6, self.B, self.D, fee_base_msat=0)
+        paths = list(self.path_finder.find_paths_for_payment(self.A, self.D, 10**8))
+        self.assertEqual([self._path(1, 6), self._path(3, 4), self._path(1, 2)], paths)
+
+    def _route(self, *scids):
+        return self.path_finder.create_route_from_path(self._path(*scids), self.A)
+
+    def test_find_paths_for_payment_avoids_blacklisted_channels(self):
+        paths = self.path_finder.find_paths_for_payment(self.A, self.D, 10**8)
+        self.assertEqual(self._path(1, 2), next(paths))
+        self.path_finder.mission_control.report_failure(self._route(1, 2), 10**8, 1)
+        self.assertEqual([self._path(3, 4)], list(paths))
+
+    def test_failed_channels_are_penalized_until_forgotten(self):
+        mission_control = self.path_finder.mission_control
+        mission_control.report_failure(self._route(1, 2), 10**8, 1)
+        self.assertEqual(self._path(3, 4), self.path_finder.find_path_for_payment(self.A, self.D, 10**8))
+        # past the blacklist, it is still expensive
+        key = ShortChannelID.from_components(0, 0, 2) + self.B
+        def age_failure(age):
+            result = mission_control.get_result(key)
+            mission_control._results[key] = result._replace(failure_time=result.failure_time - age)
+            for short_channel_id in mission_control.blacklist:
+                mission_control.blacklist[short_channel_id] -= age
+        age_failure(mission_control.BLACKLIST_DURATION)
+        self.assertEqual(self._path(3, 4), self.path_finder.find_path_for_payment(self.A, self.D, 10**8))
+        self.assertEqual({}, mission_control.blacklist)
+        # but not for smaller amounts
+        self.assertEqual(self._path(1, 2), self.path_finder.find_path_for_payment(self.A, self.D, 10**7))
+        age_failure(10 * mission_control.HALF_LIFE)
+        self.assertEqual(self._path(1, 2), self.path_finder.find_path_for_payment(self.A, self.D, 10**8))
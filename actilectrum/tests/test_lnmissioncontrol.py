@@ -0,0 +1,75 @@
+from unittest import mock
+
+from actilectrum.lnmissioncontrol import MissionControl, ChannelResult
+from actilectrum.lnrouter import RouteEdge
+from actilectrum.lnutil import ShortChannelID
+
+from . import ElectrumTestCase
+from .gossip_util import NODE_IDS
+
+
+def make_route(num_edges: int):
+    return [RouteEdge(node_id=NODE_IDS[i],
+                      short_channel_id=ShortChannelID.from_components(0, 0, i),
+                      fee_base_msat=1000,
+                      fee_proportional_millionths=0,
+                      cltv_expiry_delta=144,
+                      node_features=0)
+            for i in range(num_edges)]
+
+
+class TestMissionControl(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.channel_db = mock.Mock()
+        self.mission_control = MissionControl(self.channel_db)
+
+    def test_report_failure(self):
+        route = make_route(4)
+        self.mission_control.report_failure(route, 10**8, 2)
+        results = self.mission_control.get_results()
+        # the first edge is ours, the second forwarded the payment and its fee
+        self.assertEqual({route[1].short_channel_id + NODE_IDS[0], route[2].short_channel_id + NODE_IDS[1]},
+                         set(results))
+        self.assertEqual(10**8 + 2000, results[route[1].short_channel_id + NODE_IDS[0]].success_amount_msat)
+        self.assertEqual(10**8 + 1000, results[route[2].short_channel_id + NODE_IDS[1]].failure_amount_msat)
+        self.assertEqual({route[2].short_channel_id}, set(self.mission_control.blacklist))
+        self.assertEqual(2, self.channel_db.save_channel_result.call_count)
+        # a later success for that amount cancels the failure
+        self.mission_control.report_success(route, 10**8)
+        result = self.mission_control.get_results()[route[2].short_channel_id + NODE_IDS[1]]
+        self.assertEqual((None, None, 10**8 + 1000), result[:3])
+
+    def test_penalty(self):
+        mc = self.mission_control
+        now = 10**6
+        self.assertEqual(0, mc.get_penalty(ChannelResult(None, None, 10**8, now), 10**8, now))
+        failure = ChannelResult(10**8, now, None, None)
+        penalty = mc.get_penalty(failure, 10**8, now)
+        self.assertAlmostEqual(mc.ATTEMPT_COST * (1 / mc.MIN_PROBABILITY - 1 / mc.APRIORI_PROBABILITY), penalty)
+        self.assertEqual(0, mc.get_penalty(failure, 10**8 - 1, now))
+        # it decays with time
+        self.assertLess(mc.get_penalty(failure, 10**8, now + mc.HALF_LIFE), penalty)
+        self.assertLess(mc.get_penalty(failure, 10**8, now + 10 * mc.HALF_LIFE), 1)
+
+    def test_blacklist_expires(self):
+        self.mission_control.report_failure(make_route(2), 10**8, 1)
+        self.mission_control.update_blacklist()
+        failure_time = self.mission_control.blacklist[ShortChannelID.from_components(0, 0, 1)]
+        with mock.patch('time.time', return_value=failure_time + MissionControl.BLACKLIST_DURATION):
+            self.mission_control.update_blacklist()
+        self.assertEqual({}, self.mission_control.blacklist)
+
+    def test_results_are_bounded(self):
+        self.mission_control.MAX_RESULTS = 10
+        for i in range(1, 15):
+            route = make_route(2)
+            route[1].short_channel_id = ShortChannelID.from_components(0, 0, i)
+            with mock.patch('time.time', return_value=i):
+                self.mission_control.report_success(route, 10**8)
+        results = self.mission_control.get_results()
+        self.assertLessEqual(len(results), 10)
+        self.assertIn(ShortChannelID.from_components(0, 0, 14) + NODE_IDS[0], results)
+        self.assertNotIn(ShortChannelID.from_components(0, 0, 1) + NODE_IDS[0], results)
+        self.assertTrue(self.channel_db.delete_channel_results.called)
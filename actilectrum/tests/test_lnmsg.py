@@ -1,4 +1,5 @@
 import io
+import os
 
 from actilectrum.lnmsg import (read_bigsize_int, write_bigsize_int, FieldEncodingNotMinimal,
                                 UnexpectedEndOfStream, LNSerializer, UnknownMandatoryTLVRecordType,
@@ -383,3 +384,21 @@ class TestLNMsg(TestCaseForTestnet):
                                   {'chains': b'\xa0)>N\xeb=\xa6\xe6\xf5o\x81\xedY_W\x88\r\x1a!V\x9e\x13\xee\xfd\xd9Q(KZbfI'}
                           }}),
                          decode_msg(bfh("001000022200000302aaa20120a0293e4eeb3da6e6f56f81ed595f57880d1a21569e13eefdd951284b5a626649")))
+
+    def test_decode_msg__truncated_mandatory_field(self):
+        # "channel_update" without fee_proportional_millionths
+        with self.assertRaises(UnexpectedEndOfStream):
+            decode_msg(bfh("010200000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000a0293e4eeb3da6e6f56f81ed595f57880d1a21569e13eefdd951284b5a62664900d43100006f00025e6ed0830100009000000000000000c8000001f4"))
+        # "channel_announcement" with features shorter than len
+        with self.assertRaises(UnexpectedEndOfStream):
+            decode_msg(bfh("0100") + bytes(256) + bfh("0005") + bytes(4))
+
+    def test_decode_msg__fields_around_variable_length_field(self):
+        msg = decode_msg(bfh("0100") + bytes(256) + bfh("0002") + b'\x12\x34' + os.urandom(32 + 8 + 4 * 33))[1]
+        self.assertEqual(b'\x12\x34', msg['features'])
+        self.assertEqual(2, msg['len'])
+        self.assertEqual(33, len(msg['bitcoin_key_2']))
+        msg = decode_msg(bfh("0102") + bytes(64 + 32 + 8) + bfh("5e6ed083") + b'\x01\x00' + bfh("0090") + bytes(16) + bfh("000000003b9aca00"))[1]
+        self.assertEqual(1584320643, msg['timestamp'])
+        self.assertEqual(144, msg['cltv_expiry_delta'])
+        self.assertEqual(10**9, msg['htlc_maximum_msat'])
@@ -163,6 +163,8 @@ class MockLNWallet(Logger, NetworkRetryManager[LNPeerAddr]):
     save_preimage = LNWallet.save_preimage
     get_preimage = LNWallet.get_preimage
     _create_route_from_invoice = LNWallet._create_route_from_invoice
+    _create_routes_from_invoice = LNWallet._create_routes_from_invoice
+    _add_private_route_to_route = LNWallet._add_private_route_to_route
     _check_invoice = staticmethod(LNWallet._check_invoice)
     _pay_to_route = LNWallet._pay_to_route
     _pay = LNWallet._pay
@@ -1,8 +1,10 @@
 import asyncio
+import os
+import random
 
 from actilectrum.ecc import ECPrivkey
-from actilectrum.lnutil import LNPeerAddr
-from actilectrum.lntransport import LNResponderTransport, LNTransport
+from actilectrum.lnutil import LNPeerAddr, LightningPeerConnectionClosed
+from actilectrum.lntransport import LNResponderTransport, LNTransport, LNTransportBase
 
 from . import ElectrumTestCase
 from .test_bitcoin import needs_test_with_all_chacha20_implementations
@@ -39,6 +41,43 @@ class TestLNTransport(ElectrumTestCase):
         transport = LNResponderTransport(ls_priv, Reader(), Writer())
         asyncio.get_event_loop().run_until_complete(transport.handshake(epriv=e_priv))
 
+    @needs_test_with_all_chacha20_implementations
+    def test_messages_split_across_reads(self):
+        key, ck = os.urandom(32), os.urandom(32)
+        # more than 1000 nonces, so that the key is rotated
+        msgs = [os.urandom(random.choice([1, 136, 430, 65535])) for _ in range(600)]
+        writes = []
+        class Writer:
+            def write(self, data):
+                writes.append(data)
+        sender = LNTransportBase()
+        sender.writer = Writer()
+        sender.sk = key
+        sender.init_counters(ck)
+        for msg in msgs:
+            sender.send_bytes(msg)
+        sender.flush()
+        # the messages are written together
+        self.assertEqual(1, len(writes))
+        data = writes[0]
+        class Reader:
+            async def read(self, num_bytes):
+                nonlocal data
+                n = random.randint(1, num_bytes)
+                s, data = data[:n], data[n:]
+                return s
+        receiver = LNTransportBase()
+        receiver.reader = Reader()
+        receiver.rk = key
+        receiver.init_counters(ck)
+        async def read_all():
+            received = []
+            with self.assertRaises(LightningPeerConnectionClosed):
+                async for msg in receiver.read_messages():
+                    received.append(msg)
+            return received
+        self.assertEqual(msgs, asyncio.get_event_loop().run_until_complete(read_all()))
+
     @needs_test_with_all_chacha20_implementations
     def test_loop(self):
         loop = asyncio.get_event_loop()
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import shutil
+import tempfile
+
+from actilectrum import ecc
+from actilectrum.crypto import sha256d
+from actilectrum.lnmsg import encode_msg, decode_msg
+from actilectrum.lnverifier import GossipSignatureVerifier
+from actilectrum.simple_config import SimpleConfig
+
+from . import ElectrumTestCase
+
+
+def node_announcement(privkey: ecc.ECPrivkey, *, valid=True) -> dict:
+    fields = dict(flen=0,
+                  features=b'',
+                  timestamp=0,
+                  node_id=privkey.get_public_key_bytes(),
+                  rgb_color=b'\x00' * 3,
+                  alias=b'\x00' * 32,
+                  addrlen=0,
+                  addresses=b'')
+    raw = encode_msg('node_announcement', signature=bytes(64), **fields)
+    h = sha256d(raw[66:] if valid else raw)
+    raw = encode_msg('node_announcement', signature=privkey.sign(h, ecc.sig_string_from_r_and_s), **fields)
+    payload = decode_msg(raw)[1]
+    payload['raw'] = raw
+    return payload
+
+
+class TestGossipSignatureVerifier(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.verifier = GossipSignatureVerifier(SimpleConfig({'actilectrum_path': self.user_dir,
+                                                              'gossip_verify_threads': 3}))
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.verifier.executor.shutdown()
+        shutil.rmtree(self.user_dir)
+        super().tearDown()
+
+    def test_verify_node_announcements(self):
+        node_anns = [node_announcement(ecc.ECPrivkey(os.urandom(32))) for _ in range(10)]
+        self.assertTrue(self.loop.run_until_complete(self.verifier.verify_node_announcements(node_anns)))
+        self.assertTrue(self.loop.run_until_complete(self.verifier.verify_node_announcements([])))
+        # a bad signature in any of the batches
+        for i in (0, 9):
+            bad_node_anns = list(node_anns)
+            bad_node_anns[i] = node_announcement(ecc.ECPrivkey(os.urandom(32)), valid=False)
+            self.assertFalse(self.loop.run_until_complete(self.verifier.verify_node_announcements(bad_node_anns)))
@@ -0,0 +1,208 @@
+import asyncio
+import os
+import time
+from typing import Tuple
+from unittest import mock
+
+from actilectrum import constants
+from actilectrum.lnmsg import encode_msg, decode_msg
+from actilectrum.lnpeer import Peer
+from actilectrum.lnutil import ShortChannelID
+from actilectrum.lnworker import LNGossip, GossipBatch
+
+from .gossip_util import NODE_KEYS, ChannelDBTestCase, channel_announcement, channel_update
+
+
+class TestLNGossip(ChannelDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.lngossip = LNGossip()
+        self.lngossip.channel_db = self.cdb
+
+    def _process(self, *batches):
+        batches = [GossipBatch(peer, chan_anns, [], chan_upds, self.loop.create_future())
+                   for peer, chan_anns, chan_upds in batches]
+        self.loop.run_until_complete(self.lngossip._process_gossip_batches(batches))
+        return [batch.future for batch in batches]
+
+    def test_gossip_of_peers_is_deduplicated(self):
+        peer1, peer2 = mock.Mock(), mock.Mock()
+        now = int(time.time())
+        chan_ann = channel_announcement(1, *NODE_KEYS[:2])
+        futures = self._process(
+            (peer1, [chan_ann], [channel_update(1, 0, timestamp=now)]),
+            (peer2, [chan_ann], [channel_update(1, 0, timestamp=now), channel_update(1, 1, timestamp=now),
+                                 channel_update(2, 0, timestamp=now)]))
+        self.assertEqual([None, None], [future.result() for future in futures])
+        self.assertEqual({'accepted': 3, 'duplicate': 2, 'dropped': 1}, self.lngossip.gossip_counters)
+        self.assertEqual(2, len(self.cdb._policies))
+        # the update of an unknown channel is kept by the peer that sent it
+        peer2.add_orphan_channel_update.assert_called_once()
+        self.assertFalse(peer1.add_orphan_channel_update.called)
+        # copies sent later are dropped too, unless they were orphaned
+        self._process((peer1, [chan_ann], [channel_update(1, 1, timestamp=now),
+                                           channel_update(2, 0, timestamp=now)]))
+        self.assertEqual({'accepted': 3, 'duplicate': 4, 'dropped': 2}, self.lngossip.gossip_counters)
+
+    def test_invalid_signature_fails_only_its_peer(self):
+        peer1, peer2 = mock.Mock(), mock.Mock()
+        futures = self._process((peer1, [channel_announcement(1, *NODE_KEYS[:2], valid=False)], []),
+                                (peer2, [channel_announcement(2, *NODE_KEYS[:2])], []))
+        self.assertRaises(Exception, futures[0].result)
+        self.assertIsNone(futures[1].result())
+        self.assertEqual({'accepted': 1, 'duplicate': 0, 'dropped': 1}, self.lngossip.gossip_counters)
+        self.assertEqual(1, len(self.cdb._channels))
+
+    def test_invalid_copy_does_not_hide_valid_one(self):
+        peer1, peer2 = mock.Mock(), mock.Mock()
+        futures = self._process((peer1, [channel_announcement(1, *NODE_KEYS[:2], valid=False)], []),
+                                (peer2, [channel_announcement(1, *NODE_KEYS[:2])], []))
+        self.assertRaises(Exception, futures[0].result)
+        self.assertIsNone(futures[1].result())
+        self.assertEqual({'accepted': 1, 'duplicate': 0, 'dropped': 1}, self.lngossip.gossip_counters)
+        self.assertEqual(1, len(self.cdb._channels))
+
+
+class FakeGossipPeer:
+    """The remote side of a gossip connection, that has a channel graph."""
+
+    def __init__(self, channels, channel_db):
+        self.privkey = os.urandom(32)
+        self.channels = channels  # type: Dict[ShortChannelID, int]  # -> timestamp of its updates
+        self.channel_db = channel_db
+        self.peer = None  # type: Peer
+        self.num_ids_sent = 0
+        self.num_ids_queried = 0
+        self.timestamp_filter = None
+
+    def name(self):
+        return 'fake'
+
+    def send_bytes(self, raw):
+        self.peer.network.asyncio_loop.call_soon(self.on_message, raw)
+
+    def on_message(self, raw):
+        message_type, payload = decode_msg(raw)
+        if message_type == 'gossip_timestamp_filter':
+            self.timestamp_filter = payload['first_timestamp']
+        elif message_type == 'query_channel_range':
+            first_block = payload['first_blocknum']
+            num_blocks = payload['number_of_blocks']
+            ids = sorted(scid for scid in self.channels
+                         if first_block <= scid.block_height < first_block + num_blocks)
+            self.num_ids_sent += len(ids)
+            encoded_ids = b'\x00' + b''.join(ids)
+            self.peer.process_message(encode_msg('reply_channel_range',
+                                                 chain_hash=constants.net.rev_genesis_bytes(),
+                                                 first_blocknum=first_block,
+                                                 number_of_blocks=num_blocks,
+                                                 complete=b'\x01',
+                                                 len=len(encoded_ids),
+                                                 encoded_short_ids=encoded_ids))
+        elif message_type == 'query_short_channel_ids':
+            ids = self.peer.decode_short_ids(payload['encoded_short_ids'])
+            self.num_ids_queried += len(ids)
+            # the gossip itself is not sent, we only check what was asked
+            for scid in ids:
+                self.channel_db.add_verified_channel_info({
+                    'short_channel_id': scid,
+                    'node_id_1': b'\x02' * 33,
+                    'node_id_2': b'\x03' * 33,
+                    'features': b'',
+                })
+                self.channel_db.add_channel_update({
+                    'short_channel_id': scid,
+                    'message_flags': b'\x00',
+                    'channel_flags': b'\x00',
+                    'cltv_expiry_delta': 144,
+                    'htlc_minimum_msat': 1000,
+                    'fee_base_msat': 1000,
+                    'fee_proportional_millionths': 10,
+                    'timestamp': self.channels[ShortChannelID(scid)],
+                }, verbose=False)
+            self.peer.process_message(encode_msg('reply_short_channel_ids_end',
+                                                 chain_hash=constants.net.rev_genesis_bytes(),
+                                                 full_information=b'\x01'))
+
+
+class TestGossipSync(ChannelDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.local_height = 0
+        self.network.get_local_height = lambda: self.local_height
+        # the graph of the remote peer: 1000 channels in 10000 blocks
+        self.update_time = int(time.time()) - 7200
+        self.channels = {ShortChannelID.from_components(600_000 + 10 * i, 0, 0): self.update_time
+                         for i in range(1000)}
+
+    def _connect(self) -> Tuple[Peer, FakeGossipPeer]:
+        """Connects a new session to the fake peer."""
+        lngossip = LNGossip()
+        lngossip.network = self.network
+        lngossip.channel_db = self.cdb
+        self.network.lngossip = lngossip
+        remote = FakeGossipPeer(dict(self.channels), self.cdb)
+        peer = Peer(lngossip, os.urandom(33), remote)
+        remote.peer = peer
+        peer.initialized.set_result(True)
+        return peer, remote
+
+    def _sync(self) -> FakeGossipPeer:
+        """Connects a new session to the fake peer, until its channels are synced."""
+        peer, remote = self._connect()
+        synced_block = self.cdb.get_synced_block()
+        async def sync():
+            task = asyncio.ensure_future(peer.query_gossip())
+            while self.cdb.get_synced_block() == synced_block:
+                await asyncio.wait([task], timeout=0.01)
+                if task.done():
+                    task.result()
+            task.cancel()
+        self.loop.run_until_complete(asyncio.wait_for(sync(), 10))
+        return remote
+
+    def test_resync_after_downtime_queries_only_new_blocks(self):
+        self.local_height = 610_000
+        remote = self._sync()
+        self.assertEqual((1000, 1000), (remote.num_ids_sent, remote.num_ids_queried))
+        self.assertEqual(610_000, self.cdb.get_synced_block())
+        self.assertGreater(remote.timestamp_filter, int(time.time()) - 60)
+        # a day later, with 20 new channels
+        self.channels.update({ShortChannelID.from_components(610_000 + 10 * i, 0, 0): int(time.time())
+                              for i in range(20)})
+        self.local_height = 610_200
+        remote = self._sync()
+        # only the blocks since the last sync, and a margin before it
+        self.assertEqual(14 + 20, remote.num_ids_sent)
+        self.assertEqual(20, remote.num_ids_queried)
+        self.assertEqual(1020, len(self.cdb.get_channel_ids()))
+        self.assertEqual(610_200, self.cdb.get_synced_block())
+        # and the gossip since the last channel_update we had
+        self.assertEqual(self.update_time - LNGossip.SYNC_TIMESTAMP_MARGIN, remote.timestamp_filter)
+
+    def test_synced_block_waits_for_the_queries_of_other_peers(self):
+        self.local_height = 610_000
+        peer, remote = self._connect()
+        lngossip = peer.lnworker
+        # another peer is querying a channel that the fake peer does not know
+        other_ids = [ShortChannelID.from_components(605_005, 0, 0)]
+        self.loop.run_until_complete(lngossip.add_new_ids(other_ids))
+        self.assertEqual(other_ids, lngossip.get_ids_to_query())
+        async def sync():
+            task = asyncio.ensure_future(peer.query_gossip())
+            try:
+                while remote.num_ids_queried < 1000:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(1.5)  # query_gossip checks every second
+                self.assertIsNone(self.cdb.get_synced_block())
+                lngossip.set_ids_queried(other_ids, answered=True)
+                while self.cdb.get_synced_block() is None:
+                    await asyncio.wait([task], timeout=0.01)
+                    if task.done():
+                        task.result()
+            finally:
+                task.cancel()
+        self.loop.run_until_complete(asyncio.wait_for(sync(), 10))
+        self.assertEqual(610_000, self.cdb.get_synced_block())
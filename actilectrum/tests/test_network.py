@@ -1,12 +1,17 @@
 import asyncio
+import os
 import tempfile
+import threading
 import unittest
+from unittest import mock
 
 from actilectrum import constants
 from actilectrum.simple_config import SimpleConfig
 from actilectrum import blockchain
 from actilectrum.interface import Interface, ServerAddr
-from actilectrum.crypto import sha256
+from actilectrum.network import Network
+from actilectrum.crypto import sha256, sha256d
+from actilectrum.logging import Logger
 from actilectrum.util import bh2u
 
 from . import ElectrumTestCase
@@ -52,7 +57,7 @@ class TestNetwork(ElectrumTestCase):
 
     def setUp(self):
         super().setUp()
-        self.config = SimpleConfig({'actilectrum_pathathathatactilectrum_pathm_pathm_pathm_pathm_path})
+        self.config = SimpleConfig({'actilectrum_path': self.actilectrum_pathathathathathath})
         self.interface = MockInterface(self.config)
 
     def test_fork_noconflict(self):
@@ -117,6 +122,163 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+def make_raw_headers(num: int, prev_hash: bytes = bytes(32)) -> bytes:
+    headers = []
+    for i in range(num):
+        header = ((0x20000000).to_bytes(4, 'little') + prev_hash + os.urandom(32)
+                  + (1500000000 + i).to_bytes(4, 'little') + (0x207fffff).to_bytes(4, 'little') + bytes(4))
+        headers.append(header)
+        prev_hash = sha256d(header)
+    return b''.join(headers)
+
+
+class FakeElectrumXServer(Logger):
+    """Serves blockchain.block.headers from a list of raw headers."""
+
+    def __init__(self, name: str, raw_headers: bytes, chain: blockchain.Blockchain):
+        Logger.__init__(self)
+        self.server = ServerAddr.from_str(f'{name}:50001:t')
+        self.raw_headers = raw_headers
+        self.blockchain = chain
+        self.tip = len(raw_headers) // 80 - 1
+        self.ready = asyncio.Future()
+        self.ready.set_result(1)
+        self.requested = []
+        self.fail = False
+
+    async def get_chunk(self, index: int, size: int = 2016) -> dict:
+        self.requested.append(index)
+        await asyncio.sleep(0.001 * (index % 3))  # responses arrive out of order
+        if self.fail:
+            raise Exception('server is having a bad day')
+        data = self.raw_headers[index*2016*80:(index*2016+size)*80]
+        return {'hex': data.hex(), 'count': len(data) // 80, 'max': 2016}
+
+
+class MockNetworkForSync(Logger):
+
+    def __init__(self, config):
+        Logger.__init__(self)
+        self.config = config
+        self.interfaces = {}
+        self.interfaces_lock = threading.Lock()
+
+
+class TestSyncChunks(ElectrumTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+        cls.RAW_HEADERS = make_raw_headers(5 * 2016 + 100)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'actilectrum_path': self.actilectrum_pathathathathathath,
+                                    'header_sync_pipeline_depth': 4})
+        blockchain.blockchains = {}
+        self.chain = blockchain.Blockchain(config=self.config, forkpoint=0, parent=None,
+                                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(self.chain.path(), 'w+').close()
+        self.network = MockNetworkForSync(self.config)
+        self.tip = len(self.RAW_HEADERS) // 80 - 1
+
+    def _add_server(self, name: str, raw_headers: bytes = None) -> FakeElectrumXServer:
+        if raw_headers is None:
+            raw_headers = self.RAW_HEADERS
+        iface = FakeElectrumXServer(name, raw_headers, self.chain)
+        self.network.interfaces[iface.server] = iface
+        return iface
+
+    def _sync(self, interface, height=0):
+        coro = Network.sync_chunks(self.network, interface, height, self.tip)
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def _assert_synced(self):
+        self.assertEqual(self.tip, self.chain.height())
+        with open(self.chain.path(), 'rb') as f:
+            self.assertEqual(self.RAW_HEADERS, f.read())
+
+    def test_single_server(self):
+        main = self._add_server('main')
+        self.assertEqual((True, self.tip + 1), self._sync(main))
+        self.assertEqual([0, 1, 2, 3, 4, 5], sorted(main.requested))
+        self._assert_synced()
+
+    def test_pipeline_depth_of_one(self):
+        self.network.config = SimpleConfig({'actilectrum_path': self.actilectrum_pathathathathathath,
+                                            'header_sync_pipeline_depth': 1})
+        main = self._add_server('main')
+        self._add_server('helper')
+        self.assertEqual((True, self.tip + 1), self._sync(main))
+        self._assert_synced()
+
+    def test_chunks_spread_over_servers(self):
+        main = self._add_server('main')
+        helpers = [self._add_server(f'helper{i}') for i in range(2)]
+        self.assertEqual((True, self.tip + 1), self._sync(main))
+        self._assert_synced()
+        for iface in [main] + helpers:
+            self.assertTrue(len(iface.requested) > 0)
+        self.assertEqual([0, 1, 2, 3, 4, 5], sorted(sum([iface.requested for iface in [main] + helpers], [])))
+
+    def test_starting_mid_chunk(self):
+        main = self._add_server('main')
+        self._add_server('helper')
+        self.chain.save_chunk(0, self.RAW_HEADERS[:2500*80])
+        self.assertEqual((True, self.tip + 1 - 2016), self._sync(main, height=2500))
+        self._assert_synced()
+
+    def test_chunks_from_other_chain_are_requested_again(self):
+        main = self._add_server('main')
+        liar = self._add_server('liar', make_raw_headers(len(self.RAW_HEADERS) // 80))
+        self.assertEqual((True, self.tip + 1), self._sync(main))
+        self._assert_synced()
+        self.assertTrue(len(liar.requested) > 0)
+        self.assertEqual([0, 1, 2, 3, 4, 5], sorted(main.requested))
+
+    def test_failing_helper(self):
+        main = self._add_server('main')
+        helper = self._add_server('helper')
+        helper.fail = True
+        self.assertEqual((True, self.tip + 1), self._sync(main))
+        self._assert_synced()
+        self.assertTrue(len(helper.requested) > 0)
+
+    def test_helpers_behind_are_not_used(self):
+        main = self._add_server('main')
+        helper = self._add_server('helper')
+        helper.tip = 2 * 2016
+        self.assertEqual((True, self.tip + 1), self._sync(main))
+        self._assert_synced()
+        self.assertTrue(all(index < 2 for index in helper.requested))
+
+
+class TestFlushHeaders(ElectrumTestCase):
+
+    def test_flush_runs_outside_event_loop(self):
+        loop = asyncio.get_event_loop()
+        network = MockNetworkForSync(SimpleConfig({'actilectrum_path': self.actilectrum_pathathathathathath,
+                                                   'headers_fsync_interval': 0}))
+        network.asyncio_loop = loop
+        flushed = loop.create_future()
+        def flush_blockchains():
+            loop.call_soon_threadsafe(flushed.set_result, threading.current_thread())
+        async def run():
+            task = asyncio.ensure_future(Network._flush_headers_periodically(network))
+            try:
+                return await flushed
+            finally:
+                task.cancel()
+        with mock.patch.object(blockchain, 'flush_blockchains', flush_blockchains):
+            self.assertIsNot(threading.current_thread(), loop.run_until_complete(run()))
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
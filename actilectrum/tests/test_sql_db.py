@@ -0,0 +1,117 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from actilectrum.sql_db import SqlDB, sql, sql_rows
+
+from . import ElectrumTestCase
+
+
+class KeyValueDB(SqlDB):
+
+    def __init__(self, asyncio_loop, path):
+        self.num_calls = 0
+        super().__init__(asyncio_loop, path)
+
+    def create_database(self):
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS kv (key INTEGER PRIMARY KEY, value INTEGER)")
+        self.conn.commit()
+
+    @sql_rows
+    def put(self, rows):
+        self.num_calls += 1
+        c = self.conn.cursor()
+        c.executemany("INSERT INTO kv (key, value) VALUES (?,?)", rows)
+
+    @sql
+    def get(self, key):
+        c = self.conn.cursor()
+        c.execute("SELECT value FROM kv WHERE key=?", (key,))
+        r = c.fetchone()
+        return r[0] if r else None
+
+    @sql
+    def count_committed(self):
+        # what another connection sees
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+        finally:
+            conn.close()
+
+
+class TestSqlDB(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, 'kv_db')
+        self.asyncio_loop = asyncio.get_event_loop()
+        self._stopping_fut = self.asyncio_loop.create_future()
+        self._loop_thread = threading.Thread(target=self.asyncio_loop.run_until_complete,
+                                             args=(self._stopping_fut,))
+        self._loop_thread.start()
+        while not self.asyncio_loop.is_running():
+            time.sleep(0.01)
+        self.db = KeyValueDB(self.asyncio_loop, self.path)
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stopping_fut.set_result, 1)
+        self._loop_thread.join()
+        self.db.sql_thread.join()
+        shutil.rmtree(self.user_dir)
+        super().tearDown()
+
+    def _wait(self, fut):
+        while not fut.done():
+            time.sleep(0.01)
+        return fut.result()
+
+    def test_consecutive_writes_are_run_together(self):
+        # the sql thread is busy, so that the writes are queued
+        self.db.db_requests.put((asyncio.Future(), lambda db: time.sleep(0.2), (), {}))
+        futures = [self.db.put(i, 10 * i) for i in range(100)]
+        get_fut = self.db.get(5)
+        futures += [self.db.put(i, 10 * i) for i in range(100, 110)]
+        self.assertEqual(50, self._wait(get_fut))
+        for fut in futures:
+            self._wait(fut)
+        self.assertEqual(2, self.db.num_calls)
+
+    def test_batch_is_one_transaction(self):
+        self.db.db_requests.put((asyncio.Future(), lambda db: time.sleep(0.2), (), {}))
+        futures = [self.db.put(i, i) for i in range(10)]
+        count_fut = self.db.count_committed()
+        futures += [self.db.put(i, i) for i in range(10, 20)]
+        # the rows of the first group are not committed before the end of the batch
+        self.assertEqual(0, self._wait(count_fut))
+        for fut in futures:
+            self._wait(fut)
+        self.assertEqual(20, self._wait(self.db.count_committed()))
+
+    def test_writes_are_committed_when_resolved(self):
+        self._wait(self.db.put(1, 2))
+        conn = sqlite3.connect(self.path)
+        try:
+            self.assertEqual([(1, 2)], conn.execute("SELECT key, value FROM kv").fetchall())
+            self.assertEqual('wal', conn.execute("PRAGMA journal_mode").fetchone()[0])
+        finally:
+            conn.close()
+
+    def test_failed_write_fails_only_its_group(self):
+        self.db.db_requests.put((asyncio.Future(), lambda db: time.sleep(0.2), (), {}))
+        fut1 = self.db.put(1, 1)
+        fut2 = self.db.put(1, 2)  # duplicate key
+        fut3 = self.db.get(1)
+        fut4 = self.db.put(2, 2)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self._wait(fut2)
+        self.assertTrue(fut1.exception())
+        self.assertIsNone(self._wait(fut3))
+        self._wait(fut4)
+        self.assertEqual(2, self._wait(self.db.get(2)))
@@ -1,9 +1,11 @@
 from typing import NamedTuple, Union
 
 from actilectrum import transaction, bitcoin
-from actilectrum.transaction import convert_raw_tx_to_hex, tx_from_any, Transaction, PartialTransaction
+from actilectrum.transaction import (convert_raw_tx_to_hex, tx_from_any, Transaction, PartialTransaction,
+                                     PartialTxInput, PartialTxOutput, TxOutpoint, SighashCache)
+from actilectrum.crypto import sha256d
 from actilectrum.util import bh2u, bfh
-from actilectrum import keystore
+from actilectrum import keystore, ecc
 from actilectrum import bip32
 from actilectrum.mnemonic import seed_type
 from actilectrum.simple_config import SimpleConfig
@@ -86,6 +88,55 @@ class TestTransaction(ElectrumTestCase):
         tx.update_signatures(signed_blob_signatures)
         self.assertEqual(tx.serialize(), signed_blob)
 
+    def _make_tx_to_sign(self, num_inputs):
+        privkeys = [ecc.ECPrivkey(bytes([i + 1]) * 32) for i in range(num_inputs)]
+        inputs = []
+        for i, privkey in enumerate(privkeys):
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i]) * 32, out_idx=i))
+            txin.script_type = 'p2wpkh' if i == 2 else 'p2pkh'
+            txin.pubkeys = [privkey.get_public_key_bytes(compressed=True)]
+            txin.num_sig = 1
+            txin._trusted_value_sats = 100_000
+            inputs.append(txin)
+        outputs = [PartialTxOutput(scriptpubkey=bfh('76a914' + '22' * 20 + '88ac'), value=90_000)]
+        tx = PartialTransaction.from_io(inputs, outputs, locktime=0)
+        keypairs = {privkey.get_public_key_hex(): (privkey.get_secret_bytes(), True) for privkey in privkeys}
+        return tx, privkeys, keypairs
+
+    def test_sighash_cache(self):
+        tx, privkeys, keypairs = self._make_tx_to_sign(5)
+        outputs = tx.outputs()
+        def legacy_preimage(k):
+            txins = b''.join(txin.prevout.serialize_to_network()
+                             + (bfh('19' + tx.get_preimage_script(txin)) if i == k else b'\x00')
+                             + txin.nsequence.to_bytes(4, 'little')
+                             for i, txin in enumerate(tx.inputs()))
+            return (tx.version.to_bytes(4, 'little') + b'\x05' + txins
+                    + b'\x01' + outputs[0].serialize_to_network() + bytes(4) + b'\x01\x00\x00\x00')
+        sighash_cache = SighashCache(tx)
+        # in any order, as the hash of the start of the preimages is reused
+        for k in (0, 1, 4, 3, 2, 0):
+            if k == 2:
+                expected = sha256d(bfh(tx.serialize_preimage(k)))
+            else:
+                self.assertEqual(legacy_preimage(k).hex(), tx.serialize_preimage(k))
+                expected = sha256d(legacy_preimage(k))
+            self.assertEqual(expected, sighash_cache.sighash(k))
+        sigs = tx.sign_txins([(k, privkey.get_secret_bytes()) for k, privkey in enumerate(privkeys)])
+        for k, sig in enumerate(sigs):
+            privkeys[k].verify_message_hash(ecc.sig_string_from_der_sig(bfh(sig[:-2])), sighash_cache.sighash(k))
+        tx.sign(keypairs)
+        self.assertTrue(tx.is_complete())
+
+    def test_sign_with_threads(self):
+        tx, privkeys, keypairs = self._make_tx_to_sign(7)
+        tx.sign(keypairs)
+        for num_threads in (2, 3, 10):
+            tx2, privkeys, keypairs = self._make_tx_to_sign(7)
+            tx2.sign(keypairs, num_threads=num_threads)
+            self.assertTrue(tx2.is_complete())
+            self.assertEqual(tx.serialize(), tx2.serialize())
+
     def test_tx_setting_locktime_invalidates_ser_cache(self):
         tx = tx_from_any("cHNidP8BAJICAAAAAdAEtnw/IOVkr4oexG2xYnm+Vevsn3J7nbZsGpiBWS8MAQAAAAD9////A2Q5AwAAAAAAF6kUF6jKG6BuNVhq1RilflIDCitepw6H/NEEAAAAAAAXqRQx9SsFxDAaaOWbLB2ely1ZoZ61DYeIbQoAAAAAABYAFItCjFDsC28Z1R3tFaoi//pcInvnI3AZAAABAR+weRIAAAAAABYAFEK0I6qyqoA/lXCEgysQNZvqokaQIgYC9tgRn6/8hlDLEvEg3lKD1HmNim0gGRYwt4x3aJURIq4MqAq7DwEAAAAUAAAAAAAAIgICXYdVjyDIufLQ3yeDA4M8016luFER2SWaGPk6UF8CbuQMqAq7DwEAAAAXAAAAAA==")
         self.assertEqual("2774c819a05e44861a0555401d2741e6c03079cc4d892c69b910c0f52f407859", tx.txid())
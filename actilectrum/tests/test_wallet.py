@@ -5,9 +5,14 @@ import os
 import json
 from decimal import Decimal
 import time
+import threading
+from unittest import mock
 
 from io import StringIO
-from actilectrum.storage import WalletStorage
+from actilectrum.storage import WalletStorage, StorageEncryptionVersion
+from actilectrum.address_synchronizer import AddressSynchronizer
+from actilectrum.bitcoin import COINBASE_MATURITY
+from actilectrum.transaction import Transaction, TxOutpoint
 from actilectrum.wallet_db import FINAL_SEED_VERSION
 from actilectrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
                                  restore_wallet_from_text, Imported_Wallet)
@@ -18,6 +23,7 @@ from actilectrum.wallet_db import WalletDB
 from actilectrum.simple_config import SimpleConfig
 
 from . import ElectrumTestCase
+from .test_transaction import signed_segwit_blob, v2_blob
 
 
 class FakeSynchronizer(object):
@@ -83,6 +89,297 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+
+class TestWalletStorageAppends(WalletTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.db = WalletDB('', manual_upgrades=False)
+        self.db.put('labels', {'a': 'some label' * 100})
+        self.db.write(self.storage)
+
+    def _reload(self, password=None) -> WalletDB:
+        storage = WalletStorage(self.wallet_path)
+        if password is not None:
+            storage.decrypt(password)
+        return WalletDB(storage.read(), manual_upgrades=False)
+
+    def _read_file(self) -> str:
+        with open(self.wallet_path, "r") as f:
+            return f.read()
+
+    def test_modified_entries_are_appended(self):
+        contents = self._read_file()
+        info = TxMinedInfo(height=10, timestamp=1500000000, txpos=1, header_hash='00' * 32)
+        self.db.add_verified_tx('aa' * 32, info)
+        self.db.add_txi_addr('aa' * 32, 'some_addr', 'bb' * 32 + ':0', 1000)
+        self.db.set_addr_history('some_addr', [('aa' * 32, 10)])
+        self.db.write(self.storage)
+        new_contents = self._read_file()
+        self.assertTrue(new_contents.startswith(contents))
+        self.assertEqual(3, new_contents[len(contents):].count('\n'))
+        db = self._reload()
+        self.assertEqual(info._replace(conf=None), db.get_verified_tx('aa' * 32))
+        self.assertEqual([('bb' * 32 + ':0', 1000)], db.get_txi_addr('aa' * 32, 'some_addr'))
+        self.assertEqual([['aa' * 32, 10]], db.get_addr_history('some_addr'))
+        self.assertEqual('some label' * 100, db.get('labels')['a'])
+        # removals
+        self.db.remove_verified_tx('aa' * 32)
+        self.db.remove_txi('aa' * 32)
+        self.db.write(self.storage)
+        db = self._reload()
+        self.assertEqual(None, db.get_verified_tx('aa' * 32))
+        self.assertEqual([], db.get_txi_addr('aa' * 32, 'some_addr'))
+        # appended changes get compacted on the next write
+        self.assertTrue(db.needs_full_write())
+
+    def test_other_changes_rewrite_file(self):
+        self.db.add_verified_tx('aa' * 32, TxMinedInfo(height=10, timestamp=1, txpos=1, header_hash='00' * 32))
+        self.db.put('labels', {'a': 'another label'})
+        self.db.write(self.storage)
+        d = json.loads(self._read_file())
+        self.assertEqual({'a': 'another label'}, d['labels'])
+        self.assertIn('aa' * 32, d['verified_tx3'])
+
+    def test_file_gets_rewritten_when_twice_as_large(self):
+        for i in range(1000):
+            self.db.add_txo_addr('aa' * 32, 'some_addr', i, 1000, False)
+            self.db.write(self.storage)
+            self.assertLessEqual(self.storage.pos, 3 * self.storage.init_pos)
+        self.assertLess(self.storage.init_pos, self.storage.pos)
+        d = json.loads(self._read_file()[:self.storage.init_pos])
+        self.assertLess(500, len(d['txo']['aa' * 32]['some_addr']))
+        self.assertEqual(1000, len(self._reload().get_txo_addr('aa' * 32, 'some_addr')))
+
+    def test_incomplete_append_is_ignored(self):
+        self.db.add_txo_addr('aa' * 32, 'some_addr', 0, 1000, False)
+        self.db.write(self.storage)
+        with open(self.wallet_path, "a") as f:
+            f.write(',\n["put", "txo", "cc')
+        db = self._reload()
+        self.assertEqual([(0, 1000, False)], db.get_txo_addr('aa' * 32, 'some_addr'))
+        self.assertTrue(db.needs_full_write())
+
+    def test_append_cut_after_separator_is_ignored(self):
+        self.db.add_txo_addr('aa' * 32, 'some_addr', 0, 1000, False)
+        self.db.write(self.storage)
+        with open(self.wallet_path, "a") as f:
+            f.write(',')
+        db = self._reload()
+        self.assertEqual([(0, 1000, False)], db.get_txo_addr('aa' * 32, 'some_addr'))
+        self.assertTrue(db.needs_full_write())
+
+    def test_consolidate_leaves_single_dump(self):
+        self.db.add_txo_addr('aa' * 32, 'some_addr', 0, 1000, False)
+        self.db.write(self.storage)
+        self.assertTrue(self.storage.has_appended_data())
+        self.db.write(self.storage, consolidate=True)
+        self.assertFalse(self.storage.has_appended_data())
+        d = json.loads(self._read_file())
+        self.assertEqual([1000, False], d['txo']['aa' * 32]['some_addr']['0'])
+
+    def test_appending_to_encrypted_file(self):
+        self.storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        self.db.set_modified(True)
+        self.db.write(self.storage)
+        self.db.add_txo_addr('aa' * 32, 'some_addr', 0, 1000, False)
+        self.db.write(self.storage)
+        self.assertEqual(2, len(self._read_file().split('\n')))
+        db = self._reload(password='secret')
+        self.assertEqual([(0, 1000, False)], db.get_txo_addr('aa' * 32, 'some_addr'))
+        # after changing the password, the file gets rewritten
+        self.storage.set_password('another secret', StorageEncryptionVersion.USER_PASSWORD)
+        self.db.add_txo_addr('aa' * 32, 'some_addr', 1, 1000, False)
+        self.db.write(self.storage)
+        self.assertEqual(1, len(self._read_file().split('\n')))
+        db = self._reload(password='another secret')
+        self.assertEqual([(0, 1000, False), (1, 1000, False)], db.get_txo_addr('aa' * 32, 'some_addr'))
+
+    def test_transactions_are_kept_as_bytes(self):
+        tx = Transaction(signed_segwit_blob)
+        txid = tx.txid()
+        self.db.add_txi_addr(txid, 'some_addr', 'bb' * 32 + ':0', 1000)
+        self.db.add_transaction(txid, tx)
+        self.assertIs(tx, self.db.get_transaction(txid))
+        self.db.write(self.storage)
+        db = self._reload()
+        self.assertEqual(bytes.fromhex(signed_segwit_blob), db.transactions[txid])
+        tx2 = db.get_transaction(txid)
+        self.assertEqual(signed_segwit_blob, tx2.serialize())
+        self.assertIs(tx2, db.get_transaction(txid))
+        # only the most recently requested txs are kept parsed
+        db.TX_CACHE_SIZE = 1
+        other_tx = Transaction(v2_blob)
+        db.add_transaction(other_tx.txid(), other_tx)
+        self.assertIsNot(tx2, db.get_transaction(txid))
+        self.assertEqual(txid, db.get_transaction(txid).txid())
+        self.assertEqual(txid, db.remove_transaction(txid).txid())
+        self.assertIsNone(db.get_transaction(txid))
+
+
+class TestWalletDBReads(WalletTestCase):
+
+    def test_reads_do_not_wait_for_writers(self):
+        db = WalletDB('', manual_upgrades=False)
+        info = TxMinedInfo(height=10, timestamp=1500000000, txpos=1, header_hash='00' * 32)
+        db.add_verified_tx('aa' * 32, info)
+        db.add_txo_addr('aa' * 32, 'some_addr', 0, 1000, False)
+        db.set_addr_history('some_addr', [('aa' * 32, 10)])
+        locked = threading.Event()
+        release = threading.Event()
+        def writer():
+            with db.lock:
+                locked.set()
+                release.wait(10)
+        t = threading.Thread(target=writer)
+        t.start()
+        try:
+            locked.wait()
+            self.assertEqual(info._replace(conf=None), db.get_verified_tx('aa' * 32))
+            self.assertEqual([(0, 1000, False)], db.get_txo_addr('aa' * 32, 'some_addr'))
+            self.assertEqual([], db.get_txi_addr('aa' * 32, 'some_addr'))
+            self.assertEqual([('aa' * 32, 10)], db.get_addr_history('some_addr'))
+            self.assertTrue(db.is_in_verified_tx('aa' * 32))
+            self.assertEqual(FINAL_SEED_VERSION, db.get('seed_version'))
+        finally:
+            release.set()
+            t.join()
+
+
+class TestAddressSynchronizerCaches(WalletTestCase):
+
+    TXID1 = '11' * 32
+    TXID2 = '22' * 32
+    ADDR = 'some_addr'
+
+    def _make_adb(self, *, is_coinbase=False) -> AddressSynchronizer:
+        db = WalletDB('', manual_upgrades=False)
+        db.put('stored_height', 1000)
+        db.add_txo_addr(self.TXID1, self.ADDR, 0, 50000, is_coinbase)
+        db.add_verified_tx(self.TXID1, TxMinedInfo(height=990, timestamp=1, txpos=0, header_hash='00' * 32))
+        db.set_addr_history(self.ADDR, [(self.TXID1, 990)])
+        return AddressSynchronizer(db)
+
+    def test_balance_follows_tx_height_changes(self):
+        adb = self._make_adb()
+        self.assertEqual((50000, 0, 0), adb.get_addr_balance(self.ADDR))
+        class FakeBlockchain:
+            def check_hash(self, height, header_hash):
+                return False
+        self.assertEqual({self.TXID1}, adb.undo_verifications(FakeBlockchain(), 900))
+        adb.add_unverified_tx(self.TXID1, 0)
+        self.assertEqual((0, 50000, 0), adb.get_addr_balance(self.ADDR))
+        self.assertEqual(0, adb.get_addr_utxo(self.ADDR)[TxOutpoint.from_str(self.TXID1 + ':0')].block_height)
+        with mock.patch('actilectrum.util.trigger_callback'):
+            adb.add_verified_tx(self.TXID1, TxMinedInfo(height=995, timestamp=1, txpos=0, header_hash='00' * 32))
+        self.assertEqual((50000, 0, 0), adb.get_addr_balance(self.ADDR))
+        self.assertEqual(995, adb.get_addr_utxo(self.ADDR)[TxOutpoint.from_str(self.TXID1 + ':0')].block_height)
+        adb.remove_transaction(self.TXID1)
+        self.assertEqual((0, 0, 0), adb.get_addr_balance(self.ADDR))
+        self.assertEqual({}, adb.get_addr_utxo(self.ADDR))
+
+    def test_utxos_follow_spends(self):
+        adb = self._make_adb()
+        self.assertEqual([TxOutpoint.from_str(self.TXID1 + ':0')], list(adb.get_addr_utxo(self.ADDR)))
+        adb.db.add_txi_addr(self.TXID2, self.ADDR, self.TXID1 + ':0', 50000)
+        adb.db.add_txo_addr(self.TXID2, self.ADDR, 0, 40000, False)
+        adb._add_tx_to_local_history(self.TXID2)
+        adb.add_unverified_tx(self.TXID2, 0)
+        self.assertEqual([TxOutpoint.from_str(self.TXID2 + ':0')], list(adb.get_addr_utxo(self.ADDR)))
+        self.assertEqual((50000, -10000, 0), adb.get_addr_balance(self.ADDR))
+        # returned dicts are copies, and do not corrupt the cache
+        received, sent = adb.get_addr_io(self.ADDR)
+        received.clear()
+        adb.get_addr_utxo(self.ADDR).clear()
+        self.assertEqual(2, len(adb.get_addr_io(self.ADDR)[0]))
+        self.assertEqual(1, len(adb.get_addr_utxo(self.ADDR)))
+
+    def test_history_index_follows_changes(self):
+        adb = self._make_adb()
+        def check(expected_txids):
+            history = adb.get_history()
+            self.assertEqual(expected_txids, [hist_item.txid for hist_item in history])
+            self.assertEqual(adb._get_history_of_domain(set(adb.get_addresses())), history)
+        check([self.TXID1])
+        adb.db.add_txi_addr(self.TXID2, self.ADDR, self.TXID1 + ':0', 50000)
+        adb.db.add_txo_addr(self.TXID2, self.ADDR, 0, 40000, False)
+        adb._add_tx_to_local_history(self.TXID2)
+        adb.add_unverified_tx(self.TXID2, 0)
+        check([self.TXID1, self.TXID2])
+        self.assertEqual([50000, 40000], [hist_item.balance for hist_item in adb.get_history()])
+        with mock.patch('actilectrum.util.trigger_callback'):
+            adb.add_verified_tx(self.TXID2, TxMinedInfo(height=980, timestamp=2, txpos=0, header_hash='00' * 32))
+        # spends before its parent, by height
+        self.assertEqual([self.TXID2, self.TXID1], [hist_item.txid for hist_item in adb.get_history()])
+        adb.remove_transaction(self.TXID2)
+        check([self.TXID1])
+
+    def test_history_time_range(self):
+        adb = self._make_adb()
+        txid3 = '33' * 32
+        adb.db.add_txo_addr(self.TXID2, self.ADDR, 0, 10000, False)
+        adb.db.add_verified_tx(self.TXID2, TxMinedInfo(height=995, timestamp=5, txpos=0, header_hash='00' * 32))
+        adb._add_tx_to_local_history(self.TXID2)
+        adb.db.add_txo_addr(txid3, self.ADDR, 0, 20000, False)
+        adb._add_tx_to_local_history(txid3)
+        adb.add_unverified_tx(txid3, 0)
+        history = adb.get_history()
+        self.assertEqual([self.TXID1, self.TXID2, txid3], [hist_item.txid for hist_item in history])
+        self.assertEqual(history[:1], adb.get_history(to_timestamp=2))
+        self.assertEqual(history[1:2], adb.get_history(from_timestamp=2, to_timestamp=10))
+        self.assertEqual(history[1:], adb.get_history(from_timestamp=2))
+        self.assertEqual(history[2:], adb.get_history(from_timestamp=10))
+
+    def _add_out_of_order_txs(self, adb: AddressSynchronizer) -> str:
+        txid3 = '33' * 32
+        adb.db.add_txo_addr(self.TXID2, self.ADDR, 0, 10000, False)
+        adb.db.add_verified_tx(self.TXID2, TxMinedInfo(height=995, timestamp=5, txpos=0, header_hash='00' * 32))
+        adb._add_tx_to_local_history(self.TXID2)
+        # a later block, with an earlier timestamp
+        adb.db.add_txo_addr(txid3, self.ADDR, 0, 20000, False)
+        adb.db.add_verified_tx(txid3, TxMinedInfo(height=996, timestamp=3, txpos=0, header_hash='00' * 32))
+        adb._add_tx_to_local_history(txid3)
+        return txid3
+
+    def test_history_time_range_with_out_of_order_timestamps(self):
+        adb = self._make_adb()
+        txid3 = self._add_out_of_order_txs(adb)
+        history = adb.get_history()
+        self.assertEqual([self.TXID1, self.TXID2, txid3], [hist_item.txid for hist_item in history])
+        self.assertEqual([history[0], history[2]], adb.get_history(to_timestamp=4))
+        self.assertEqual(history[2:], adb.get_history(from_timestamp=2, to_timestamp=4))
+        self.assertEqual(history[1:2], adb.get_history(from_timestamp=4))
+        adb.remove_transaction(txid3)
+        self.assertEqual(history[:1], adb.get_history(to_timestamp=4))
+
+    def test_monotonic_timestamps_of_time_range(self):
+        adb = self._make_adb()
+        txid3 = self._add_out_of_order_txs(adb)
+        txids = [self.TXID1, self.TXID2, txid3]
+        self.assertEqual([1, 5, 5], adb.get_monotonic_timestamps(txids))
+        self.assertEqual([1, 5, 5], adb.get_monotonic_timestamps(txids, domain=[self.ADDR]))
+        self.assertEqual([5], adb.get_monotonic_timestamps([txid3]))
+        # the timestamps of the txs out of the range count too
+        adb.get_label = lambda txid: ''
+        items = list(Abstract_Wallet.get_onchain_history(adb, from_timestamp=2, to_timestamp=4))
+        self.assertEqual([(txid3, 3, 5)], [(item['txid'], item['timestamp'], item['monotonic_timestamp'])
+                                           for item in items])
+        items = list(Abstract_Wallet.get_onchain_history(adb))
+        self.assertEqual([1, 5, 5], [item['monotonic_timestamp'] for item in items])
+
+    def test_coinbase_maturity(self):
+        adb = self._make_adb(is_coinbase=True)
+        self.assertEqual((0, 0, 50000), adb.get_addr_balance(self.ADDR))
+        adb.db.put('stored_height', 990 + COINBASE_MATURITY - 2)
+        self.assertEqual((0, 0, 50000), adb.get_addr_balance(self.ADDR))
+        adb.db.put('stored_height', 990 + COINBASE_MATURITY - 1)
+        self.assertEqual((50000, 0, 0), adb.get_addr_balance(self.ADDR))
+        # reorg to a shorter chain
+        adb.db.put('stored_height', 1000)
+        self.assertEqual((0, 0, 50000), adb.get_addr_balance(self.ADDR))
+
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -35,16 +35,18 @@ import base64
 from typing import (Sequence, Union, NamedTuple, Tuple, Optional, Iterable,
                     Callable, List, Dict, Set, TYPE_CHECKING)
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
 import itertools
 import binascii
+import hashlib
 
 from . import ecc, bitcoin, constants, segwit_addr, bip32
 from .bip32 import BIP32Node
 from .util import profiler, to_bytes, bh2u, bfh, chunks, is_hex_str
 from .bitcoin import (TYPE_ADDRESS, TYPE_SCRIPT, hash_160,
                       hash160_to_p2sh, hash160_to_p2pkh, hash_to_segwit_addr,
-                      var_int, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC, COIN,
+                      var_int, var_int_bytes, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC, COIN,
                       int_to_hex, push_script, b58_address_to_hash160,
                       opcodes, add_number_to_script, base_decode, is_segwit_script_type)
 from .crypto import sha256d
@@ -105,7 +107,7 @@ class TxOutput:
     def serialize_to_network(self) -> bytes:
         buf = int.to_bytes(self.value, 8, byteorder="little", signed=False)
         script = self.scriptpubkey
-        buf += bfh(var_int(len(script.hex()) // 2))
+        buf += var_int_bytes(len(script))
         buf += script
         return buf
 
@@ -162,9 +164,9 @@ class TxOutput:
 
 
 class BIP143SharedTxDigestFields(NamedTuple):
-    hashPrevouts: str
-    hashSequence: str
-    hashOutputs: str
+    hashPrevouts: bytes
+    hashSequence: bytes
+    hashOutputs: bytes
 
 
 class TxOutpoint(NamedTuple):
@@ -184,7 +186,7 @@ class TxOutpoint(NamedTuple):
         return [self.txid.hex(), self.out_idx]
 
     def serialize_to_network(self) -> bytes:
-        return self.txid[::-1] + bfh(int_to_hex(self.out_idx, 4))
+        return self.txid[::-1] + self.out_idx.to_bytes(4, 'little')
 
     def is_coinbase(self) -> bool:
         return self.txid == bytes(32)
@@ -490,9 +492,12 @@ def construct_witness(items: Sequence[Union[str, int, bytes]]) -> str:
 
 
 def parse_witness(vds: BCDataStream, txin: TxInput) -> None:
+    # the serialized witness is kept as is
+    start = vds.read_cursor
     n = vds.read_compact_size()
-    witness_elements = list(vds.read_bytes(vds.read_compact_size()) for i in range(n))
-    txin.witness = bfh(construct_witness(witness_elements))
+    for i in range(n):
+        vds.read_bytes(vds.read_compact_size())
+    txin.witness = bytes(vds.input[start:vds.read_cursor])
 
 
 def parse_output(vds: BCDataStream) -> TxOutput:
@@ -518,8 +523,13 @@ def multisig_script(public_keys: Sequence[str], m: int) -> str:
 
 
 
+def int_to_bytes(i: int, length: int) -> bytes:
+    """As int_to_hex, but returns bytes."""
+    return i.to_bytes(length, 'little', signed=i < 0)
+
+
 class Transaction:
-    _cached_network_ser: Optional[str]
+    _cached_network_ser: Optional[bytes]
 
     def __str__(self):
         return self.serialize()
@@ -528,10 +538,11 @@ class Transaction:
         if raw is None:
             self._cached_network_ser = None
         elif isinstance(raw, str):
-            self._cached_network_ser = raw.strip() if raw else None
-            assert is_hex_str(self._cached_network_ser)
+            raw = raw.strip() if raw else None
+            assert is_hex_str(raw)
+            self._cached_network_ser = bfh(raw)
         elif isinstance(raw, (bytes, bytearray)):
-            self._cached_network_ser = bh2u(raw)
+            self._cached_network_ser = bytes(raw)
         else:
             raise Exception(f"cannot initialize transaction from {raw}")
         self._inputs = None  # type: List[TxInput]
@@ -584,9 +595,8 @@ class Transaction:
         if self._inputs is not None:
             return
 
-        raw_bytes = bfh(self._cached_network_ser)
         vds = BCDataStream()
-        vds.write(raw_bytes)
+        vds.write(self._cached_network_ser)
         self._version = vds.read_int32()
         n_vin = vds.read_compact_size()
         is_segwit = (n_vin == 0)
@@ -765,24 +775,23 @@ class Transaction:
             raise UnknownTxinType(f'cannot construct preimage_script for txin_type: {txin.script_type}')
 
     @classmethod
-    def serialize_input(self, txin: TxInput, script: str) -> str:
-        # Prev hash and index
-        s = txin.prevout.serialize_to_network().hex()
-        # Script length, script, sequence
-        s += var_int(len(script)//2)
-        s += script
-        s += int_to_hex(txin.nsequence, 4)
-        return s
-
-    def _calc_bip143_shared_txdigest_fields(self) -> BIP143SharedTxDigestFields:
-        inputs = self.inputs()
-        outputs = self.outputs()
-        hashPrevouts = bh2u(sha256d(b''.join(txin.prevout.serialize_to_network() for txin in inputs)))
-        hashSequence = bh2u(sha256d(bfh(''.join(int_to_hex(txin.nsequence, 4) for txin in inputs))))
-        hashOutputs = bh2u(sha256d(bfh(''.join(o.serialize_to_network().hex() for o in outputs))))
-        return BIP143SharedTxDigestFields(hashPrevouts=hashPrevouts,
-                                          hashSequence=hashSequence,
-                                          hashOutputs=hashOutputs)
+    def serialize_input(self, txin: TxInput, script: bytes) -> bytes:
+        # Prev hash and index, script length, script, sequence
+        return (txin.prevout.serialize_to_network()
+                + var_int_bytes(len(script))
+                + script
+                + int_to_bytes(txin.nsequence, 4))
+
+    def _input_script_bytes(self, txin: TxInput, *, estimate_size=False) -> bytes:
+        # parsed and finalized inputs have their scriptSig as bytes already
+        if txin.script_sig is not None:
+            return txin.script_sig
+        return bfh(self.input_script(txin, estimate_size=estimate_size))
+
+    def _serialize_witness_bytes(self, txin: TxInput, *, estimate_size=False) -> bytes:
+        if txin.witness is not None:
+            return txin.witness
+        return bfh(self.serialize_witness(txin, estimate_size=estimate_size))
 
     def is_segwit(self, *, guess_for_address=False):
         return any(self.is_segwit_input(txin, guess_for_address=guess_for_address)
@@ -793,12 +802,12 @@ class Transaction:
         self._cached_txid = None
 
     def serialize(self) -> str:
-        if not self._cached_network_ser:
-            self._cached_network_ser = self.serialize_to_network(estimate_size=False, include_sigs=True)
-        return self._cached_network_ser
+        return self.serialize_as_bytes().hex()
 
     def serialize_as_bytes(self) -> bytes:
-        return bfh(self.serialize())
+        if not self._cached_network_ser:
+            self._cached_network_ser = self._serialize_to_network_bytes(estimate_size=False, include_sigs=True)
+        return self._cached_network_ser
 
     def serialize_to_network(self, *, estimate_size=False, include_sigs=True, force_legacy=False) -> str:
         """Serialize the transaction as used on the Bitcoin network, into hex.
@@ -806,27 +815,31 @@ class Transaction:
         `force_legacy` signals to use the pre-segwit format
         note: (not include_sigs) implies force_legacy
         """
+        return self._serialize_to_network_bytes(estimate_size=estimate_size, include_sigs=include_sigs,
+                                                force_legacy=force_legacy).hex()
+
+    def _serialize_to_network_bytes(self, *, estimate_size=False, include_sigs=True, force_legacy=False) -> bytes:
         self.deserialize()
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        nVersion = int_to_bytes(self.version, 4)
+        nLocktime = int_to_bytes(self.locktime, 4)
         inputs = self.inputs()
         outputs = self.outputs()
 
-        def create_script_sig(txin: TxInput) -> str:
+        def create_script_sig(txin: TxInput) -> bytes:
             if include_sigs:
-                return self.input_script(txin, estimate_size=estimate_size)
-            return ''
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, create_script_sig(txin))
-                                               for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(o.serialize_to_network().hex() for o in outputs)
+                return self._input_script_bytes(txin, estimate_size=estimate_size)
+            return b''
+        txins = var_int_bytes(len(inputs)) + b''.join(self.serialize_input(txin, create_script_sig(txin))
+                                                      for txin in inputs)
+        txouts = var_int_bytes(len(outputs)) + b''.join(o.serialize_to_network() for o in outputs)
 
         use_segwit_ser_for_estimate_size = estimate_size and self.is_segwit(guess_for_address=True)
         use_segwit_ser_for_actual_use = not estimate_size and self.is_segwit()
         use_segwit_ser = use_segwit_ser_for_estimate_size or use_segwit_ser_for_actual_use
         if include_sigs and not force_legacy and use_segwit_ser:
-            marker = '00'
-            flag = '01'
-            witness = ''.join(self.serialize_witness(x, estimate_size=estimate_size) for x in inputs)
+            marker = b'\x00'
+            flag = b'\x01'
+            witness = b''.join(self._serialize_witness_bytes(x, estimate_size=estimate_size) for x in inputs)
             return nVersion + marker + flag + txins + txouts + witness + nLocktime
         else:
             return nVersion + txins + txouts + nLocktime
@@ -838,11 +851,11 @@ class Transaction:
             if not all_segwit and not self.is_complete():
                 return None
             try:
-                ser = self.serialize_to_network(force_legacy=True)
+                ser = self._serialize_to_network_bytes(force_legacy=True)
             except UnknownTxinType:
                 # we might not know how to construct scriptSig for some scripts
                 return None
-            self._cached_txid = bh2u(sha256d(bfh(ser))[::-1])
+            self._cached_txid = sha256d(ser)[::-1].hex()
         return self._cached_txid
 
     def wtxid(self) -> Optional[str]:
@@ -850,11 +863,11 @@ class Transaction:
         if not self.is_complete():
             return None
         try:
-            ser = self.serialize_to_network()
+            ser = self._serialize_to_network_bytes()
         except UnknownTxinType:
             # we might not know how to construct scriptSig/witness for some scripts
             return None
-        return bh2u(sha256d(bfh(ser))[::-1])
+        return sha256d(ser)[::-1].hex()
 
     def add_info_from_wallet(self, wallet: 'Abstract_Wallet') -> None:
         return  # no-op
@@ -875,8 +888,8 @@ class Transaction:
     @classmethod
     def estimated_input_weight(cls, txin, is_segwit_tx):
         '''Return an estimate of serialized input weight in weight units.'''
-        script = cls.input_script(txin, estimate_size=True)
-        input_size = len(cls.serialize_input(txin, script)) // 2
+        script = bfh(cls.input_script(txin, estimate_size=True))
+        input_size = len(cls.serialize_input(txin, script))
 
         if cls.is_segwit_input(txin, guess_for_address=True):
             witness_size = len(cls.serialize_witness(txin, estimate_size=True)) // 2
@@ -899,9 +912,9 @@ class Transaction:
     def estimated_total_size(self):
         """Return an estimated total transaction size in bytes."""
         if not self.is_complete() or self._cached_network_ser is None:
-            return len(self.serialize_to_network(estimate_size=True)) // 2
+            return len(self._serialize_to_network_bytes(estimate_size=True))
         else:
-            return len(self._cached_network_ser) // 2  # ASCII hex string
+            return len(self._cached_network_ser)
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
@@ -909,8 +922,8 @@ class Transaction:
         if not self.is_segwit(guess_for_address=estimate):
             return 0
         inputs = self.inputs()
-        witness = ''.join(self.serialize_witness(x, estimate_size=estimate) for x in inputs)
-        witness_size = len(witness) // 2 + 2  # include marker and flag
+        witness = b''.join(self._serialize_witness_bytes(x, estimate_size=estimate) for x in inputs)
+        witness_size = len(witness) + 2  # include marker and flag
         return witness_size
 
     def estimated_base_size(self):
@@ -1254,7 +1267,7 @@ class PartialTxInput(TxInput, PSBTSection):
         if self.witness_utxo:
             wr(PSBTInputType.WITNESS_UTXO, self.witness_utxo.serialize_to_network())
         elif self.utxo:
-            wr(PSBTInputType.NON_WITNESS_UTXO, bfh(self.utxo.serialize_to_network(include_sigs=True)))
+            wr(PSBTInputType.NON_WITNESS_UTXO, self.utxo._serialize_to_network_bytes(include_sigs=True))
         for pk, val in sorted(self.part_sigs.items()):
             wr(PSBTInputType.PARTIAL_SIG, val, pk)
         if self.sighash is not None:
@@ -1311,18 +1324,21 @@ class PartialTxInput(TxInput, PSBTSection):
             return True
         if self.script_sig is not None and not Transaction.is_segwit_input(self):
             return True
-        signatures = list(self.part_sigs.values())
-        s = len(signatures)
+        num_sigs_required = self.get_num_sigs_required()
+        return num_sigs_required is not None and len(self.part_sigs) >= num_sigs_required
+
+    def get_num_sigs_required(self) -> Optional[int]:
+        """Number of signatures needed to finalize the input, or None if unknown."""
         # note: The 'script_type' field is currently only set by the wallet,
         #       for its own addresses. This means we can only finalize inputs
         #       that are related to the wallet.
         #       The 'fix' would be adding extra logic that matches on templates,
         #       and figures out the script_type from available fields.
         if self.script_type in ('p2pk', 'p2pkh', 'p2wpkh', 'p2wpkh-p2sh'):
-            return s >= 1
+            return 1
         if self.script_type in ('p2sh', 'p2wsh', 'p2wsh-p2sh'):
-            return s >= self.num_sig
-        return False
+            return self.num_sig
+        return None
 
     def finalize(self) -> None:
         def clear_fields_when_finalized():
@@ -1502,6 +1518,105 @@ class PartialTxOutput(TxOutput, PSBTSection):
         self._unknown.update(other_txout._unknown)
 
 
+class SighashCache:
+    """Computes the SIGHASH_ALL digests of the inputs of a transaction.
+    The parts shared by all inputs are serialized once, so that the digest
+    of each input takes time linear in the size of the transaction.
+    The transaction must not be changed while the cache is in use.
+    """
+
+    def __init__(self, tx: 'PartialTransaction', *,
+                 bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None):
+        self.tx = tx
+        self.inputs = tx.inputs()
+        self.version = int_to_bytes(tx.version, 4)
+        self.locktime = int_to_bytes(tx.locktime, 4)
+        self.outputs = b''.join(o.serialize_to_network() for o in tx.outputs())
+        self._bip143 = bip143_shared_txdigest_fields
+        self._legacy = None  # type: Optional[Tuple[bytes, List[int], bytes]]
+        # (k, sha256 of the legacy preimages up to the k-th input)
+        self._legacy_prefix = None
+
+    def get_bip143_shared_txdigest_fields(self) -> BIP143SharedTxDigestFields:
+        if self._bip143 is None:
+            self._bip143 = BIP143SharedTxDigestFields(
+                hashPrevouts=sha256d(b''.join(txin.prevout.serialize_to_network() for txin in self.inputs)),
+                hashSequence=sha256d(b''.join(int_to_bytes(txin.nsequence, 4) for txin in self.inputs)),
+                hashOutputs=sha256d(self.outputs))
+        return self._bip143
+
+    def _get_legacy(self) -> Tuple[bytes, List[int], bytes]:
+        # inputs with empty scriptSigs, their offsets, and what follows them
+        if self._legacy is None:
+            serialized_inputs = [Transaction.serialize_input(txin, b'') for txin in self.inputs]
+            offsets = [0]
+            for serialized_input in serialized_inputs:
+                offsets.append(offsets[-1] + len(serialized_input))
+            tail = var_int_bytes(len(self.tx.outputs())) + self.outputs + self.locktime
+            self._legacy = b''.join(serialized_inputs), offsets, tail
+        return self._legacy
+
+    def _get_nhashtype(self, txin: 'PartialTxInput') -> bytes:
+        sighash = txin.sighash if txin.sighash is not None else SIGHASH_ALL
+        if sighash != SIGHASH_ALL:
+            raise Exception("only SIGHASH_ALL signing is supported!")
+        return int_to_bytes(sighash, 4)
+
+    def _bip143_preimage(self, txin_index: int) -> bytes:
+        txin = self.inputs[txin_index]
+        fields = self.get_bip143_shared_txdigest_fields()
+        preimage_script = bfh(self.tx.get_preimage_script(txin))
+        return (self.version + fields.hashPrevouts + fields.hashSequence
+                + txin.prevout.serialize_to_network()
+                + var_int_bytes(len(preimage_script)) + preimage_script
+                + int_to_bytes(txin.value_sats(), 8)
+                + int_to_bytes(txin.nsequence, 4)
+                + fields.hashOutputs + self.locktime + self._get_nhashtype(txin))
+
+    def _legacy_parts(self, txin_index: int) -> List[bytes]:
+        # the preimage is: prefix, the input with the preimage script, suffix
+        txin = self.inputs[txin_index]
+        inputs, offsets, tail = self._get_legacy()
+        script_input = Transaction.serialize_input(txin, bfh(self.tx.get_preimage_script(txin)))
+        suffix = memoryview(inputs)[offsets[txin_index + 1]:]
+        return [script_input, suffix, tail, self._get_nhashtype(txin)]
+
+    def _legacy_prefix_hash(self, txin_index: int):
+        inputs, offsets, tail = self._get_legacy()
+        if self._legacy_prefix is None or self._legacy_prefix[0] > txin_index:
+            h = hashlib.sha256(self.version + var_int_bytes(len(self.inputs)))
+            self._legacy_prefix = 0, h
+        k, h = self._legacy_prefix
+        # inputs are usually signed in order, so that the prefix is hashed once
+        h.update(memoryview(inputs)[offsets[k]:offsets[txin_index]])
+        self._legacy_prefix = txin_index, h
+        return h.copy()
+
+    def preimage(self, txin_index: int) -> bytes:
+        if self.tx.is_segwit_input(self.inputs[txin_index]):
+            return self._bip143_preimage(txin_index)
+        inputs, offsets, tail = self._get_legacy()
+        prefix = self.version + var_int_bytes(len(self.inputs)) + inputs[:offsets[txin_index]]
+        return prefix + b''.join(self._legacy_parts(txin_index))
+
+    def sighash(self, txin_index: int) -> bytes:
+        """Returns sha256d of the preimage of the input."""
+        if self.tx.is_segwit_input(self.inputs[txin_index]):
+            return sha256d(self._bip143_preimage(txin_index))
+        h = self._legacy_prefix_hash(txin_index)
+        for part in self._legacy_parts(txin_index):
+            h.update(part)
+        return hashlib.sha256(h.digest()).digest()
+
+
+def _sign_sighashes(items: Sequence[Tuple[bytes, bytes]]) -> List[str]:
+    """Signs each (privkey_bytes, sighash) item. Returns the signatures in hex,
+    with SIGHASH_ALL appended.
+    """
+    return [bh2u(ecc.ECPrivkey(privkey_bytes).sign_transaction(pre_hash)) + '01'
+            for privkey_bytes, pre_hash in items]
+
+
 class PartialTransaction(Transaction):
 
     def __init__(self, raw_unsigned_tx):
@@ -1558,7 +1673,7 @@ class PartialTransaction(Transaction):
                     if tx is not None:
                         raise SerializationError(f"duplicate key: {repr(kt)}")
                     if key: raise SerializationError(f"key for {repr(kt)} must be empty")
-                    unsigned_tx = Transaction(val.hex())
+                    unsigned_tx = Transaction(val)
                     for txin in unsigned_tx.inputs():
                         if txin.script_sig or txin.witness:
                             raise SerializationError(f"PSBT {repr(kt)} must have empty scriptSigs and witnesses")
@@ -1643,7 +1758,7 @@ class PartialTransaction(Transaction):
         wr = PSBTSection.create_psbt_writer(fd)
         fd.write(b'psbt\xff')
         # global section
-        wr(PSBTGlobalType.UNSIGNED_TX, bfh(self.serialize_to_network(include_sigs=False)))
+        wr(PSBTGlobalType.UNSIGNED_TX, self._serialize_to_network_bytes(include_sigs=False))
         for bip32node, (xfp, path) in sorted(self.xpubs.items()):
             val = pack_bip32_root_fingerprint_and_int_path(xfp, path)
             wr(PSBTGlobalType.XPUB, val, key=bip32node.to_bytes())
@@ -1750,61 +1865,64 @@ class PartialTransaction(Transaction):
 
     def serialize_preimage(self, txin_index: int, *,
                            bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None) -> str:
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
-        inputs = self.inputs()
-        outputs = self.outputs()
-        txin = inputs[txin_index]
-        sighash = txin.sighash if txin.sighash is not None else SIGHASH_ALL
-        if sighash != SIGHASH_ALL:
-            raise Exception("only SIGHASH_ALL signing is supported!")
-        nHashType = int_to_hex(sighash, 4)
-        preimage_script = self.get_preimage_script(txin)
-        if self.is_segwit_input(txin):
-            if bip143_shared_txdigest_fields is None:
-                bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
-            hashPrevouts = bip143_shared_txdigest_fields.hashPrevouts
-            hashSequence = bip143_shared_txdigest_fields.hashSequence
-            hashOutputs = bip143_shared_txdigest_fields.hashOutputs
-            outpoint = txin.prevout.serialize_to_network().hex()
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin.value_sats(), 8)
-            nSequence = int_to_hex(txin.nsequence, 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
-        else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, preimage_script if txin_index==k else '')
-                                                   for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(o.serialize_to_network().hex() for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
-        return preimage
+        sighash_cache = SighashCache(self, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)
+        return sighash_cache.preimage(txin_index).hex()
 
-    def sign(self, keypairs) -> None:
+    def sign(self, keypairs, *, num_threads: int = 1) -> None:
         # keypairs:  pubkey_hex -> (secret_bytes, is_compressed)
-        bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
+        to_sign = []  # (txin_index, pubkey_hex, secret_bytes)
         for i, txin in enumerate(self.inputs()):
-            pubkeys = [pk.hex() for pk in txin.pubkeys]
-            for pubkey in pubkeys:
-                if txin.is_complete():
+            if txin.is_complete():
+                continue
+            # sign with our keys until the input would be complete
+            num_sigs_required = txin.get_num_sigs_required()
+            signed = set(txin.part_sigs)
+            for pubkey in [pk.hex() for pk in txin.pubkeys]:
+                if num_sigs_required is not None and len(signed) >= num_sigs_required:
                     break
                 if pubkey not in keypairs:
                     continue
-                _logger.info(f"adding signature for {pubkey}")
                 sec, compressed = keypairs[pubkey]
-                sig = self.sign_txin(i, sec, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)
-                self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
+                to_sign.append((i, pubkey, sec))
+                signed.add(bfh(pubkey))
+        sigs = self.sign_txins([(i, sec) for i, pubkey, sec in to_sign], num_threads=num_threads)
+        for (i, pubkey, sec), sig in zip(to_sign, sigs):
+            _logger.info(f"adding signature for {pubkey}")
+            self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
 
         _logger.debug(f"is_complete {self.is_complete()}")
         self.invalidate_ser_cache()
 
-    def sign_txin(self, txin_index, privkey_bytes, *, bip143_shared_txdigest_fields=None) -> str:
+    def sign_txins(self, txins_and_privkeys: Sequence[Tuple[int, bytes]], *,
+                   num_threads: int = 1) -> List[str]:
+        """Signs the given inputs, each with the given private key.
+        The sighashes of all inputs are computed in one pass.
+
+        With num_threads > 1, the signatures are made in a pool of threads:
+        libsecp256k1 is called through ctypes, which releases the GIL.
+        Signatures are deterministic (RFC 6979), so that the result
+        does not depend on num_threads.
+        """
+        sighash_cache = SighashCache(self)
+        items = []  # (privkey_bytes, sighash)
+        for txin_index, privkey_bytes in txins_and_privkeys:
+            self.inputs()[txin_index].validate_data(for_signing=True)
+            items.append((privkey_bytes, sighash_cache.sighash(txin_index)))
+        if num_threads <= 1 or len(items) <= 1:
+            return _sign_sighashes(items)
+        batch_size = -(-len(items) // num_threads)
+        with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='sign') as executor:
+            batches = executor.map(_sign_sighashes, [items[i:i+batch_size]
+                                                     for i in range(0, len(items), batch_size)])
+            return [sig for batch in batches for sig in batch]
+
+    def sign_txin(self, txin_index, privkey_bytes, *, sighash_cache: SighashCache = None) -> str:
         txin = self.inputs()[txin_index]
         txin.validate_data(for_signing=True)
-        pre_hash = sha256d(bfh(self.serialize_preimage(txin_index,
-                                                       bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)))
-        privkey = ecc.ECPrivkey(privkey_bytes)
-        sig = privkey.sign_transaction(pre_hash)
-        sig = bh2u(sig) + '01'  # SIGHASH_ALL
-        return sig
+        if sighash_cache is None:
+            sighash_cache = SighashCache(self)
+        pre_hash = sighash_cache.sighash(txin_index)
+        return _sign_sighashes([(privkey_bytes, pre_hash)])[0]
 
     def is_complete(self) -> bool:
         return all([txin.is_complete() for txin in self.inputs()])
@@ -1824,7 +1942,7 @@ class PartialTransaction(Transaction):
         """Returns PSBT as base64 text, or raw hex of network tx (if complete)."""
         self.finalize_psbt()
         if self.is_complete():
-            return Transaction.serialize(self)
+            return Transaction.serialize_as_bytes(self).hex()
         return self._serialize_as_base64()
 
     def serialize_as_bytes(self, *, force_psbt: bool = False) -> bytes:
@@ -1852,12 +1970,13 @@ class PartialTransaction(Transaction):
             return
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        sighash_cache = SighashCache(self)
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             sig = signatures[i]
             if bfh(sig) in list(txin.part_sigs.values()):
                 continue
-            pre_hash = sha256d(bfh(self.serialize_preimage(i)))
+            pre_hash = sighash_cache.sighash(i)
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
             for recid in range(4):
                 try:
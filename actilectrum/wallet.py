@@ -166,7 +166,7 @@ def sweep(privkeys, *, network: 'Network', config: 'SimpleConfig',
 
     tx = PartialTransaction.from_io(inputs, outputs, locktime=locktime, version=tx_version)
     tx.set_rbf(True)
-    tx.sign(keypairs)
+    tx.sign(keypairs, num_threads=config.get('sign_threads', 1))
     return tx
 
 
@@ -260,9 +260,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         self.lnworker = LNWallet(self, ln_xprv) if ln_xprv else None
         self.lnbackups = LNBackups(self)
 
-    def save_db(self):
+    def save_db(self, *, consolidate: bool = False):
         if self.storage:
-            self.db.write(self.storage)
+            self.db.write(self.storage, consolidate=consolidate)
 
     def save_backup(self):
         backup_dir = get_backup_dir(self.config)
@@ -322,7 +322,8 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
                 self.lnworker = None
             self.lnbackups.stop()
             self.lnbackups = None
-        self.save_db()
+        # leave a file that older versions can open
+        self.save_db(consolidate=True)
 
     def set_up_to_date(self, b):
         super().set_up_to_date(b)
@@ -611,10 +612,16 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         # return last balance
         return balance
 
-    def get_onchain_history(self, *, domain=None):
-        monotonic_timestamp = 0
-        for hist_item in self.get_history(domain=domain):
-            monotonic_timestamp = max(monotonic_timestamp, (hist_item.tx_mined_status.timestamp or float('inf')))
+    def get_onchain_history(self, *, domain=None, from_timestamp=None, to_timestamp=None):
+        history = self.get_history(domain=domain, from_timestamp=from_timestamp, to_timestamp=to_timestamp)
+        if from_timestamp or to_timestamp:
+            # the txs before the time range, and those skipped in it, count too
+            monotonic_timestamps = self.get_monotonic_timestamps([hist_item.txid for hist_item in history],
+                                                                 domain=domain)
+        else:
+            monotonic_timestamps = itertools.accumulate(
+                (hist_item.tx_mined_status.timestamp or float('inf') for hist_item in history), max)
+        for hist_item, monotonic_timestamp in zip(history, monotonic_timestamps):
             yield {
                 'txid': hist_item.txid,
                 'fee_sat': hist_item.fee,
@@ -825,13 +832,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         capital_gains = Decimal(0)
         fiat_income = Decimal(0)
         fiat_expenditures = Decimal(0)
-        now = time.time()
-        for item in self.get_onchain_history():
-            timestamp = item['timestamp']
-            if from_timestamp and (timestamp or now) < from_timestamp:
-                continue
-            if to_timestamp and (timestamp or now) >= to_timestamp:
-                continue
+        for item in self.get_onchain_history(from_timestamp=from_timestamp, to_timestamp=to_timestamp):
             tx_hash = item['txid']
             tx = self.db.get_transaction(tx_hash)
             tx_fee = item['fee_sat']
@@ -1477,7 +1478,11 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         # sign. start with ready keystores.
         for k in sorted(self.get_keystores(), key=lambda ks: ks.ready_to_sign(), reverse=True):
             try:
-                if k.can_sign(tmp_tx):
+                if not k.can_sign(tmp_tx):
+                    continue
+                if isinstance(k, keystore.Software_KeyStore):
+                    k.sign_transaction(tmp_tx, password, num_threads=self.config.get('sign_threads', 1))
+                else:
                     k.sign_transaction(tmp_tx, password)
             except UserCancelled:
                 continue
@@ -2184,6 +2189,9 @@ class Deterministic_Wallet(Abstract_Wallet):
     def derive_pubkeys(self, c: int, i: int) -> Sequence[str]:
         pass
 
+    def derive_pubkeys_range(self, c: int, start: int, count: int) -> List[Sequence[str]]:
+        return [self.derive_pubkeys(c, i) for i in range(start, start + count)]
+
     def derive_address(self, for_change: int, n: int) -> str:
         for_change = int(for_change)
         pubkeys = self.derive_pubkeys(for_change, n)
@@ -2217,30 +2225,37 @@ class Deterministic_Wallet(Abstract_Wallet):
             txinout.bip32_paths[pubkey] = (fp_bytes, der_full)
 
     def create_new_address(self, for_change: bool = False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change: bool, count: int) -> List[str]:
         assert type(for_change) is bool
         with self.lock:
             n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            address = self.derive_address(int(for_change), n)
-            self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
-            self.add_address(address)
-            if for_change:
-                # note: if it's actually used, it will get filtered later
-                self._unused_change_addresses.append(address)
-            return address
+            addresses = [self.pubkeys_to_address(pubkeys)
+                         for pubkeys in self.derive_pubkeys_range(int(for_change), n, count)]
+            for address in addresses:
+                self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
+                self.add_address(address)
+                if for_change:
+                    # note: if it's actually used, it will get filtered later
+                    self._unused_change_addresses.append(address)
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
             if num_addr < limit:
-                self.create_new_address(for_change)
+                self.create_new_addresses(for_change, limit - num_addr)
                 continue
             if for_change:
                 last_few_addresses = self.get_change_addresses(slice_start=-limit)
             else:
                 last_few_addresses = self.get_receiving_addresses(slice_start=-limit)
-            if any(map(self.address_is_old, last_few_addresses)):
-                self.create_new_address(for_change)
+            # the window of the last 'limit' addresses must not contain old ones
+            old_indices = [i for i, addr in enumerate(last_few_addresses) if self.address_is_old(addr)]
+            if old_indices:
+                self.create_new_addresses(for_change, old_indices[-1] + 1)
             else:
                 break
 
@@ -2326,6 +2341,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [self.keystore.derive_pubkey(c, i).hex()]
 
+    def derive_pubkeys_range(self, c, start, count):
+        return [[pubkey.hex()] for pubkey in self.keystore.derive_pubkeys_range(c, start, count)]
+
 
 
 
@@ -2382,6 +2400,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i).hex() for k in self.get_keystores()]
 
+    def derive_pubkeys_range(self, c, start, count):
+        pubkeys_of_keystores = [k.derive_pubkeys_range(c, start, count) for k in self.get_keystores()]
+        return [[pubkey.hex() for pubkey in pubkeys] for pubkeys in zip(*pubkeys_of_keystores)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
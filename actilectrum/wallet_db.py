@@ -27,7 +27,7 @@ import ast
 import json
 import copy
 import threading
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from typing import Dict, Optional, List, Tuple, Set, Iterable, NamedTuple, Sequence, TYPE_CHECKING, Union
 import binascii
 
@@ -38,7 +38,7 @@ from .transaction import Transaction, TxOutpoint, tx_from_any, PartialTransactio
 from .logging import Logger
 from .lnutil import LOCAL, REMOTE, FeeUpdate, UpdateAddHtlc, LocalConfig, RemoteConfig, Keypair, OnlyPubkeyKeypair, RevocationStore, ChannelBackupStorage
 from .lnutil import ChannelConstraints, Outpoint, ShachainElement
-from .json_db import StoredDict, JsonDB, locked, modifier
+from .json_db import StoredDict, JsonDB, locked, modifier, entry_modifier
 from .plugin import run_hook, plugin_loaders
 from .paymentrequest import PaymentRequest
 
@@ -62,10 +62,21 @@ class TxFeesValue(NamedTuple):
 
 class WalletDB(JsonDB):
 
+    APPENDABLE_KEYS = frozenset([
+        'txi', 'txo', 'spent_outpoints', 'prevouts_by_scripthash', 'transactions',
+        'addr_history', 'verified_tx3', 'tx_fees', 'addresses',
+    ])
+    # number of parsed transactions kept in memory
+    TX_CACHE_SIZE = 1000
+
     def __init__(self, raw, *, manual_upgrades: bool):
         JsonDB.__init__(self, {})
         self._manual_upgrades = manual_upgrades
         self._called_after_upgrade_tasks = False
+        # complete txs are stored as raw bytes, and parsed when requested.
+        # txid -> Transaction, for the most recently requested ones
+        self._parsed_txs = OrderedDict()  # type: OrderedDict[str, Transaction]
+        self._parsed_txs_lock = threading.Lock()
         if raw:  # loading existing db
             self.load_data(raw)
             self.load_plugins()
@@ -75,7 +86,7 @@ class WalletDB(JsonDB):
 
     def load_data(self, s):
         try:
-            self.data = json.loads(s)
+            self.data = self.load_json(s)
         except:
             try:
                 d = ast.literal_eval(s)
@@ -683,19 +694,20 @@ class WalletDB(JsonDB):
                 msg += "\nPlease open this file with Actilectrum 1.9.8, and move your coins to a new wallet."
         raise WalletFileException(msg)
 
-    @locked
+    # note: the getters of single entries below do not take the lock.
+    #       StoredDict reads are atomic, and each of these getters
+    #       looks up the entry only once.
+
     def get_txi_addresses(self, tx_hash: str) -> List[str]:
         """Returns list of is_mine addresses that appear as inputs in tx."""
         assert isinstance(tx_hash, str)
         return list(self.txi.get(tx_hash, {}).keys())
 
-    @locked
     def get_txo_addresses(self, tx_hash: str) -> List[str]:
         """Returns list of is_mine addresses that appear as outputs in tx."""
         assert isinstance(tx_hash, str)
         return list(self.txo.get(tx_hash, {}).keys())
 
-    @locked
     def get_txi_addr(self, tx_hash: str, address: str) -> Iterable[Tuple[str, int]]:
         """Returns an iterable of (prev_outpoint, value)."""
         assert isinstance(tx_hash, str)
@@ -703,15 +715,14 @@ class WalletDB(JsonDB):
         d = self.txi.get(tx_hash, {}).get(address, {})
         return list(d.items())
 
-    @locked
     def get_txo_addr(self, tx_hash: str, address: str) -> Iterable[Tuple[int, int, bool]]:
         """Returns an iterable of (output_index, value, is_coinbase)."""
         assert isinstance(tx_hash, str)
         assert isinstance(address, str)
         d = self.txo.get(tx_hash, {}).get(address, {})
-        return [(int(n), v, cb) for (n, (v, cb)) in d.items()]
+        return [(int(n), v, cb) for (n, (v, cb)) in list(d.items())]
 
-    @modifier
+    @entry_modifier
     def add_txi_addr(self, tx_hash: str, addr: str, ser: str, v: int) -> None:
         assert isinstance(tx_hash, str)
         assert isinstance(addr, str)
@@ -724,7 +735,7 @@ class WalletDB(JsonDB):
             d[addr] = {}
         d[addr][ser] = v
 
-    @modifier
+    @entry_modifier
     def add_txo_addr(self, tx_hash: str, addr: str, n: Union[int, str], v: int, is_coinbase: bool) -> None:
         n = str(n)
         assert isinstance(tx_hash, str)
@@ -747,12 +758,12 @@ class WalletDB(JsonDB):
     def list_txo(self) -> Sequence[str]:
         return list(self.txo.keys())
 
-    @modifier
+    @entry_modifier
     def remove_txi(self, tx_hash: str) -> None:
         assert isinstance(tx_hash, str)
         self.txi.pop(tx_hash, None)
 
-    @modifier
+    @entry_modifier
     def remove_txo(self, tx_hash: str) -> None:
         assert isinstance(tx_hash, str)
         self.txo.pop(tx_hash, None)
@@ -769,13 +780,12 @@ class WalletDB(JsonDB):
         assert isinstance(prevout_hash, str)
         return list(self.spent_outpoints.get(prevout_hash, {}).keys())
 
-    @locked
     def get_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str]) -> Optional[str]:
         assert isinstance(prevout_hash, str)
         prevout_n = str(prevout_n)
         return self.spent_outpoints.get(prevout_hash, {}).get(prevout_n)
 
-    @modifier
+    @entry_modifier
     def remove_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str]) -> None:
         assert isinstance(prevout_hash, str)
         prevout_n = str(prevout_n)
@@ -783,7 +793,7 @@ class WalletDB(JsonDB):
         if not self.spent_outpoints[prevout_hash]:
             self.spent_outpoints.pop(prevout_hash)
 
-    @modifier
+    @entry_modifier
     def set_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str], tx_hash: str) -> None:
         assert isinstance(prevout_hash, str)
         assert isinstance(tx_hash, str)
@@ -792,7 +802,7 @@ class WalletDB(JsonDB):
             self.spent_outpoints[prevout_hash] = {}
         self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
 
-    @modifier
+    @entry_modifier
     def add_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
         assert isinstance(scripthash, str)
         assert isinstance(prevout, TxOutpoint)
@@ -800,13 +810,15 @@ class WalletDB(JsonDB):
         if scripthash not in self._prevouts_by_scripthash:
             self._prevouts_by_scripthash[scripthash] = set()
         self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value))
+        self.set_path_modified(['prevouts_by_scripthash', scripthash])
 
-    @modifier
+    @entry_modifier
     def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
         assert isinstance(scripthash, str)
         assert isinstance(prevout, TxOutpoint)
         assert isinstance(value, int)
         self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
+        self.set_path_modified(['prevouts_by_scripthash', scripthash])
         if not self._prevouts_by_scripthash[scripthash]:
             self._prevouts_by_scripthash.pop(scripthash)
 
@@ -816,7 +828,7 @@ class WalletDB(JsonDB):
         prevouts_and_values = self._prevouts_by_scripthash.get(scripthash, set())
         return {(TxOutpoint.from_str(prevout), value) for prevout, value in prevouts_and_values}
 
-    @modifier
+    @entry_modifier
     def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
         assert isinstance(tx_hash, str)
         assert isinstance(tx, Transaction), tx
@@ -828,19 +840,51 @@ class WalletDB(JsonDB):
         # don't allow overwriting complete tx with partial tx
         tx_we_already_have = self.transactions.get(tx_hash, None)
         if tx_we_already_have is None or isinstance(tx_we_already_have, PartialTransaction):
-            self.transactions[tx_hash] = tx
+            if isinstance(tx, PartialTransaction):
+                self.transactions[tx_hash] = tx
+            else:
+                self.transactions[tx_hash] = tx.serialize_as_bytes()
+            # tx might be the object we already have, updated in place
+            self.set_path_modified(['transactions', tx_hash])
+            self._cache_parsed_tx(tx_hash, tx)
 
-    @modifier
+    @entry_modifier
     def remove_transaction(self, tx_hash: str) -> Optional[Transaction]:
         assert isinstance(tx_hash, str)
-        return self.transactions.pop(tx_hash, None)
+        with self._parsed_txs_lock:
+            tx = self._parsed_txs.pop(tx_hash, None)
+        raw_tx = self.transactions.pop(tx_hash, None)
+        if isinstance(raw_tx, bytes):
+            return tx or Transaction(raw_tx)
+        return raw_tx
 
-    @locked
     def get_transaction(self, tx_hash: Optional[str]) -> Optional[Transaction]:
         if tx_hash is None:
             return None
         assert isinstance(tx_hash, str)
-        return self.transactions.get(tx_hash)
+        raw_tx = self.transactions.get(tx_hash)
+        if not isinstance(raw_tx, bytes):
+            return raw_tx
+        with self._parsed_txs_lock:
+            tx = self._parsed_txs.get(tx_hash)
+            if tx is not None:
+                self._parsed_txs.move_to_end(tx_hash)
+                return tx
+        # note: the tx gets deserialized when it is first used
+        tx = Transaction(raw_tx)
+        self._cache_parsed_tx(tx_hash, tx)
+        return tx
+
+    def _cache_parsed_tx(self, tx_hash: str, tx: Transaction) -> None:
+        with self._parsed_txs_lock:
+            if isinstance(tx, PartialTransaction):
+                # those are kept in self.transactions
+                self._parsed_txs.pop(tx_hash, None)
+                return
+            self._parsed_txs[tx_hash] = tx
+            self._parsed_txs.move_to_end(tx_hash)
+            while len(self._parsed_txs) > self.TX_CACHE_SIZE:
+                self._parsed_txs.popitem(last=False)
 
     @locked
     def list_transactions(self) -> Sequence[str]:
@@ -855,17 +899,16 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         return addr in self.history
 
-    @locked
     def get_addr_history(self, addr: str) -> Sequence[Tuple[str, int]]:
         assert isinstance(addr, str)
         return self.history.get(addr, [])
 
-    @modifier
+    @entry_modifier
     def set_addr_history(self, addr: str, hist) -> None:
         assert isinstance(addr, str)
         self.history[addr] = hist
 
-    @modifier
+    @entry_modifier
     def remove_addr_history(self, addr: str) -> None:
         assert isinstance(addr, str)
         self.history.pop(addr, None)
@@ -874,25 +917,25 @@ class WalletDB(JsonDB):
     def list_verified_tx(self) -> Sequence[str]:
         return list(self.verified_tx.keys())
 
-    @locked
     def get_verified_tx(self, txid: str) -> Optional[TxMinedInfo]:
         assert isinstance(txid, str)
-        if txid not in self.verified_tx:
+        info = self.verified_tx.get(txid)
+        if info is None:
             return None
-        height, timestamp, txpos, header_hash = self.verified_tx[txid]
+        height, timestamp, txpos, header_hash = info
         return TxMinedInfo(height=height,
                            conf=None,
                            timestamp=timestamp,
                            txpos=txpos,
                            header_hash=header_hash)
 
-    @modifier
+    @entry_modifier
     def add_verified_tx(self, txid: str, info: TxMinedInfo):
         assert isinstance(txid, str)
         assert isinstance(info, TxMinedInfo)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
 
-    @modifier
+    @entry_modifier
     def remove_verified_tx(self, txid: str):
         assert isinstance(txid, str)
         self.verified_tx.pop(txid, None)
@@ -901,7 +944,7 @@ class WalletDB(JsonDB):
         assert isinstance(txid, str)
         return txid in self.verified_tx
 
-    @modifier
+    @entry_modifier
     def add_tx_fee_from_server(self, txid: str, fee_sat: Optional[int]) -> None:
         assert isinstance(txid, str)
         # note: when called with (fee_sat is None), rm currently saved value
@@ -912,7 +955,7 @@ class WalletDB(JsonDB):
             return
         self.tx_fees[txid] = tx_fees_value._replace(fee=fee_sat, is_calculated_by_us=False)
 
-    @modifier
+    @entry_modifier
     def add_tx_fee_we_calculated(self, txid: str, fee_sat: Optional[int]) -> None:
         assert isinstance(txid, str)
         if fee_sat is None:
@@ -922,7 +965,6 @@ class WalletDB(JsonDB):
             self.tx_fees[txid] = TxFeesValue()
         self.tx_fees[txid] = self.tx_fees[txid]._replace(fee=fee_sat, is_calculated_by_us=True)
 
-    @locked
     def get_tx_fee(self, txid: str, *, trust_server: bool = False) -> Optional[int]:
         assert isinstance(txid, str)
         """Returns tx_fee."""
@@ -933,7 +975,7 @@ class WalletDB(JsonDB):
             return None
         return tx_fees_value.fee
 
-    @modifier
+    @entry_modifier
     def add_num_inputs_to_tx(self, txid: str, num_inputs: int) -> None:
         assert isinstance(txid, str)
         assert isinstance(num_inputs, int)
@@ -941,7 +983,6 @@ class WalletDB(JsonDB):
             self.tx_fees[txid] = TxFeesValue()
         self.tx_fees[txid] = self.tx_fees[txid]._replace(num_inputs=num_inputs)
 
-    @locked
     def get_num_all_inputs_of_tx(self, txid: str) -> Optional[int]:
         assert isinstance(txid, str)
         tx_fees_value = self.tx_fees.get(txid)
@@ -949,13 +990,12 @@ class WalletDB(JsonDB):
             return None
         return tx_fees_value.num_inputs
 
-    @locked
     def get_num_ismine_inputs_of_tx(self, txid: str) -> int:
         assert isinstance(txid, str)
         txins = self.txi.get(txid, {})
-        return sum([len(tupls) for addr, tupls in txins.items()])
+        return sum([len(tupls) for tupls in list(txins.values())])
 
-    @modifier
+    @entry_modifier
     def remove_tx_fee(self, txid: str) -> None:
         assert isinstance(txid, str)
         self.tx_fees.pop(txid, None)
@@ -986,17 +1026,19 @@ class WalletDB(JsonDB):
         # note: slicing makes a shallow copy
         return self.receiving_addresses[slice_start:slice_stop]
 
-    @modifier
+    @entry_modifier
     def add_change_address(self, addr: str) -> None:
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (1, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self.set_path_modified(['addresses', 'change'])
 
-    @modifier
+    @entry_modifier
     def add_receiving_address(self, addr: str) -> None:
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (0, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self.set_path_modified(['addresses', 'receiving'])
 
     @locked
     def get_address_index(self, address: str) -> Optional[Sequence[int]]:
@@ -1046,14 +1088,17 @@ class WalletDB(JsonDB):
 
     @profiler
     def _load_transactions(self):
+        # converting data does not change it
+        modified = self._modified
         self.data = StoredDict(self.data, self, [])
+        self.set_modified(modified)
         # references in self.data
         # TODO make all these private
         # txid -> address -> prev_outpoint -> value
         self.txi = self.get_dict('txi')                          # type: Dict[str, Dict[str, Dict[str, int]]]
         # txid -> address -> output_index -> (value, is_coinbase)
         self.txo = self.get_dict('txo')                          # type: Dict[str, Dict[str, Dict[str, Tuple[int, bool]]]]
-        self.transactions = self.get_dict('transactions')        # type: Dict[str, Transaction]
+        self.transactions = self.get_dict('transactions')        # type: Dict[str, Union[bytes, PartialTransaction]]
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
@@ -1078,9 +1123,11 @@ class WalletDB(JsonDB):
         #      it's horrible. we need to change this, at least for the internal representation,
         #      to something that can be typed.
         self.invoices = self.get_dict('invoices')
+        modified = self._modified
         for invoice_key, invoice in self.invoices.items():
             if invoice.get('type') == PR_TYPE_ONCHAIN:
                 invoice['outputs'] = [PartialTxOutput.from_legacy_tuple(*output) for output in invoice.get('outputs')]
+        self._modified = modified
 
     @modifier
     def clear_history(self):
@@ -1088,6 +1135,8 @@ class WalletDB(JsonDB):
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        with self._parsed_txs_lock:
+            self._parsed_txs.clear()
         self.history.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
@@ -1095,8 +1144,8 @@ class WalletDB(JsonDB):
 
     def _convert_dict(self, path, key, v):
         if key == 'transactions':
-            # note: for performance, "deserialize=False" so that we will deserialize these on-demand
-            v = dict((k, tx_from_any(x, deserialize=False)) for k, x in v.items())
+            # note: for performance, complete txs are kept as bytes, see get_transaction
+            v = dict((k, self._raw_tx_from_json(x)) for k, x in v.items())
         elif key == 'adds':
             v = dict((k, UpdateAddHtlc.from_tuple(*x)) for k, x in v.items())
         elif key == 'fee_updates':
@@ -1113,6 +1162,13 @@ class WalletDB(JsonDB):
             v = dict((k, bfh(x)) for k, x in v.items())
         return v
 
+    @staticmethod
+    def _raw_tx_from_json(x: str) -> Union[bytes, PartialTransaction]:
+        try:
+            return bytes.fromhex(x)
+        except ValueError:  # psbt
+            return tx_from_any(x, deserialize=False)
+
     def _convert_value(self, path, key, v):
         if key == 'local_config':
             v = LocalConfig(**v)
@@ -1124,17 +1180,24 @@ class WalletDB(JsonDB):
             v = Outpoint(**v)
         return v
 
-    def write(self, storage: 'WalletStorage'):
+    def write(self, storage: 'WalletStorage', *, consolidate: bool = False):
+        """Writes the changes to storage. With consolidate, the file is left
+        as a single JSON dump, which is what older versions can read.
+        """
         with self.lock:
-            self._write(storage)
+            self._write(storage, consolidate=consolidate)
 
-    def _write(self, storage: 'WalletStorage'):
+    def _write(self, storage: 'WalletStorage', *, consolidate: bool = False):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
             return
-        if not self.modified():
+        consolidate = consolidate and storage.has_appended_data()
+        if not self.modified() and not consolidate:
             return
-        storage.write(self.dump())
+        if consolidate or self.needs_full_write() or storage.needs_consolidation():
+            storage.write(self.dump())
+        else:
+            storage.append(self.dump_modified_entries())
         self.set_modified(False)
 
     def is_ready_to_be_used_by_wallet(self):